@@ -1,12 +1,37 @@
 import streamlit as st
-import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
-import io
+import fitz  # PyMuPDF
+import os
+import shutil
+import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
+from urllib.parse import quote
+from dotenv import load_dotenv
+from disk_cache import cache_dir, cache_get, cache_key, cache_put_file, env_bytes, env_int, env_seconds
+from s3_upload import get_s3_client, transfer_config
+from object_cache import describe_object_cache_stats, object_cache_stats, open_cached_object
+from archive_tree import (
+    get_folder_node, get_month_manifest, invalidate_archive_prefix, iter_folder_files, list_folder,
+    load_month_manifests, refresh_archive_roots,
+)
+from archive_index import ARCHIVE_SECTIONS, DEFAULT_PAGE_SIZE, find_identifier, search_archive
+from manifest import MANIFEST_NAME
+from jobs import deferred_file
 
 
-//
+load_dotenv()
+AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
+AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
+S3_BUCKET_NAME = "sanj0908"
+
+# Folder ZIPs built on request are kept on local disk (.env file):
+#   ARCHIVE_DOWNLOAD_WORKERS     objects fetched at the same time (default 16)
+#   FOLDER_ZIP_CACHE_MAX_BYTES   byte budget of the folder ZIP cache (default 2 GB)
+#   PRESIGNED_URL_EXPIRES        seconds a file download link stays valid (default 900)
+DEFAULT_ARCHIVE_DOWNLOAD_WORKERS = 16
+DEFAULT_FOLDER_ZIP_CACHE_MAX_BYTES = 2 * 1024 ** 3
+DEFAULT_PRESIGNED_URL_EXPIRES = 900
 
 
 def get_readable_file_size(size_bytes):
@@ -16,60 +41,176 @@ def get_readable_file_size(size_bytes):
         size_bytes /= 1024
     return f"{size_bytes:.2f} PB"
 
-@st.cache_data(show_spinner=False)
 def list_s3_objects(prefix):
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=AWS_ACCESS_KEY,
-        aws_secret_access_key=AWS_SECRET_KEY
+    """Sub-folders and files of prefix, answered from the archive tree (see archive_tree)."""
+    s3_client = get_s3_client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+    folders, files = list_folder(s3_client, S3_BUCKET_NAME, prefix)
+    return folders, [file for file in files if file['Name'] != MANIFEST_NAME]
+
+def get_folder_size(folder_prefix):
+    """Total bytes under folder_prefix, from the archive tree."""
+    s3_client = get_s3_client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+    return get_folder_node(s3_client, S3_BUCKET_NAME, folder_prefix)["bytes"]
+
+def list_folder_objects(s3_client, folder_prefix):
+    """(path inside the folder, object) of every object under folder_prefix, from the archive tree."""
+    return [
+        (name, obj) for name, obj in iter_folder_files(get_folder_node(s3_client, S3_BUCKET_NAME, folder_prefix))
+        if obj['Name'] != MANIFEST_NAME
+    ]
+
+def objects_zip_key(entries):
+    """Cache key of the ZIP of entries: every entry's name, key, ETag and LastModified."""
+    return cache_key(
+        "objects-zip", S3_BUCKET_NAME,
+        *[f"{name}|{obj['Key']}|{obj.get('ETag', '')}|{obj['LastModified'].isoformat()}" for name, obj in entries]
     )
 
-    paginator = s3_client.get_paginator('list_objects_v2')
-    operation_parameters = {'Bucket': S3_BUCKET_NAME, 'Prefix': prefix, 'Delimiter': '/'}
-    folders = []
-    files = []
-
-    for page in paginator.paginate(**operation_parameters):
-        for common_prefix in page.get('CommonPrefixes', []):
-            folders.append(common_prefix['Prefix'])
-
-        for content in page.get('Contents', []):
-            if content['Key'] != prefix:
-                files.append({
-                    'Key': content['Key'],
-                    'Size': content['Size'],
-                    'Name': Path(content['Key']).name
-                })
-
-    return folders, files
-
-@st.cache_data(show_spinner=False)
-def get_folder_size_cached(folder_prefix):
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=AWS_ACCESS_KEY,
-        aws_secret_access_key=AWS_SECRET_KEY
+def build_objects_zip(s3_client, entries):
+    """
+    Builds a ZIP of S3 objects and returns its path on local disk.
+    entries lists (name inside the ZIP, object from a listing with Key, ETag and LastModified).
+      - The ZIP is cached by every entry's name, key, ETag and LastModified, so the same objects
+        are downloaded from S3 again only after one of them changed.
+      - Objects are fetched concurrently (ARCHIVE_DOWNLOAD_WORKERS at a time, at most twice that
+        many waiting) through the local object cache, so objects downloaded before are read from
+        disk. They are streamed one by one into a temporary file on disk, stored (PDFs and xlsx
+        files are already compressed).
+    """
+    zip_key = objects_zip_key(entries)
+    cached_path = cache_get("folder_zips", zip_key)
+    if cached_path is not None:
+        return cached_path
+
+    workers = env_int("ARCHIVE_DOWNLOAD_WORKERS", DEFAULT_ARCHIVE_DOWNLOAD_WORKERS)
+    workers = workers if workers > 0 else DEFAULT_ARCHIVE_DOWNLOAD_WORKERS
+
+    def fetch(entry):
+        name, obj = entry
+        return name, open_cached_object(s3_client, S3_BUCKET_NAME, obj)
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir("folder_zips"), suffix=".tmp")
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf, \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            remaining = iter(entries)
+            pending = set()
+            while True:
+                for entry in remaining:
+                    pending.add(pool.submit(fetch, entry))
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, source = future.result()
+                    with source, zipf.open(name, 'w', force_zip64=True) as member:
+                        shutil.copyfileobj(source, member, 1024 * 1024)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    max_bytes = env_bytes("FOLDER_ZIP_CACHE_MAX_BYTES", DEFAULT_FOLDER_ZIP_CACHE_MAX_BYTES)
+    return cache_put_file("folder_zips", zip_key, tmp_path, max_bytes)
+
+def prepared_zip_path(zip_key):
+    """Path of the ZIP cached under zip_key (see objects_zip_key), or None once it was evicted."""
+    return cache_get("folder_zips", zip_key) if zip_key is not None else None
+
+def selected_entries(s3_client, selected_folders, selected_files):
+    """(name inside the ZIP, object) of every selected file and every object under the selected folders."""
+    entries = []
+    for folder in selected_folders:
+        for name, obj in list_folder_objects(s3_client, folder):
+            entries.append((f"{Path(folder).name}/{name}", obj))
+    entries.extend((file['Name'], file) for file in selected_files)
+    return entries
+
+def presigned_download_url(s3_client, key, file_name):
+    """
+    Short-lived (PRESIGNED_URL_EXPIRES seconds) GET URL of an object, so the browser downloads
+    it straight from S3 as file_name. Signing is local: it costs no request to S3.
+    """
+    expires = env_seconds("PRESIGNED_URL_EXPIRES", DEFAULT_PRESIGNED_URL_EXPIRES)
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': S3_BUCKET_NAME,
+            'Key': key,
+            'ResponseContentDisposition': f"attachment; filename*=UTF-8''{quote(file_name)}"
+        },
+        ExpiresIn=expires if expires > 0 else DEFAULT_PRESIGNED_URL_EXPIRES
+    )
+
+def show_archive_search(s3_client, query):
+    """Paginated results of a search over every archived file of Bank, PF and ESIC."""
+    refresh_archive_roots(s3_client, S3_BUCKET_NAME, [f"{section}/" for section in ARCHIVE_SECTIONS])
+    page = st.number_input("Page", min_value=1, value=1, step=1, key="archive_search_page") - 1
+    total, results = search_archive(
+        S3_BUCKET_NAME, query, page=page, page_size=DEFAULT_PAGE_SIZE, exclude_names=(MANIFEST_NAME,)
     )
-    paginator = s3_client.get_paginator('list_objects_v2')
-    total_size = 0
-    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=folder_prefix):
-        for obj in page.get('Contents', []):
-            total_size += obj['Size']
-    return total_size
-
-def download_folder_zip(s3_client, folder_prefix):
-    paginator = s3_client.get_paginator('list_objects_v2')
-    buffer = io.BytesIO()
-    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=folder_prefix):
-            for obj in page.get('Contents', []):
-                key = obj['Key']
-                obj_data = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
-                file_bytes = obj_data['Body'].read()
-                filename = key[len(folder_prefix):]
-                zipf.writestr(filename, file_bytes)
-    buffer.seek(0)
-    return buffer
+    pages = max(1, -(-total // DEFAULT_PAGE_SIZE))
+    st.info(f"🔍 {total} file(s) match \"{query}\" (page {min(page + 1, pages)} of {pages})")
+    for result in results:
+        st.link_button(
+            f"📄 {result['Key']} ({get_readable_file_size(result['Size'])})",
+            presigned_download_url(s3_client, result['Key'], result['Name'])
+        )
+
+def get_archive_object(s3_client, key):
+    """Listing entry (Key, Size, ETag, ...) of an archived object: from the tree, else a HEAD request."""
+    folder_prefix, _, name = key.rpartition('/')
+    obj = get_folder_node(s3_client, S3_BUCKET_NAME, folder_prefix + '/')["files"].get(name)
+    if obj is None:
+        head = s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=key)
+        obj = {'Key': key, 'Size': head['ContentLength'], 'ETag': head['ETag'], 'LastModified': head['LastModified']}
+    return obj
+
+def open_pdf(path):
+    """fitz.open(path), raising the built-in FileNotFoundError for a missing file (see open_cached_object)."""
+    try:
+        return fitz.open(path)
+    except fitz.FileNotFoundError as e:
+        raise FileNotFoundError(path) from e
+
+def extract_statement(s3_client, match):
+    """PDF bytes holding only the pages of one identifier match (see find_identifier)."""
+    obj = get_archive_object(s3_client, match['Key'])
+    statement = fitz.open()
+    with open_cached_object(s3_client, S3_BUCKET_NAME, obj, transfer_config(), opener=open_pdf) as unit_pdf:
+        for page_number in match['Pages']:
+            statement.insert_pdf(unit_pdf, from_page=page_number - 1, to_page=page_number - 1)
+    statement_bytes = statement.write()
+    statement.close()
+    return statement_bytes
+
+def show_identifier_lookup(s3_client, identifier):
+    """Every archived statement of one employee, each extractable on its own."""
+    load_month_manifests(s3_client, S3_BUCKET_NAME, [f"{section}/" for section in ARCHIVE_SECTIONS])
+    matches = find_identifier(S3_BUCKET_NAME, identifier)
+    st.info(f"👤 {identifier} appears in {len(matches)} archived statement(s)")
+    # Extracted statements of this session: widget key -> PDF bytes.
+    if "statements" not in st.session_state:
+        st.session_state.statements = {}
+    for match in matches:
+        pages = ", ".join(str(page) for page in match['Pages'])
+        label = f"{match['Section']} · {match['Month']} · {match['Unit']} · page(s) {pages}"
+        statement_key = f"statement_{identifier}_{match['Key']}"
+        statement = st.session_state.statements.get(statement_key)
+        if statement is None and st.button(f"📄 {label}", key=statement_key):
+            with st.spinner("Extracting pages ..."):
+                statement = extract_statement(s3_client, match)
+            st.session_state.statements[statement_key] = statement
+        if statement is not None:
+            st.download_button(
+                label=f"⬇️ {label}",
+                data=statement,
+                file_name=f"{identifier}_{match['Section']}_{match['Month']}_{match['Unit']}.pdf",
+                mime="application/pdf",
+                key=statement_key + "_download"
+            )
+    st.caption(describe_object_cache_stats(object_cache_stats()))
 
 def run_archive_section():
     st.markdown("""
@@ -92,22 +233,45 @@ def run_archive_section():
 
     if "s3_path" not in st.session_state:
         st.session_state.s3_path = f"{archive_type}/"
+    # Folder prefix -> cache key of its ZIP (objects_zip_key), for folders whose ZIP was requested.
+    # The key changes with any object of the folder, so a stale ZIP is never offered.
+    if "folder_zips" not in st.session_state:
+        st.session_state.folder_zips = {}
 
     if archive_type and not st.session_state.s3_path.startswith(archive_type):
         st.session_state.s3_path = f"{archive_type}/"
 
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=AWS_ACCESS_KEY,
-        aws_secret_access_key=AWS_SECRET_KEY
-    )
+    s3_client = get_s3_client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+
+    # 🔎 Search across every month and section (answered from the local search index)
+    archive_query = st.text_input("🔎 Search the whole archive (unit, month, file type)", "").strip()
+    if archive_query:
+        show_archive_search(s3_client, archive_query)
+        return
+
+    # 👤 Single-employee statements (from the identifier index of the month manifests)
+    identifier = st.text_input("👤 Employee lookup (PF UAN, ESINO or bank account number)", "").strip()
+    if identifier:
+        show_identifier_lookup(s3_client, identifier)
+        return
 
     current_path = st.session_state.s3_path
+    # Folders and files always come from the archive tree, so units uploaded before manifests
+    # existed (or by a run whose manifest write failed) are listed too. The manifest of a month
+    # folder ("PF/March-2025/") only adds each unit's matched / unmatched / page figures.
     folders, files = list_s3_objects(current_path)
+    month_manifest = None
+    if current_path.count('/') == 2:
+        month_manifest = get_month_manifest(s3_client, S3_BUCKET_NAME, current_path)
 
     st.markdown(f"### 📁 Current Path: {current_path}")
     st.info(f"🔍 Found {len(folders)} folder(s) in {current_path}")
 
+    # The listing is kept for ARCHIVE_TREE_TTL seconds; uploads by the sections refresh it on their own.
+    if st.button("🔄 Refresh"):
+        invalidate_archive_prefix(f"{archive_type}/")
+        st.rerun()
+
     # 🔍 Search Bar for folders
     search_query = st.text_input("🔎 Search folders", "").strip().lower()
 
@@ -124,70 +288,75 @@ def run_archive_section():
 
     for folder in sorted(filtered_folders):
         folder_name = Path(folder.rstrip('/')).name
-        folder_size = get_folder_size_cached(folder)
-        readable_size = get_readable_file_size(folder_size)
+        unit_entry = month_manifest["units"].get(folder_name) if month_manifest is not None else None
+        readable_size = get_readable_file_size(get_folder_size(folder))
 
         col1, col2, col3 = st.columns([7, 2, 1])
         with col1:
             if st.button(f"📁 {folder_name}", key=folder):
                 st.session_state.s3_path = folder
                 st.rerun()
+            if unit_entry is not None:
+                st.caption(
+                    f"✅ {unit_entry.get('matched', 0)} matched · ❌ {unit_entry.get('unmatched', 0)} unmatched"
+                    f" · 📄 {unit_entry.get('pages', 0)} pages"
+                )
 
         with col2:
-            zip_buffer = download_folder_zip(s3_client, folder)
-            st.download_button(
-                label=f"⬇️ {readable_size}",
-                data=zip_buffer,
-                file_name=f"{folder_name}.zip",
-                mime="application/zip",
-                key=folder + "_zip"
-            )
+            # The folder ZIP is only built when asked for, and offered while the folder is unchanged.
+            # The file is read only when the download is clicked, not on every rerun.
+            zip_path = None
+            zip_key = st.session_state.folder_zips.get(folder)
+            if zip_key is not None and zip_key == objects_zip_key(list_folder_objects(s3_client, folder)):
+                zip_path = prepared_zip_path(zip_key)
+            if zip_path is None and st.button(f"📦 {readable_size}", key=folder + "_prepare", help="Prepare ZIP download"):
+                entries = list_folder_objects(s3_client, folder)
+                with st.spinner(f"Preparing {folder_name}.zip ..."):
+                    zip_path = build_objects_zip(s3_client, entries)
+                st.session_state.folder_zips[folder] = objects_zip_key(entries)
+            if zip_path is not None:
+                st.download_button(
+                    label=f"⬇️ {readable_size}",
+                    data=deferred_file(zip_path),
+                    file_name=f"{folder_name}.zip",
+                    mime="application/zip",
+                    key=folder + "_zip"
+                )
 
         with col3:
             if st.checkbox("", key=folder + "_check"):
                 selected_folders.append(folder)
 
-    # 📄 Display Files
+    # 📄 Display Files (from the listing only: the browser downloads them from S3 directly)
     for file in sorted(files, key=lambda x: x['Name']):
         file_size = get_readable_file_size(file['Size'])
-        obj_data = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=file['Key'])
-        file_bytes = obj_data['Body'].read()
 
         col1, col2 = st.columns([9, 1])
         with col1:
-            st.download_button(
-                label=f"📄 {file['Name']} ({file_size})",
-                data=file_bytes,
-                file_name=file['Name'],
-                mime="application/octet-stream",
-                key=file['Key']
+            st.link_button(
+                f"📄 {file['Name']} ({file_size})",
+                presigned_download_url(s3_client, file['Key'], file['Name'])
             )
         with col2:
             if st.checkbox("", key=file['Key'] + "_check"):
-                selected_files.append({
-                    'Key': file['Key'],
-                    'Name': file['Name'],
-                    'Bytes': file_bytes
-                })
+                selected_files.append(file)
 
 
     if selected_folders or selected_files:
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for folder in selected_folders:
-                for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=S3_BUCKET_NAME, Prefix=folder):
-                    for obj in page.get('Contents', []):
-                        key = obj['Key']
-                        obj_data = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
-                        file_bytes = obj_data['Body'].read()
-                        filename = key[len(folder):]
-                        zipf.writestr(f"{Path(folder).name}/{filename}", file_bytes)
-            for file in selected_files:
-                zipf.writestr(file['Name'], file['Bytes'])
-        zip_buffer.seek(0)
-        st.download_button(
-            label="📦 Download Selected as ZIP",
-            data=zip_buffer,
-            file_name="selected_items.zip",
-            mime="application/zip"
-        )
+        # Only a combined ZIP passes the files through this server, and only once asked for.
+        entries = selected_entries(s3_client, selected_folders, selected_files)
+        zip_key = objects_zip_key(entries)
+        zip_path = prepared_zip_path(zip_key) if st.session_state.get("selected_zip") == zip_key else None
+        if zip_path is None and st.button("📦 Prepare Selected as ZIP"):
+            with st.spinner("Preparing selected_items.zip ..."):
+                zip_path = build_objects_zip(s3_client, entries)
+            st.session_state.selected_zip = zip_key
+        if zip_path is not None:
+            st.download_button(
+                label="📦 Download Selected as ZIP",
+                data=deferred_file(zip_path),
+                file_name="selected_items.zip",
+                mime="application/zip"
+            )
+
+    st.caption(describe_object_cache_stats(object_cache_stats()))
@@ -0,0 +1,198 @@
+import sqlite3
+import threading
+from pathlib import PurePosixPath
+
+# Search index over every archived S3 key, kept in an in-memory SQLite database shared by every
+# session of this process. archive_tree feeds it: each listing (a whole root, or one prefix
+# listed again after an upload) replaces the index rows under that prefix.
+#
+# Keys are matched by substring, case-insensitively. With SQLite's FTS5 trigram tokenizer
+# (SQLite 3.34+) terms of 3+ characters are answered from the full-text index; shorter terms,
+# and every term on older SQLite builds, fall back to LIKE over the sorted key table.
+#
+# A second table maps employee identifiers (UAN, ESINO, bank account) to the pages of the
+# archived unit PDFs they appear on; it is fed from the month manifests (see manifest.py).
+ARCHIVE_SECTIONS = ["Bank", "PF", "ESIC"]
+DEFAULT_PAGE_SIZE = 50
+
+_db = None
+_db_fts = False
+_db_lock = threading.Lock()
+
+
+def _connect():
+    """The process-wide index database (created on first use)."""
+    global _db, _db_fts
+    if _db is None:
+        db = sqlite3.connect(":memory:", check_same_thread=False)
+        db.execute(
+            """
+            CREATE TABLE objects (
+                bucket TEXT NOT NULL, key TEXT NOT NULL,
+                section TEXT, month TEXT, unit TEXT, name TEXT, ext TEXT,
+                size INTEGER, last_modified TEXT,
+                UNIQUE (bucket, key)
+            )
+            """
+        )
+        db.execute(
+            """
+            CREATE TABLE identifiers (
+                bucket TEXT NOT NULL, month_prefix TEXT NOT NULL, identifier TEXT NOT NULL,
+                section TEXT, month TEXT, unit TEXT, pdf_key TEXT, pdf_sha256 TEXT, pages TEXT
+            )
+            """
+        )
+        db.execute("CREATE INDEX identifiers_by_id ON identifiers (identifier)")
+        db.execute("CREATE INDEX identifiers_by_month ON identifiers (bucket, month_prefix)")
+        try:
+            db.execute("CREATE VIRTUAL TABLE objects_fts USING fts5(key, tokenize='trigram')")
+            _db_fts = True
+        except sqlite3.OperationalError:
+            _db_fts = False
+        _db = db
+    return _db
+
+
+def _key_fields(key):
+    """(section, month, unit, name, ext) of an archive key "<section>/<month>/<unit>/.../<name>"."""
+    parts = key.split('/')
+    section = parts[0]
+    month = parts[1] if len(parts) > 2 else ""
+    unit = parts[2] if len(parts) > 3 else ""
+    name = parts[-1]
+    return section, month, unit, name, PurePosixPath(name).suffix.lower().lstrip('.')
+
+
+def _prefix_range(prefix):
+    """Key range [low, high) of every key starting with prefix (keys sort as text)."""
+    return prefix, prefix + "\U0010ffff"
+
+
+def index_objects(bucket, prefix, objects):
+    """
+    Replaces the index rows of every key under prefix by objects (listing entries with
+    Key, Size and LastModified), e.g. after prefix was listed again.
+    """
+    low, high = _prefix_range(prefix)
+    rows = [
+        (bucket, obj['Key'], *_key_fields(obj['Key']), obj['Size'], obj['LastModified'].isoformat())
+        for obj in objects
+    ]
+    with _db_lock:
+        db = _connect()
+        with db:
+            if _db_fts:
+                db.execute(
+                    "DELETE FROM objects_fts WHERE rowid IN "
+                    "(SELECT rowid FROM objects WHERE bucket = ? AND key >= ? AND key < ?)",
+                    (bucket, low, high)
+                )
+            db.execute("DELETE FROM objects WHERE bucket = ? AND key >= ? AND key < ?", (bucket, low, high))
+            db.executemany(
+                "INSERT INTO objects "
+                "(bucket, key, section, month, unit, name, ext, size, last_modified) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            if _db_fts:
+                db.execute(
+                    "INSERT INTO objects_fts (rowid, key) "
+                    "SELECT rowid, key FROM objects WHERE bucket = ? AND key >= ? AND key < ?",
+                    (bucket, low, high)
+                )
+
+
+def _like_pattern(term):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def search_archive(bucket, query, sections=None, page=0, page_size=DEFAULT_PAGE_SIZE, exclude_names=()):
+    """
+    Archived objects whose key contains every whitespace-separated term of query (unit names,
+    months, file types, ...), case-insensitively, sorted by key.
+    sections limits the search to some archive roots ("PF", ...); page counts from 0.
+
+    Returns (total matches, [ {Key, Size, Name, Section, Month, Unit, LastModified} ] of the page).
+    """
+    terms = query.lower().split()
+    if not terms:
+        return 0, []
+    where = ["o.bucket = ?"]
+    params = [bucket]
+    with _db_lock:
+        db = _connect()
+        fts_terms = [term for term in terms if len(term) >= 3] if _db_fts else []
+        if fts_terms:
+            where.append("o.rowid IN (SELECT rowid FROM objects_fts WHERE objects_fts MATCH ?)")
+            params.append(" AND ".join('"' + term.replace('"', '""') + '"' for term in fts_terms))
+        for term in terms:
+            if term not in fts_terms:
+                where.append("lower(o.key) LIKE ? ESCAPE '\\'")
+                params.append(_like_pattern(term))
+        if sections:
+            where.append(f"o.section IN ({', '.join('?' * len(sections))})")
+            params.extend(sections)
+        if exclude_names:
+            where.append(f"o.name NOT IN ({', '.join('?' * len(exclude_names))})")
+            params.extend(exclude_names)
+        condition = " AND ".join(where)
+
+        total = db.execute(f"SELECT count(*) FROM objects o WHERE {condition}", params).fetchone()[0]
+        rows = db.execute(
+            f"SELECT o.key, o.size, o.name, o.section, o.month, o.unit, o.last_modified "
+            f"FROM objects o WHERE {condition} ORDER BY o.key LIMIT ? OFFSET ?",
+            params + [page_size, page * page_size]
+        ).fetchall()
+    return total, [
+        {'Key': key, 'Size': size, 'Name': name, 'Section': section, 'Month': month, 'Unit': unit,
+         'LastModified': last_modified}
+        for key, size, name, section, month, unit, last_modified in rows
+    ]
+
+
+def index_manifest(bucket, month_prefix, manifest):
+    """
+    Replaces the identifier rows of a month by those of its manifest (None: the month has no
+    manifest, so it has no rows). Units without a PDF or identifier pages are skipped.
+    """
+    rows = []
+    for unit, entry in (manifest or {}).get("units", {}).items():
+        pdf_file = entry.get("files", {}).get(entry.get("pdf", ""))
+        if pdf_file is None:
+            continue
+        section, month = month_prefix.rstrip('/').split('/')[:2]
+        for identifier, pages in entry.get("ids", {}).items():
+            rows.append((
+                bucket, month_prefix, identifier, section, month, unit,
+                pdf_file["key"], pdf_file["sha256"], ",".join(str(page) for page in pages)
+            ))
+    with _db_lock:
+        db = _connect()
+        with db:
+            db.execute("DELETE FROM identifiers WHERE bucket = ? AND month_prefix = ?", (bucket, month_prefix))
+            db.executemany(
+                "INSERT INTO identifiers "
+                "(bucket, month_prefix, identifier, section, month, unit, pdf_key, pdf_sha256, pages) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+
+def find_identifier(bucket, identifier):
+    """
+    Every archived statement page of an identifier, by section and PDF key:
+        [ {Section, Month, Unit, Key (unit PDF), Sha256, Pages (numbers from 1)} ]
+    """
+    with _db_lock:
+        rows = _connect().execute(
+            "SELECT section, month, unit, pdf_key, pdf_sha256, pages FROM identifiers "
+            "WHERE bucket = ? AND identifier = ? ORDER BY section, pdf_key",
+            (bucket, identifier.strip())
+        ).fetchall()
+    return [
+        {'Section': section, 'Month': month, 'Unit': unit, 'Key': pdf_key, 'Sha256': pdf_sha256,
+         'Pages': [int(page) for page in pages.split(",")]}
+        for section, month, unit, pdf_key, pdf_sha256, pages in rows
+    ]
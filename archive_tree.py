@@ -0,0 +1,254 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from archive_index import index_manifest, index_objects
+from disk_cache import env_seconds
+from manifest import read_manifest
+
+# Prefix tree of the Archive (.env file):
+#   ARCHIVE_TREE_TTL   seconds a listed archive root (Bank/, PF/, ESIC/) is reused (default 300)
+DEFAULT_ARCHIVE_TREE_TTL = 300
+
+# (bucket, root) -> {"node": tree of the root, "built": time.monotonic() (None: list again),
+#                    "stale": {prefix to relist: generation of its latest invalidation},
+#                    "expirations": times the whole root was invalidated}
+# Shared by every session of this process. A published node is never changed afterwards: a
+# relisted prefix gets new copies of the nodes on its path (copy-on-write) and the entry's
+# "node" is swapped, so callers can walk the tree they got without holding any lock.
+# _trees_lock only guards these dicts; listings run under the root's own build lock, so a
+# slow listing of one root blocks neither other roots nor readers of the current tree.
+_trees = {}
+_trees_lock = threading.Lock()
+_build_locks = {}
+# Generations of prefix invalidations: a prefix is only cleared from "stale" by a relist that
+# started after its latest invalidation.
+_generations = itertools.count(1)
+# (bucket, month prefix) -> (time.monotonic() when read, manifest or None)
+_manifests = {}
+
+
+def archive_tree_ttl():
+    """Seconds a listed archive root is reused before it is listed again."""
+    ttl = env_seconds("ARCHIVE_TREE_TTL", DEFAULT_ARCHIVE_TREE_TTL)
+    return ttl if ttl > 0 else DEFAULT_ARCHIVE_TREE_TTL
+
+
+def _new_node():
+    return {"objects": 0, "bytes": 0, "last_modified": None, "folders": {}, "files": {}}
+
+
+def _aggregate(node):
+    """Recomputes a node's totals from its files and (already up to date) sub-folders."""
+    node["objects"] = len(node["files"])
+    node["bytes"] = sum(obj["Size"] for obj in node["files"].values())
+    times = [obj["LastModified"] for obj in node["files"].values()]
+    for child in node["folders"].values():
+        node["objects"] += child["objects"]
+        node["bytes"] += child["bytes"]
+        if child["last_modified"] is not None:
+            times.append(child["last_modified"])
+    node["last_modified"] = max(times) if times else None
+
+
+def _aggregate_all(node):
+    for child in node["folders"].values():
+        _aggregate_all(child)
+    _aggregate(node)
+
+
+def _list_subtree(s3_client, bucket, prefix):
+    """
+    Lists everything under prefix in one paginated sweep (no delimiter) and returns it as a tree.
+    Folder placeholder keys ("a/b/") create their folders but are not counted as objects.
+    """
+    tree = _new_node()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            parts = obj['Key'][len(prefix):].split('/')
+            node = tree
+            for part in parts[:-1]:
+                node = node["folders"].setdefault(part, _new_node())
+            if parts[-1]:
+                node["files"][parts[-1]] = {
+                    'Key': obj['Key'],
+                    'Size': obj['Size'],
+                    'Name': parts[-1],
+                    'ETag': obj.get('ETag', ''),
+                    'LastModified': obj['LastModified'],
+                }
+    _aggregate_all(tree)
+    return tree
+
+
+def _copy_node(node):
+    """Shallow copy of a node whose folders can be replaced without touching the original."""
+    return {**node, "folders": dict(node["folders"])}
+
+
+def _relist(s3_client, bucket, root_node, root, prefix):
+    """
+    Returns a new root node where the subtree of prefix (below root) is a fresh listing.
+    root_node and its sub-nodes are left unchanged: the nodes on the path are copied.
+    """
+    parts = prefix[len(root):].rstrip('/').split('/')
+    path = [_copy_node(root_node)]
+    for part in parts[:-1]:
+        child = _copy_node(path[-1]["folders"].get(part) or _new_node())
+        path[-1]["folders"][part] = child
+        path.append(child)
+    subtree = _list_subtree(s3_client, bucket, prefix)
+    index_objects(bucket, prefix, [obj for _, obj in iter_folder_files(subtree)])
+    if subtree["objects"] or subtree["folders"]:
+        path[-1]["folders"][parts[-1]] = subtree
+    else:
+        path[-1]["folders"].pop(parts[-1], None)
+    for node in reversed(path):
+        _aggregate(node)
+    return path[0]
+
+
+def archive_root(prefix):
+    """Archive root ("PF/", "ESIC/", "Bank/") of a prefix."""
+    return prefix.split('/', 1)[0] + '/'
+
+
+def get_folder_node(s3_client, bucket, prefix):
+    """
+    Node of the folder prefix ("PF/" or "PF/March-2025/..."):
+        { "objects": count, "bytes": total size, "last_modified": newest object (or None),
+          "folders": { name: node }, "files": { name: {Key, Size, Name, ETag, LastModified} } }
+    (objects, bytes and last_modified cover the whole subtree). An unknown folder is empty.
+
+    Each archive root is listed once, recursively, and kept for ARCHIVE_TREE_TTL seconds.
+    Prefixes invalidated in between (invalidate_archive_prefix) are listed again on their own.
+    Every listing also refreshes the search index (archive_index) under its prefix.
+    The node returned is a snapshot: it is never changed later, and must not be changed.
+    """
+    root = archive_root(prefix)
+    node = _root_node(s3_client, bucket, root)
+    for part in prefix[len(root):].rstrip('/').split('/') if prefix != root else []:
+        node = node["folders"].get(part)
+        if node is None:
+            return _new_node()
+    return node
+
+
+def _is_expired(entry):
+    return entry["built"] is None or time.monotonic() - entry["built"] > archive_tree_ttl()
+
+
+def _is_current(entry):
+    return entry["node"] is not None and not entry["stale"] and not _is_expired(entry)
+
+
+def _root_node(s3_client, bucket, root):
+    """Current tree of an archive root, listed (or partly relisted) first when needed."""
+    key = (bucket, root)
+    with _trees_lock:
+        entry = _trees.setdefault(key, {"node": None, "built": None, "stale": {}, "expirations": 0})
+        if _is_current(entry):
+            return entry["node"]
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+
+    with build_lock:
+        with _trees_lock:
+            if _is_current(entry):
+                # Brought up to date by another session while this one waited.
+                return entry["node"]
+            expirations = entry["expirations"]
+            full = entry["node"] is None or _is_expired(entry)
+            node = entry["node"]
+            stale = dict(entry["stale"])
+            started = time.monotonic()
+        if full:
+            node = _list_subtree(s3_client, bucket, root)
+            index_objects(bucket, root, [obj for _, obj in iter_folder_files(node)])
+        else:
+            for stale_prefix in sorted(stale):
+                node = _relist(s3_client, bucket, node, root, stale_prefix)
+        with _trees_lock:
+            entry["node"] = node
+            # Prefixes (or the root) invalidated during the listing may be missing from it:
+            # their generation changed, so they stay stale for the next access.
+            for stale_prefix, generation in stale.items():
+                if entry["stale"].get(stale_prefix) == generation:
+                    del entry["stale"][stale_prefix]
+            if full:
+                entry["built"] = started if entry["expirations"] == expirations else None
+        return node
+
+
+def get_month_manifest(s3_client, bucket, month_prefix):
+    """
+    Manifest of a month folder (see manifest.py), or None when the month has none.
+    Kept like the tree: for ARCHIVE_TREE_TTL seconds, or until the month is invalidated.
+    Every manifest read also refreshes the month's rows of the identifier index.
+    """
+    with _trees_lock:
+        cached = _manifests.get((bucket, month_prefix))
+        if cached is not None and time.monotonic() - cached[0] <= archive_tree_ttl():
+            return cached[1]
+    manifest = read_manifest(s3_client, bucket, month_prefix)
+    index_manifest(bucket, month_prefix, manifest)
+    with _trees_lock:
+        _manifests[(bucket, month_prefix)] = (time.monotonic(), manifest)
+    return manifest
+
+
+def load_month_manifests(s3_client, bucket, roots, workers=8):
+    """
+    Reads (or reuses) the manifest of every month folder of the roots, a few at a time,
+    so the identifier index covers the whole archive.
+    """
+    month_prefixes = []
+    for root in roots:
+        month_prefixes.extend(list_folder(s3_client, bucket, root)[0])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda month_prefix: get_month_manifest(s3_client, bucket, month_prefix), month_prefixes))
+
+
+def refresh_archive_roots(s3_client, bucket, roots):
+    """Brings the trees (and so the search index) of several archive roots up to date."""
+    for root in roots:
+        get_folder_node(s3_client, bucket, root)
+
+
+def list_folder(s3_client, bucket, prefix):
+    """Sub-folder prefixes and files directly in the folder prefix, from the archive tree."""
+    node = get_folder_node(s3_client, bucket, prefix)
+    folders = [f"{prefix}{name}/" for name in node["folders"]]
+    return folders, list(node["files"].values())
+
+
+def iter_folder_files(node):
+    """(path inside the folder, file) of every file in a folder node and its sub-folders."""
+    for name, obj in node["files"].items():
+        yield name, obj
+    for folder_name, child in node["folders"].items():
+        for name, obj in iter_folder_files(child):
+            yield f"{folder_name}/{name}", obj
+
+
+def invalidate_archive_prefix(prefix):
+    """
+    Marks a prefix as changed (e.g. a section just uploaded a month's outputs) in every bucket:
+    it is listed again on the next access, without relisting the rest of its root, and the
+    manifests of the months it covers are read again.
+    Invalidating a whole root ("PF/") drops it, so it is listed again in full.
+    """
+    root = archive_root(prefix)
+    with _trees_lock:
+        for bucket, month_prefix in list(_manifests):
+            if month_prefix.startswith(prefix) or prefix.startswith(month_prefix):
+                del _manifests[(bucket, month_prefix)]
+        for (bucket, tree_root), entry in _trees.items():
+            if tree_root != root:
+                continue
+            if prefix == root:
+                entry["built"] = None
+                entry["expirations"] += 1
+            else:
+                entry["stale"][prefix] = next(_generations)
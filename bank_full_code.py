@@ -1,19 +1,292 @@
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from metrics import start_metrics, stage, count, add_time, merge_metrics, finish_metrics
+from page_plan import scan_pdf, has_roster_hits, render_unit_pdfs, identifier_pages
+from pdf_marks import draw_marks, OUTPUT_ANNOTATIONS, OUTPUT_FLATTENED
+
+# Define constant for "Highlight Relevant"
+HIGHLIGHT_RELEVANT = "Highlight Relevant"
+
+# Execution engines for Bank processing (BANK_EXECUTOR in the .env file).
+EXECUTOR_PROCESS = "process"
+EXECUTOR_THREAD = "thread"
+
+# Words whose top edges lie within this many points of a row's first word share that row.
+ROW_TOLERANCE = 10
+
+# Row kinds stored in the row table.
+ROW_MAIN = 0
+ROW_HEADER = 1
+ROW_FOOTER = 2
+
+
+def build_row_table(words, page_height, page_index):
+    """
+    Groups the words of one page into rows in a single pass.
+    Words are sorted by their top edge once; a new row starts whenever a word lies
+    ROW_TOLERANCE or more below the first word of the current row. Row ids follow
+    top-to-bottom order, so they are stable for a given page.
+
+    Returns a dict of NumPy arrays:
+        word_row         -> row id of every word (same order as `words`)
+        x0, y0, x1, y1   -> bounding box of every row
+        kind             -> ROW_HEADER, ROW_FOOTER or ROW_MAIN for every row
+    """
+    n_words = len(words)
+    word_row = np.zeros(n_words, dtype=np.int32)
+    if n_words == 0:
+        empty = np.zeros(0, dtype=np.float64)
+        return {
+            "word_row": word_row,
+            "x0": empty, "y0": empty, "x1": empty, "y1": empty,
+            "kind": np.zeros(0, dtype=np.int8),
+        }
+
+    coords = np.array([w[:4] for w in words], dtype=np.float64)
+    order = np.argsort(coords[:, 1], kind="stable")
+
+    # Assign row ids walking the words top to bottom.
+    row_id = 0
+    row_top = coords[order[0], 1]
+    for idx in order:
+        if coords[idx, 1] - row_top >= ROW_TOLERANCE:
+            row_id += 1
+            row_top = coords[idx, 1]
+        word_row[idx] = row_id
+    n_rows = row_id + 1
+
+    x0 = np.full(n_rows, np.inf)
+    y0 = np.full(n_rows, np.inf)
+    x1 = np.full(n_rows, -np.inf)
+    y1 = np.full(n_rows, -np.inf)
+    np.minimum.at(x0, word_row, coords[:, 0])
+    np.minimum.at(y0, word_row, coords[:, 1])
+    np.maximum.at(x1, word_row, coords[:, 2])
+    np.maximum.at(y1, word_row, coords[:, 3])
+
+    # Classify rows as header (top), footer (bottom) or main content.
+    header_threshold = page_height * (0.30 if page_index == 0 else 0.12)
+    footer_threshold = page_height * 0.95
+    kind = np.full(n_rows, ROW_MAIN, dtype=np.int8)
+    kind[y1 > footer_threshold] = ROW_FOOTER
+    kind[y0 < header_threshold] = ROW_HEADER
+
+    return {"word_row": word_row, "x0": x0, "y0": y0, "x1": x1, "y1": y1, "kind": kind}
+
+
+def mask_non_highlighted_content(row_table, highlighted_rows, marks):
+    """
+    Adds a mask mark for every main content row that is not highlighted (ignoring header and footer rows).
+    Returns the number of mask marks added.
+    """
+    to_mask = (row_table["kind"] == ROW_MAIN) & ~highlighted_rows
+    mask_count_here = 0
+    for r in np.flatnonzero(to_mask):
+        row_rect = (row_table["x0"][r], row_table["y0"][r], row_table["x1"][r], row_table["y1"][r])
+        marks.append((row_rect, "mask"))  # Gray mask
+        mask_count_here += 1
+    return mask_count_here
+
+
+def highlight_and_mask_pdf_pages(pdf_path, units, bank_index, masking_mode, page_selection_mode, output_mode,
+                                 cancel_flag_path=None, pdf_sha256=None):
+    """
+    Processes one PDF file (supplied as the path of its spooled upload, see upload_spool):
+      - Each page's words are matched once against bank_index (account -> units).
+      - In "Relevant Pages" mode, pages with no match are skipped (except the first and last pages).
+      - Only pages kept by some unit are copied; a PDF without any match is rejected after the scan.
+      - Words on each kept page are grouped into rows once (see build_row_table).
+      - Rows are classified as header (top), footer (bottom), or main content.
+      - Bank account matches and unit names are highlighted.
+      - If masking mode is selected, non-highlighted main content rows are masked.
+      - Marks are drawn as annotations or flattened into the page, per output_mode (see draw_marks).
+
+    Runs in a worker process, so only picklable values go in and out.
+    Returns a tuple:
+       ({ unit: PDF bytes holding that unit's pages in source page order },
+        highlight_count, mask_count, unit_matched_local, metrics, page_ids)
+    The first item is empty when the PDF was rejected. metrics holds this PDF's stage
+    timings and counters, to be merged into the run's (see metrics.merge_metrics).
+    page_ids lists the accounts found on each page of each unit's PDF (see render_unit_pdfs).
+    Once the file cancel_flag_path exists (see jobs.cancel_job) the PDF is dropped at the next
+    page boundary and None is returned; a file works across worker processes, unlike an Event.
+    pdf_sha256 (the spooled upload's hash) keys the PDF's pages in the word cache.
+    """
+    def cancelled():
+        return cancel_flag_path is not None and os.path.exists(cancel_flag_path)
+
+    metrics = start_metrics("Bank")
+    # Opened from disk: pages are read as they are needed, and only the path crosses processes.
+    with stage(metrics, "pdf_open"):
+        doc = fitz.open(pdf_path, filetype="pdf")
+
+    bank_regex = re.compile(r"\b\d+\b")  # Pure digits only
+
+    # Scan phase: words and account matches for every page, and the units keeping each page.
+    # In Relevant Pages mode, pages without a match are skipped except for the first and last pages.
+    page_plans = scan_pdf(
+        doc, units, bank_index, bank_regex, page_selection_mode == "Relevant Pages", metrics=metrics,
+        cancelled=cancelled, doc_sha256=pdf_sha256
+    )
+    if cancelled():
+        doc.close()
+        return None
+    if not has_roster_hits(page_plans):
+        # No account from the roster anywhere in this PDF: nothing is copied.
+        doc.close()
+        return {}, 0, 0, {}, metrics, {}
+
+    counts = {"highlight": 0, "mask": 0}
+    unit_matched_local = {unit: set() for unit in units}
+
+    def draw_page(unit, temp_page, plan):
+        # Build the row layout once per page; every unit keeping the page reuses it.
+        if "rows" not in plan:
+            plan["rows"] = build_row_table(plan["words"], plan["height"], plan["number"])
+        row_table = plan["rows"]
+
+        # Rows holding at least one bank account of this unit.
+        hits = plan["unit_hits"].get(unit, [])
+        highlighted_rows = np.zeros(len(row_table["kind"]), dtype=bool)
+        highlighted_rows[row_table["word_row"][hits]] = True
+        unit_matched_local[unit].update(plan["words"][w_idx][4] for w_idx in hits)
+
+        # Highlight every row that contains a bank account match.
+        marks = []
+        for r in np.flatnonzero(highlighted_rows):
+            row_rect = (row_table["x0"][r], row_table["y0"][r], row_table["x1"][r], row_table["y1"][r])
+            marks.append((row_rect, "highlight"))  # Yellow highlight
+
+        # Optionally highlight the unit name itself.
+        unit_rects = temp_page.search_for(unit)
+        for rect in unit_rects:
+            marks.append((rect, "unit_name"))
+
+        # If "Mask all not relevant" is chosen, mask all main content rows that are not highlighted.
+        if masking_mode == "Mask all not relevant":
+            mask_non_highlighted_content(row_table, highlighted_rows, marks)
+        elif masking_mode == HIGHLIGHT_RELEVANT:
+            # In Highlight Relevant mode, no additional masking is applied.
+            pass
+
+        drawn = draw_marks(temp_page, marks, output_mode)
+        counts["highlight"] += drawn.get("highlight", 0) + drawn.get("unit_name", 0)
+        counts["mask"] += drawn.get("mask", 0)
+        count(metrics, "marks", sum(drawn.values()))
+
+    # Render phase: only the selected pages are copied, straight into each unit's document.
+    page_ids = {}
+    unit_docs = render_unit_pdfs(
+        doc, page_plans, draw_page, metrics=metrics, page_ids=page_ids, cancelled=cancelled
+    )
+    doc.close()
+    if cancelled():
+        for unit_doc in unit_docs.values():
+            unit_doc.close()
+        return None
+    # Serialize each unit's pages so the result can travel back from a worker process.
+    result = {}
+    for unit, unit_doc in unit_docs.items():
+        with stage(metrics, "pdf_write"):
+            result[unit] = unit_doc.write()
+        unit_doc.close()
+    return result, counts["highlight"], counts["mask"], unit_matched_local, metrics, page_ids
+
+
+# ----------------------- Worker Pool -----------------------
+# One executor per Streamlit server process, shared by every session and rerun, so worker
+# processes stay warm (PyMuPDF already imported) between Generate clicks.
+_executor = None
+_executor_key = None
+_executor_lock = threading.Lock()
+
+
+def _warm_worker():
+    """Process-pool initializer: touches PyMuPDF once so the first task doesn't pay for it."""
+    fitz.open().close()
+
+
+def bank_executor_settings():
+    """
+    Reads the execution engine and worker count from the environment:
+      - BANK_EXECUTOR: "process" (default) or "thread"
+      - BANK_WORKERS:  number of workers; unset or 0 auto-detects the usable CPU count
+    """
+    engine = os.getenv("BANK_EXECUTOR", EXECUTOR_PROCESS).strip().lower()
+    if engine not in (EXECUTOR_PROCESS, EXECUTOR_THREAD):
+        engine = EXECUTOR_PROCESS
+    try:
+        workers = int(os.getenv("BANK_WORKERS", "0"))
+    except ValueError:
+        workers = 0
+    if workers <= 0:
+        if hasattr(os, "sched_getaffinity"):
+            workers = len(os.sched_getaffinity(0))
+        else:
+            workers = os.cpu_count() or 1
+    return engine, workers
+
+
+def get_bank_executor(engine, workers):
+    """
+    Returns the shared executor for (engine, workers), creating it on first use.
+    A pool with different settings, or one whose workers died, is replaced.
+    """
+    global _executor, _executor_key
+    with _executor_lock:
+        key = (engine, workers)
+        broken = getattr(_executor, "_broken", False)
+        if _executor is not None and _executor_key == key and not broken:
+            return _executor
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        if engine == EXECUTOR_PROCESS:
+            # "spawn" keeps workers clear of the Streamlit server's threads and locks.
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_worker,
+            )
+        else:
+            _executor = ThreadPoolExecutor(max_workers=workers)
+        _executor_key = key
+        return _executor
+
+
+
 def run_bank_section():
     import streamlit as st
-    import pandas as pd
-    import fitz  # PyMuPDF
-    import re
-    import io
-    import os
-    import zipfile
-    import numpy as np  # For integer conversion
     import time  # For timing
-    from concurrent.futures import ThreadPoolExecutor, as_completed
-    import boto3
+    from concurrent.futures import wait, FIRST_COMPLETED
     from botocore.exceptions import NoCredentialsError
     import datetime
-    import hashlib  # for duplicate-file checking
+    import functools
     from dotenv import load_dotenv
+    from id_index import build_id_index
+    from roster import read_roster, build_unit_mapping
+    from reports import iter_unit_reports, matched_flags, unit_match_counts
+    from disk_cache import cache_key, content_hash, cache_get, cache_rename, result_cache_max_bytes
+    from output_zip import (
+        start_output_zip, add_unit_files, read_output_file, finish_output_zip, close_output_reader,
+        discard_output_zip
+    )
+    from archive_tree import invalidate_archive_prefix
+    from manifest import start_manifest, add_manifest_unit, write_manifest
+    from s3_upload import start_uploads, submit_upload, cancel_uploads, finish_uploads, describe_upload_stats
+    from checkpoints import open_checkpoints, load_checkpoint, save_checkpoint, clear_checkpoints
+    from jobs import submit_job, is_job_active, session_job_id, remember_job, show_job, poll_job, deferred_file
+    from upload_spool import spool_uploads
+    from unit_parts import (
+        start_unit_parts, add_unit_parts, unit_parts_over_budget, finish_unit_parts, merge_unit_parts,
+        discard_unit_parts
+    )
  
     # Load AWS credentials from the .env file
     load_dotenv()
@@ -22,146 +295,6 @@ def run_bank_section():
     S3_BUCKET_NAME = "sanj0908"
     S3_FOLDER = "Bank/"  # Optional folder inside the bucket
  
-    # Read-only annotation flag (prevents moving/editing in most PDF viewers)
-    ANNOT_FLAG_READONLY = 64
- 
-    # Define constant for "Highlight Relevant"
-    HIGHLIGHT_RELEVANT = "Highlight Relevant"
- 
-    # ----------------------- Helper Functions -----------------------
-    def mask_non_highlighted_content(page, highlight_rects, all_rows, header_rows, footer_rows):
-        """
-        Masks all main content rows that are not highlighted (ignoring header and footer rows).
-        Returns the number of mask annotations added.
-        """
-        mask_count_here = 0
-        for row in all_rows:
-            if row not in highlight_rects and row not in header_rows and row not in footer_rows:
-                mask_annot = page.add_rect_annot(row)
-                mask_annot.set_colors(stroke=(0.5, 0.5, 0.5), fill=(0.5, 0.5, 0.5))  # Gray mask
-                mask_annot.set_border(width=1)
-                mask_annot.set_opacity(1.0)
-                mask_annot.set_flags(ANNOT_FLAG_READONLY)
-                mask_annot.update()
-                mask_count_here += 1
-        return mask_count_here
- 
-    def highlight_and_mask_pdf_pages(pdf_bytes, unit_bank_dict, masking_mode, page_selection_mode):
-        """
-        Processes one PDF file (supplied as bytes):
-          - In "Relevant Pages" mode, pages with no match are skipped (except the first and last pages).
-          - Each page is processed by grouping words into rows.
-          - Rows are classified as header (top), footer (bottom), or main content.
-          - Bank account matches and unit names are highlighted.
-          - If masking mode is selected, non-highlighted main content rows are masked.
- 
-        Returns a tuple:
-           ({ unit: [list of 1-page docs with modifications] },
-            highlight_count, mask_count, unit_matched_local)
-        """
-        # Convert bytes back into a file-like object for PyMuPDF
-        pdf_file = io.BytesIO(pdf_bytes)
-        doc = fitz.open(stream=pdf_file.read(), filetype="pdf")
- 
-        bank_regex = re.compile(r"\b\d+\b")  # Pure digits only
-        total_pages = doc.page_count
- 
-        local_highlight_count = 0
-        local_mask_count = 0
- 
-        # Prepare a list (one entry per page) per unit.
-        unit_pages = {unit: [None] * total_pages for unit in unit_bank_dict.keys()}
-        unit_matched_local = {unit: set() for unit in unit_bank_dict.keys()}
- 
-        for i in range(total_pages):
-            page = doc[i]
-            words = page.get_text("words")
- 
-            for unit, bank_acc_list in unit_bank_dict.items():
-                # Check if page has any bank account match.
-                has_match = any(
-                    bank_regex.fullmatch(w[4]) and w[4] in bank_acc_list
-                    for w in words
-                )
-                # In Relevant Pages mode, skip pages without a match except for the first and last pages.
-                if page_selection_mode == "Relevant Pages" and not has_match and i not in (0, total_pages - 1):
-                    continue
- 
-                # Create a temporary PDF for this page.
-                temp_doc = fitz.open()
-                temp_doc.insert_pdf(doc, from_page=i, to_page=i)
-                temp_page = temp_doc[0]
- 
-                # Define thresholds for header and footer.
-                header_threshold = temp_page.rect.height * (0.30 if i == 0 else 0.12)
-                footer_threshold = temp_page.rect.height * 0.95
- 
-                all_rows = set()
-                header_rows = set()
-                footer_rows = set()
-                highlight_rects = []
- 
-                for w in words:
-                    word_text = w[4]
-                    # Group words by similar y-coordinate to define a row.
-                    row_words = [w] + [tw for tw in words if abs(tw[1] - w[1]) < 10]
-                    x0 = min(rw[0] for rw in row_words)
-                    y0 = min(rw[1] for rw in row_words)
-                    x1 = max(rw[2] for rw in row_words)
-                    y1 = max(rw[3] for rw in row_words)
-                    row_rect = fitz.Rect(x0, y0, x1, y1)
- 
-                    # Classify the row as header, footer, or main content.
-                    if y0 < header_threshold:
-                        header_rows.add(row_rect)
-                    elif y1 > footer_threshold:
-                        footer_rows.add(row_rect)
-                    else:
-                        all_rows.add(row_rect)
- 
-                    # If the word is a bank account match, highlight that row.
-                    if bank_regex.fullmatch(word_text) and word_text in bank_acc_list:
-                        highlight_rects.append(row_rect)
-                        annot = temp_page.add_rect_annot(row_rect)
-                        annot.set_colors(stroke=(1, 1, 0), fill=(1, 1, 0))  # Yellow highlight
-                        annot.set_border(width=1)
-                        annot.set_opacity(0.3)
-                        annot.set_flags(ANNOT_FLAG_READONLY)
-                        annot.update()
-                        unit_matched_local[unit].add(word_text)
-                        local_highlight_count += 1
- 
-                # Optionally highlight the unit name itself.
-                unit_rects = temp_page.search_for(unit)
-                for rect in unit_rects:
-                    highlight_rects.append(rect)
-                    unit_annot = temp_page.add_rect_annot(rect)
-                    unit_annot.set_colors(stroke=(1, 1, 0), fill=(1, 1, 0))
-                    unit_annot.set_border(width=1)
-                    unit_annot.set_opacity(0.5)
-                    unit_annot.set_flags(ANNOT_FLAG_READONLY)
-                    unit_annot.update()
-                    local_highlight_count += 1
- 
-                # If "Mask all not relevant" is chosen, mask all main content rows that are not highlighted.
-                if masking_mode == "Mask all not relevant":
-                    mask_added = mask_non_highlighted_content(
-                        temp_page, highlight_rects, all_rows, header_rows, footer_rows
-                    )
-                    local_mask_count += mask_added
-                elif masking_mode == HIGHLIGHT_RELEVANT:
-                    # In Highlight Relevant mode, no additional masking is applied.
-                    pass
- 
-                # Store the temporary document in the unit_pages structure.
-                unit_pages[unit][i] = temp_doc
- 
-        doc.close()
-        # Remove None pages.
-        result = {unit: [p for p in pages if p is not None] for unit, pages in unit_pages.items()}
-        result = {unit: docs for unit, docs in result.items() if docs}
-        return result, local_highlight_count, local_mask_count, unit_matched_local
- 
     # ----------------------- Streamlit Layout -----------------------
     st.title("Bank Statement")
  
@@ -174,8 +307,8 @@ def run_bank_section():
     current_month = now.month
     month_names = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
  
-    # Arrange four columns for options.
-    col1, col2, col3, col4 = st.columns(4)
+    # Arrange five columns for options.
+    col1, col2, col3, col4, col5 = st.columns(5)
  
     with col1:
         masking_mode = st.radio(
@@ -192,11 +325,19 @@ def run_bank_section():
         )
  
     with col3:
+        # "Flattened" draws all marks of a page into its content at once: smaller, faster PDFs.
+        output_mode = st.radio(
+            "Select Output Mode:",
+            options=[OUTPUT_ANNOTATIONS, OUTPUT_FLATTENED],
+            index=0
+        )
+ 
+    with col4:
         selected_year = st.number_input(
             "Select Year", min_value=1900, max_value=current_year, step=1, value=current_year
         )
  
-    with col4:
+    with col5:
         if selected_year == current_year:
             allowed_months = month_names[:current_month]
             default_index = current_month - 1  # pre-select current month
@@ -205,107 +346,133 @@ def run_bank_section():
             default_index = 0
         selected_month = st.selectbox("Select Month", allowed_months, index=default_index)
  
-    # --- Step 1 & Step 2: Side-by-Side Columns for File Upload ---
-    col_pdf, col_excel = st.columns(2)
- 
-    with col_pdf:
-        st.header("Upload PDF Files")
-        pdf_files = st.file_uploader(
-            "",
-            type="pdf",
-            accept_multiple_files=True,
-            key="bank_pdf"
-        )
- 
-    with col_excel:
-        st.header("Upload Excel File")
-        excel_file = st.file_uploader(
-            "",
-            type=["xlsx", "xls"],
-            key="bank_excel"
-        )
- 
-    generate_button = st.button("Generate")
- 
-    # Step 4: Processing & Download
-    st.header("Processing & Download")
- 
-    if generate_button:
-        if not (pdf_files and excel_file):
-            st.warning("Please upload at least one PDF and one Excel file to proceed.")
-            st.stop()
- 
-        # --- 1) Check for duplicates among uploaded PDFs ---
-        pdf_file_contents = []
-        pdf_hashes = set()
-        duplicate_found = False
- 
-        for pdf in pdf_files:
-            # Read file bytes for hashing
-            content = pdf.read()
-            file_hash = hashlib.md5(content).hexdigest()
-            if file_hash in pdf_hashes:
-                duplicate_found = True
-                break
-            else:
-                pdf_hashes.add(file_hash)
-                # Store the file name & bytes for further processing
-                pdf_file_contents.append((pdf.name, content))
- 
-        if duplicate_found:
-            st.error("Duplicate PDF file(s) found. Please remove duplicates and try again.")
-            st.stop()
- 
+    # ----------------------- Background Job -----------------------
+    def generate_outputs(ui, pdf_uploads, excel_file, result_key):
+        """
+        Processes the spooled PDF uploads (see upload_spool) against the roster and archives the outputs.
+        Queued by Generate and run by the job worker (jobs.py); ui records for show_job
+        what st would have shown.
+        """
         # --- 2) Load Excel & prepare data ---
         try:
             start_time = time.time()
             highlight_count = 0
             mask_count = 0
+            # Stage timings and counters of this run (shown at the end and written to metrics files).
+            metrics = start_metrics("Bank")
  
             # Read Excel file and build unit-bank dictionary.
-            df = pd.read_excel(excel_file, dtype={'BANK_ACC_NO': str})
-            unit_bank_dict = {}
-            for _, row in df.iterrows():
-                unit = row['UNIT']
-                bank_acc = row['BANK_ACC_NO']
-                unit_bank_dict.setdefault(unit, []).append(bank_acc)
+            with stage(metrics, "excel_load"):
+                df = read_roster(excel_file, dtype={'BANK_ACC_NO': str})
+                unit_bank_dict = build_unit_mapping(df, 'BANK_ACC_NO')
+                # Account number -> unit(s), built once for all PDFs.
+                bank_index = build_id_index(unit_bank_dict)
  
             if not unit_bank_dict:
-                st.error("The Excel file does not contain valid UNIT or BANK_ACC_NO data. (Mismatch file)")
+                ui.error("The Excel file does not contain valid UNIT or BANK_ACC_NO data. (Mismatch file)")
             combined_unit_matched = {unit: set() for unit in unit_bank_dict.keys()}
  
         except Exception as e:
-            st.error("Error reading Excel file. Please check the file and column names.")
-            st.error(e)
-            st.stop()
+            ui.error("Error reading Excel file. Please check the file and column names.")
+            ui.error(e)
+            ui.stop()
  
         # --- 3) Concurrency & Progress ---
-        progress_bar = st.progress(0)
-        progress_text = st.empty()
-        total_pdfs = len(pdf_file_contents)
+        progress_bar = ui.progress(0)
+        progress_text = ui.empty()
+        total_pdfs = len(pdf_uploads)
         completed = 0
  
-        # Dictionary to hold final PDF docs for each unit.
-        all_unit_docs = {u: [] for u in unit_bank_dict.keys()}
- 
-        from concurrent.futures import ThreadPoolExecutor, as_completed
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = []
-            for (pdf_name, pdf_bytes) in pdf_file_contents:
-                futures.append(executor.submit(
-                    highlight_and_mask_pdf_pages,
-                    pdf_bytes,
-                    unit_bank_dict,
-                    masking_mode,
-                    page_selection_mode
-                ))
-            for future in as_completed(futures):
-                pdf_result, local_h_count, local_m_count, unit_matched_pdf = future.result()
-                highlight_count += local_h_count
-                mask_count += local_m_count
-                for unit, doc_list in pdf_result.items():
-                    all_unit_docs[unit].extend(doc_list)
-                for unit, matches in unit_matched_pdf.items():
+        # Unit pages of every PDF, appended in upload order regardless of which worker finishes
+        # first; kept in memory up to OUTPUT_MEMORY_MAX_BYTES and on disk beyond (see unit_parts.py).
+        unit_parts = start_unit_parts(metrics)
+        # Accounts on each page of each PDF's unit parts, in the same order (for the archive manifest).
+        pdf_page_ids = [None] * total_pdfs
+ 
+        # Warm executor shared across reruns (see get_bank_executor).
+        engine, workers = bank_executor_settings()
+        executor = get_bank_executor(engine, workers)
+        units = list(unit_bank_dict.keys())
+        # PDFs finished by an earlier, interrupted run with the same files and options are
+        # loaded from their checkpoints; only the others go to the executor.
+        checkpoints = open_checkpoints(result_key, units)
+        resumed = list(checkpoints["done"])
+        to_submit = [pdf_pos for pdf_pos in range(total_pdfs) if pdf_pos not in checkpoints["done"]]
+        if resumed:
+            ui.info(
+                f"Resuming an interrupted run: {len(resumed)} of {total_pdfs} "
+                f"PDF files were already processed."
+            )
+        # PDF futures not consumed yet (a result is dropped once its part is added).
+        running = {}
+
+        def finished_pdfs():
+            """
+            (upload position, part) of every PDF as it finishes. A checkpointed PDF is loaded once
+            every PDF before it has been submitted, so its part does not wait long in memory.
+            Backpressure: at most two PDFs per worker are submitted and not yet consumed, and no
+            new one is submitted while parts waiting for an earlier PDF exceed the memory budget.
+            PDFs stopped or never started because of a Cancel are left out.
+            """
+            next_submit = 0
+            while True:
+                if ui.cancelled():
+                    # PDFs not started yet are dropped; running ones stop at their next page.
+                    next_submit = len(to_submit)
+                    for pending in running:
+                        pending.cancel()
+                first_open = min([*running.values(), *to_submit[next_submit:next_submit + 1]], default=total_pdfs)
+                while resumed and resumed[0] < first_open:
+                    pdf_pos = resumed.pop(0)
+                    count(metrics, "resumed_pdfs")
+                    yield pdf_pos, load_checkpoint(checkpoints, pdf_pos)
+                while next_submit < len(to_submit) and len(running) < 2 * workers and not (
+                    running and unit_parts_over_budget(unit_parts)
+                ):
+                    future = executor.submit(
+                        highlight_and_mask_pdf_pages,
+                        pdf_uploads[to_submit[next_submit]]["path"],
+                        units,
+                        bank_index,
+                        masking_mode,
+                        page_selection_mode,
+                        output_mode,
+                        ui.cancel_flag_path,
+                        pdf_uploads[to_submit[next_submit]]["sha256"]
+                    )
+                    running[future] = to_submit[next_submit]
+                    next_submit += 1
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=running.get):
+                    pdf_pos = running.pop(future)
+                    if future.cancelled() or future.result() is None:
+                        continue
+                    pdf_result, local_h_count, local_m_count, unit_matched_pdf, pdf_metrics, page_ids = future.result()
+                    merge_metrics(metrics, pdf_metrics)
+                    count(metrics, "pdfs")
+                    part = {
+                        "unit_files": pdf_result,
+                        "page_ids": page_ids,
+                        "matched": unit_matched_pdf,
+                        "counts": {"highlight": local_h_count, "mask": local_m_count},
+                    }
+                    save_checkpoint(checkpoints, pdf_pos, **part)
+                    yield pdf_pos, part
+
+        try:
+            for pdf_pos, part in finished_pdfs():
+                add_unit_parts(unit_parts, pdf_pos, part["unit_files"])
+                pdf_page_ids[pdf_pos] = part["page_ids"]
+                if not part["unit_files"]:
+                    ui.warning(
+                        f"No bank account from the Excel file was found in "
+                        f"{pdf_uploads[pdf_pos]['name']}. File skipped."
+                    )
+                highlight_count += part["counts"]["highlight"]
+                mask_count += part["counts"]["mask"]
+                for unit, matches in part["matched"].items():
                     combined_unit_matched[unit].update(matches)
                 completed += 1
                 progress = completed / total_pdfs
@@ -318,125 +485,230 @@ def run_bank_section():
                     f"Processed {completed}/{total_pdfs} PDFs. "
                     f"{progress*100:.0f}% complete. Estimated time remaining: {remaining:.1f} sec."
                 )
+        except Exception as e:
+            for future in running:
+                future.cancel()
+            discard_unit_parts(unit_parts)
+            ui.error(f"Error while processing PDF files ({engine} engine, {workers} workers): {e}")
+            ui.stop()
+
+        # A cancelled run still delivers the PDFs finished before the Cancel (not archived).
+        run_cancelled = completed < total_pdfs
+        if run_cancelled:
+            pdf_page_ids = [page_ids or {} for page_ids in pdf_page_ids]
+            ui.warning(
+                f"⏹ Run cancelled after {completed} of {total_pdfs} PDF files. The output below only "
+                f"covers those files and is not archived to S3. Press Generate again with the same files "
+                f"and options to process the rest."
+            )
  
-        # --- 4) Build merged PDFs per unit ---
-        unit_pdf_data = {}
-        for unit, doc_list in all_unit_docs.items():
-            # Only merge pages if the doc_list is not empty AND there's at least one match
-            if doc_list and combined_unit_matched[unit]:
-                merged_pdf = fitz.open()
-                for d in doc_list:
-                    merged_pdf.insert_pdf(d)
-                    d.close()
-                pdf_bytes = merged_pdf.write()
-                merged_pdf.close()
-                unit_pdf_data[unit] = pdf_bytes
- 
+        # --- 4) Units with output: pages in at least one PDF AND at least one match ---
+        units_with_pages = set(finish_unit_parts(unit_parts))
+        output_units = [unit for unit in units if combined_unit_matched[unit] and unit in units_with_pages]
+
         # --- 5) Prepare Excel files per unit (Matched / Unmatched) ---
-        unit_excel_data = {}
-        for unit in unit_bank_dict.keys():
-            unit_df = df[df['UNIT'] == unit]
-            matched_df = unit_df[unit_df['BANK_ACC_NO'].isin(combined_unit_matched[unit])]
-            unmatched_df = unit_df[~unit_df['BANK_ACC_NO'].isin(combined_unit_matched[unit])]
- 
-            desired_cols = [
-                "SNO", "EMP CODE", "EMP NAME", "BRANCH", "BRANCH 1",
-                "UNIT", "STATE", "BANK_ACC_NO", "BANKREFNO"
-            ]
- 
-            desired_cols_filtered = [col for col in desired_cols if col in df.columns]
- 
-            matched_df = matched_df[desired_cols_filtered]
-            unmatched_df = unmatched_df[desired_cols_filtered]
- 
-            matched_buffer = io.BytesIO()
-            with pd.ExcelWriter(matched_buffer, engine="xlsxwriter") as writer:
-                matched_df.to_excel(writer, index=False, sheet_name="Matched")
-            matched_bytes = matched_buffer.getvalue()
- 
-            unmatched_buffer = io.BytesIO()
-            with pd.ExcelWriter(unmatched_buffer, engine="xlsxwriter") as writer:
-                unmatched_df.to_excel(writer, index=False, sheet_name="Unmatched")
-            unmatched_bytes = unmatched_buffer.getvalue()
- 
-            unit_excel_data[unit] = (matched_bytes, unmatched_bytes)
- 
+        # Built a few units at a time while the units are written (one pass over the roster).
+        with stage(metrics, "excel_report"):
+            flags = matched_flags(df, 'BANK_ACC_NO', combined_unit_matched)
+            unit_excel_data = iter_unit_reports(
+                df, flags, output_units,
+                [
+                    "SNO", "EMP CODE", "EMP NAME", "BRANCH", "BRANCH 1",
+                    "UNIT", "STATE", "BANK_ACC_NO", "BANKREFNO"
+                ],
+                sheet_names=("Matched", "Unmatched")
+            )
+            match_counts = unit_match_counts(df, flags)
+
         # --- 6) Final Output Handling ---
-        if not unit_pdf_data:
+        if not output_units:
+            discard_unit_parts(unit_parts)
             # If no matches found, display the message in RED (error style)
-            st.error("Mismatch: PDF & Excel file data not matching. Please upload proper data.")
+            ui.error("Mismatch: PDF & Excel file data not matching. Please upload proper data.")
             # (Optionally) stop execution if desired:
-            # st.stop()
+            # ui.stop()
         else:
-            # Create a ZIP for each unit (PDF + matched/unmatched Excel).
-            unit_zip_data = {}
-            for unit, pdf_bytes in unit_pdf_data.items():
-                inmem_zip = io.BytesIO()
-                with zipfile.ZipFile(inmem_zip, "w", zipfile.ZIP_DEFLATED) as z:
-                    z.writestr(f"{unit}_Bank.pdf", pdf_bytes)
-                    if unit in unit_excel_data:
-                        matched_bytes, unmatched_bytes = unit_excel_data[unit]
-                        z.writestr(f"{unit}_Matched.xlsx", matched_bytes)
-                        z.writestr(f"{unit}_Unmatched.xlsx", unmatched_bytes)
-                inmem_zip.seek(0)
-                unit_zip_data[unit] = inmem_zip.getvalue()
+            # One folder per unit (PDF + matched/unmatched Excel) in the output ZIP, which is
+            # written to disk unit by unit: each merged PDF is dropped once it is stored, and the
+            # unit's files upload to S3 in the background while the next units merge.
+            month_prefix = f"{S3_FOLDER}{selected_month}-{selected_year}/"
+            # What is uploaded is also described in the month's archive manifest.
+            manifest = start_manifest("Bank", month_prefix)
+            output = start_output_zip()
+            uploads = None if run_cancelled else start_uploads(AWS_ACCESS_KEY, AWS_SECRET_KEY, S3_BUCKET_NAME)
+            try:
+                for unit in output_units:
+                    # Merge in upload order, then page order within each PDF.
+                    with stage(metrics, "unit_merge"):
+                        merged_pdf = merge_unit_parts(unit_parts, unit)
+                    with stage(metrics, "pdf_write"):
+                        pdf_bytes = merged_pdf.write()
+                    merged_pages = merged_pdf.page_count
+                    merged_pdf.close()
+                    count(metrics, "units")
+
+                    with stage(metrics, "excel_report"):
+                        matched_bytes, unmatched_bytes = next(unit_excel_data)
+                    with stage(metrics, "zip"):
+                        add_unit_files(output, unit, f"{unit}_Bank", {
+                            f"{unit}_Bank.pdf": pdf_bytes,
+                            f"{unit}_Matched.xlsx": matched_bytes,
+                            f"{unit}_Unmatched.xlsx": unmatched_bytes,
+                        })
+                    matched_rows, unmatched_rows = match_counts.get(unit, (0, 0))
+                    add_manifest_unit(manifest, unit, {
+                        f"{month_prefix}{unit}/{unit}_Bank.pdf": pdf_bytes,
+                        f"{month_prefix}{unit}/{unit}_Matched.xlsx": matched_bytes,
+                        f"{month_prefix}{unit}/{unit}_Unmatched.xlsx": unmatched_bytes,
+                    }, matched=matched_rows, unmatched=unmatched_rows, pages=merged_pages,
+                       pdf=f"{unit}_Bank.pdf",
+                       ids=identifier_pages(page_ids[unit] for page_ids in pdf_page_ids if unit in page_ids))
+                    # Upload individual files for each unit (no zip).
+                    if uploads is not None:
+                        for file_name in output["units"][unit]:
+                            submit_upload(
+                                uploads,
+                                f"{month_prefix}{unit}/{file_name}",
+                                functools.partial(read_output_file, output, unit, file_name)
+                            )
+            except Exception:
+                if uploads is not None:
+                    cancel_uploads(uploads)
+                discard_output_zip(output)
+                raise
+            finally:
+                discard_unit_parts(unit_parts)
+            # The ZIP is cached under result_key (returned at once by Generate) only after the month
+            # is archived; until then the checkpoints stay, so Generate retries a failed upload or
+            # resumes a cancelled run without processing the PDFs again.
+            if run_cancelled:
+                output_key = cache_key("Bank", "cancelled", result_key, completed)
+            else:
+                output_key = cache_key("Bank", "unarchived", result_key)
+            with stage(metrics, "zip"):
+                master_zip_path = finish_output_zip(output, output_key, result_cache_max_bytes())
+
+            master_zip_name = f"{selected_month}-{selected_year}.zip"
+
+            # Wait for the S3 uploads still running.
+            if uploads is None:
+                close_output_reader(output)
+            else:
+                try:
+                    with stage(metrics, "s3_wait"):
+                        upload_stats = finish_uploads(uploads)
+                        write_manifest(uploads["client"], S3_BUCKET_NAME, manifest)
+                    master_zip_path = cache_rename("results", output_key, result_key)
+                    clear_checkpoints(checkpoints)
+                    add_time(metrics, "s3_upload", upload_stats["seconds"])
+                    count(metrics, "s3_objects", upload_stats["objects"])
+                    count(metrics, "s3_bytes", upload_stats["bytes"])
+                    ui.success("Data processed & generated files are archived for future use.")
+                    ui.info(describe_upload_stats(upload_stats))
+
+                except NoCredentialsError:
+                    ui.error("AWS credentials not found. Could not upload to S3. Press Generate again to retry the archive.")
+                except Exception as e:
+                    ui.error(f"Failed to upload to S3: {e}. Press Generate again to retry the archive.")
+                finally:
+                    close_output_reader(output)
+                    invalidate_archive_prefix(month_prefix)
+
+            # Provide local ZIP download to user.
+            with open(master_zip_path, "rb") as master_zip:
+                ui.download_button(
+                    label="Download Output in ZIP",
+                    data=master_zip,
+                    file_name=master_zip_name,
+                    mime="application/zip"
+                )
+
+            # Show final summary message only if matches were found
+            end_time = time.time()
+            elapsed_time = end_time - start_time
+            ui.success(
+                f"Processing completed in {elapsed_time:.2f} seconds. "
+                f"Highlight annotations: {highlight_count}, Mask annotations: {mask_count}."
+            )
+            with ui.expander("Performance details"):
+                ui.json(finish_metrics(metrics))
  
-            # Create a master ZIP containing all unit ZIPs.
-            master_zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(master_zip_buffer, "w", zipfile.ZIP_DEFLATED) as master_zip:
-                for unit, zip_data in unit_zip_data.items():
-                    master_zip.writestr(f"{unit}_Bank.zip", zip_data)
-            master_zip_buffer.seek(0)
+    # --- Step 1 & Step 2: Side-by-Side Columns for File Upload ---
+    col_pdf, col_excel = st.columns(2)
  
-            master_zip_name = f"{selected_month}-{selected_year}.zip"
+    with col_pdf:
+        st.header("Upload PDF Files")
+        pdf_files = st.file_uploader(
+            "",
+            type="pdf",
+            accept_multiple_files=True,
+            key="bank_pdf"
+        )
  
-            # Attempt S3 upload.
-            try:
-                s3_client = boto3.client(
-                    's3',
-                    aws_access_key_id=AWS_ACCESS_KEY,
-                    aws_secret_access_key=AWS_SECRET_KEY
-                )
+    with col_excel:
+        st.header("Upload Excel File")
+        excel_file = st.file_uploader(
+            "",
+            type=["xlsx", "xls"],
+            key="bank_excel"
+        )
  
-                # Upload individual files for each unit (no zip).
-                for unit, pdf_bytes in unit_pdf_data.items():
-                    s3_client.upload_fileobj(
-                        io.BytesIO(pdf_bytes),
-                        S3_BUCKET_NAME,
-                        f"{S3_FOLDER}{selected_month}-{selected_year}/{unit}/{unit}_Bank.pdf"
-                    )
-                    if unit in unit_excel_data:
-                        matched_bytes, unmatched_bytes = unit_excel_data[unit]
-                        s3_client.upload_fileobj(
-                            io.BytesIO(matched_bytes),
-                            S3_BUCKET_NAME,
-                            f"{S3_FOLDER}{selected_month}-{selected_year}/{unit}/{unit}_Matched.xlsx"
-                        )
-                        s3_client.upload_fileobj(
-                            io.BytesIO(unmatched_bytes),
-                            S3_BUCKET_NAME,
-                            f"{S3_FOLDER}{selected_month}-{selected_year}/{unit}/{unit}_Unmatched.xlsx"
-                        )
+    generate_button = st.button("Generate")
+ 
+    # Step 4: Processing & Download
+    st.header("Processing & Download")
+ 
+    job_id = session_job_id("Bank")
+    if generate_button:
+        if not (pdf_files and excel_file):
+            st.warning("Please upload at least one PDF and one Excel file to proceed.")
+            st.stop()
  
-                st.success("Data processed & generated files are archived for future use.")
+        # --- 1) Check for duplicates among uploaded PDFs ---
+        # Each PDF is copied to disk once and hashed on the way (the hashes also key the result
+        # cache); the run only keeps the paths of the copies.
+        pdf_uploads = spool_uploads(pdf_files)
+        pdf_hash_list = [pdf["sha256"] for pdf in pdf_uploads]  # upload order
+        duplicate_found = len(set(pdf_hash_list)) != len(pdf_hash_list)
  
-            except NoCredentialsError:
-                st.error("AWS credentials not found. Could not upload to S3.")
-            except Exception as e:
-                st.error(f"Failed to upload to S3: {e}")
+        if duplicate_found:
+            st.error("Duplicate PDF file(s) found. Please remove duplicates and try again.")
+            st.stop()
  
-            # Provide local ZIP download to user.
+        # --- Result cache: same files and options as an earlier run return its ZIP at once ---
+        result_key = cache_key(
+            "Bank",
+            *pdf_hash_list,
+            content_hash(excel_file.getvalue()),
+            masking_mode, page_selection_mode, output_mode, selected_month, selected_year
+        )
+        cached_zip_path = cache_get("results", result_key)
+        if cached_zip_path is not None:
+            st.success("These files were already processed with the same options. Returning the previous output.")
             st.download_button(
                 label="Download Output in ZIP",
-                data=master_zip_buffer.getvalue(),
-                file_name=master_zip_name,
+                data=deferred_file(cached_zip_path),
+                file_name=f"{selected_month}-{selected_year}.zip",
                 mime="application/zip"
             )
+            st.stop()
  
-            # Show final summary message only if matches were found
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            st.success(
-                f"Processing completed in {elapsed_time:.2f} seconds. "
-                f"Highlight annotations: {highlight_count}, Mask annotations: {mask_count}."
-            )
\ No newline at end of file
+        # --- Run in the background: the page polls the job and shows its results ---
+        if job_id and is_job_active(job_id):
+            st.warning("A Bank run of this session is still in progress. Please wait for it to finish.")
+        else:
+            new_job_id = submit_job(
+                "Bank", f"Bank {selected_month}-{selected_year}",
+                sum(pdf["size"] for pdf in pdf_uploads) + excel_file.size,
+                generate_outputs, pdf_uploads, excel_file, result_key,
+                dedupe_key=result_key
+            )
+            if new_job_id is None:
+                st.error("Too many runs are waiting to be processed. Please try again in a few minutes.")
+            else:
+                job_id = new_job_id
+                remember_job("Bank", job_id)
+ 
+    # Latest job of this session (also after a rerun or a reconnect), refreshed until it ends.
+    if job_id and show_job(job_id):
+        poll_job(job_id)
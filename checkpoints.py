@@ -0,0 +1,112 @@
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from disk_cache import cache_dir, env_seconds
+
+# Per-PDF checkpoints of a Generate run, so a run that failed or was interrupted on PDF 180 of
+# 200 resumes from PDF 180 when Generate is pressed again with the same files and options.
+# Each finished source PDF gets a folder under <cache>/checkpoints/<result key>/ holding its
+# unit parts (one PDF per unit) and part.json (matched identifiers, page identifiers, counts).
+# Units are stored by their position in the roster (UNIT values need not be strings); the
+# roster is part of the key, so positions mean the same units when the run resumes.
+# A part folder is renamed into place once complete, so a crash never leaves a half part.
+# Settings (.env file):
+#   CHECKPOINT_RETENTION_SECONDS   checkpoints of runs never finished are dropped after (default 2 days)
+DEFAULT_CHECKPOINT_RETENTION_SECONDS = 2 * 24 * 3600
+
+
+def checkpoint_retention_seconds():
+    """Seconds the checkpoints of an unfinished run are kept."""
+    return env_seconds("CHECKPOINT_RETENTION_SECONDS", DEFAULT_CHECKPOINT_RETENTION_SECONDS)
+
+
+def _prune_checkpoints(root, keep):
+    """Removes the checkpoint folders of runs untouched for longer than the retention time."""
+    oldest = time.time() - checkpoint_retention_seconds()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name == keep:
+            continue
+        with contextlib.suppress(FileNotFoundError):
+            if os.path.getmtime(path) < oldest:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def open_checkpoints(run_key, units):
+    """
+    Checkpoints of a run: run_key identifies its inputs and options (e.g. the result cache
+    key), units lists the roster units in order.
+    Returns { "dir": folder, "units": units, "done": sorted indices of the PDFs already processed }.
+    """
+    root = cache_dir("checkpoints")
+    _prune_checkpoints(root, run_key)
+    run_dir = os.path.join(root, run_key)
+    os.makedirs(run_dir, exist_ok=True)
+    os.utime(run_dir)
+    done = sorted(int(name[4:]) for name in os.listdir(run_dir) if name.startswith("pdf-"))
+    return {"dir": run_dir, "units": list(units), "done": done}
+
+
+def _part_dir(checkpoints, index):
+    return os.path.join(checkpoints["dir"], f"pdf-{index:05d}")
+
+
+def save_checkpoint(checkpoints, index, unit_files, page_ids, matched, counts):
+    """
+    Stores the outputs of source PDF number index:
+        unit_files: { unit: PDF bytes of the unit's part }
+        page_ids:   { unit: [identifiers on each page of the part] } (see render_unit_pdfs)
+        matched:    { unit: identifiers matched for the unit in this PDF }
+        counts:     { name: number } (marks drawn, pages, ...)
+    """
+    position = {unit: pos for pos, unit in enumerate(checkpoints["units"])}
+    tmp_dir = tempfile.mkdtemp(dir=checkpoints["dir"], prefix=".tmp-")
+    try:
+        for unit, pdf_bytes in unit_files.items():
+            with open(os.path.join(tmp_dir, f"{position[unit]}.pdf"), "wb") as f:
+                f.write(pdf_bytes)
+        with open(os.path.join(tmp_dir, "part.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "files": [position[unit] for unit in unit_files],
+                "page_ids": [[position[unit], ids] for unit, ids in page_ids.items()],
+                "matched": [[position[unit], sorted(ids)] for unit, ids in matched.items() if ids],
+                "counts": counts,
+            }, f)
+        os.rename(tmp_dir, _part_dir(checkpoints, index))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    checkpoints["done"].append(index)
+
+
+def load_checkpoint(checkpoints, index):
+    """
+    Outputs of source PDF number index as saved by save_checkpoint (matched values as sets),
+    or None when that PDF has no checkpoint.
+    """
+    part_dir = _part_dir(checkpoints, index)
+    try:
+        with open(os.path.join(part_dir, "part.json"), encoding="utf-8") as f:
+            part = json.load(f)
+    except FileNotFoundError:
+        return None
+    units = checkpoints["units"]
+    unit_files = {}
+    for pos in part["files"]:
+        with open(os.path.join(part_dir, f"{pos}.pdf"), "rb") as f:
+            unit_files[units[pos]] = f.read()
+    return {
+        "unit_files": unit_files,
+        "page_ids": {units[pos]: ids for pos, ids in part["page_ids"]},
+        "matched": {units[pos]: set(ids) for pos, ids in part["matched"]},
+        "counts": part["counts"],
+    }
+
+
+def clear_checkpoints(checkpoints):
+    """Drops the checkpoints of a run once its output is complete."""
+    shutil.rmtree(checkpoints["dir"], ignore_errors=True)
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import tempfile
+
+# Cache settings are read from the environment (.env file) when used:
+#   CORE_INTEGRA_CACHE_DIR  root folder of every local cache (one sub-folder per cache name)
+#   RESULT_CACHE_MAX_BYTES  byte budget of the Generate result cache (default 2 GB)
+DEFAULT_RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+
+def cache_root():
+    """Root folder of every local cache."""
+    return os.getenv("CORE_INTEGRA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "core_integra_cache"))
+
+
+# Unit suffixes of env_bytes ("512K", "256MB", "2G") and env_seconds ("90s", "30m", "6h", "1d").
+BYTE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+SECOND_UNITS = {"": 1, "S": 1, "M": 60, "H": 3600, "D": 24 * 3600}
+
+
+def _env_number(name, default, units):
+    """Integer setting, optionally followed by a unit (a key of units); default when unset or invalid."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    value = value.strip().upper()
+    number = value.rstrip("".join(units))
+    try:
+        return int(number) * units[value[len(number):]]
+    except (KeyError, ValueError):
+        return default
+
+
+def env_bytes(name, default):
+    """
+    Reads a size in bytes from the environment: a number of bytes, or of K, M, G or T bytes
+    ("256M", "2GB"). Falls back to default when unset or invalid.
+    """
+    units = dict(BYTE_UNITS, **{unit + "B": factor for unit, factor in BYTE_UNITS.items()})
+    return _env_number(name, default, units)
+
+
+def env_seconds(name, default):
+    """Reads a duration in seconds from the environment ("900", "30m", "6h", "1d"), like env_bytes."""
+    return _env_number(name, default, SECOND_UNITS)
+
+
+def env_int(name, default):
+    """Reads a plain count (workers, retries, queue length) from the environment, like env_bytes."""
+    return _env_number(name, default, {"": 1})
+
+
+def result_cache_max_bytes():
+    """Byte budget of the Generate result cache."""
+    return env_bytes("RESULT_CACHE_MAX_BYTES", DEFAULT_RESULT_CACHE_MAX_BYTES)
+
+
+def cache_dir(name):
+    """Returns (and creates) the folder of the named cache."""
+    path = os.path.join(cache_root(), name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def content_hash(data):
+    """SHA-256 hex digest of a bytes payload."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(*parts):
+    """Builds a cache key from any number of strings / numbers (e.g. file hashes and options)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def cache_path(name, key):
+    """Path of an entry of the named cache (whether or not it exists)."""
+    return os.path.join(cache_dir(name), key)
+
+
+def cache_get(name, key):
+    """
+    Returns the path of a cached entry, or None on a miss.
+    A hit refreshes the entry's modification time, which drives LRU eviction.
+    """
+    path = cache_path(name, key)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def cache_get_bytes(name, key):
+    """Returns the cached bytes, or None on a miss."""
+    path = cache_get(name, key)
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        # Evicted by another session in between.
+        return None
+
+
+def cache_put(name, key, data, max_bytes):
+    """
+    Stores bytes under key, then evicts least recently used entries until the cache fits
+    in max_bytes. Writes go through a temporary file so readers never see partial entries.
+    Returns the entry path.
+    """
+    folder = cache_dir(name)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    path = os.path.join(folder, key)
+    os.replace(tmp_path, path)
+    evict_lru(name, max_bytes)
+    return path
+
+
+def cache_put_file(name, key, tmp_path, max_bytes):
+    """
+    Moves a finished file (written in cache_dir(name) with a ".tmp" suffix) into the cache under
+    key, then evicts least recently used entries. The new entry itself is never evicted here,
+    so callers can read it right away. Returns the entry path.
+    """
+    path = cache_path(name, key)
+    os.replace(tmp_path, path)
+    evict_lru(name, max_bytes, keep=path)
+    return path
+
+
+def cache_rename(name, key, new_key):
+    """Moves an entry of the named cache to new_key (replacing any entry there) and returns its path."""
+    path = cache_path(name, new_key)
+    os.replace(cache_path(name, key), path)
+    return path
+
+
+def evict_lru(name, max_bytes, keep=None):
+    """
+    Deletes the least recently used entries of the named cache until it fits in max_bytes.
+    The entry at path keep (if any) is left in place.
+    """
+    folder = cache_dir(name)
+    entries = []
+    total = 0
+    with os.scandir(folder) as it:
+        for entry in it:
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
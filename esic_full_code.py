@@ -1,18 +1,42 @@
 def run_esic_section():
     import streamlit as st
-    import pandas as pd
     import fitz  # PyMuPDF
     import re
-    import io
     import numpy as np  # For int64 conversion
-    import zipfile
     import time
-    import boto3
     from botocore.exceptions import NoCredentialsError
     import datetime
+    import functools
+    import os
+    from dotenv import load_dotenv
+    from id_index import build_id_index
+    from roster import read_roster, build_unit_mapping
+    from reports import iter_unit_reports, matched_flags, unit_match_counts
+    from page_plan import scan_pdf, has_roster_hits, render_unit_pdfs, identifier_pages
+    from pdf_marks import draw_marks, OUTPUT_ANNOTATIONS, OUTPUT_FLATTENED
+    from disk_cache import cache_key, content_hash, cache_get, cache_rename, result_cache_max_bytes
+    from output_zip import (
+        start_output_zip, add_unit_files, read_output_file, finish_output_zip, close_output_reader,
+        discard_output_zip
+    )
+    from metrics import start_metrics, stage, count, add_time, finish_metrics
+    from archive_tree import invalidate_archive_prefix
+    from manifest import start_manifest, add_manifest_unit, write_manifest
+    from s3_upload import start_uploads, submit_upload, cancel_uploads, finish_uploads, describe_upload_stats
+    from checkpoints import open_checkpoints, load_checkpoint, save_checkpoint, clear_checkpoints
+    from jobs import submit_job, is_job_active, session_job_id, remember_job, show_job, poll_job, deferred_file
+    from upload_spool import spool_uploads
+    from unit_parts import (
+        start_unit_parts, add_unit_parts, finish_unit_parts, merge_unit_parts, discard_unit_parts
+    )
  
     # AWS S3 configuration for ESIC uploads
-    
+    load_dotenv()
+    AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
+    AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
+    S3_BUCKET_NAME = "sanj0908"
+    S3_FOLDER = "ESIC/"  # Optional folder inside the bucket
+ 
     # ----------------------- New Streamlit Layout -----------------------
     st.title("ESIC Statement")
  
@@ -25,8 +49,8 @@ def run_esic_section():
     current_month = now.month
     month_names = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
  
-    # Use four columns for options.
-    col1, col2, col3, col4 = st.columns([2, 2, 2, 2])
+    # Use five columns for options.
+    col1, col2, col3, col4, col5 = st.columns([2, 2, 2, 2, 2])
  
     with col1:
         masking_mode = st.radio(
@@ -43,10 +67,18 @@ def run_esic_section():
         )
  
     with col3:
+        # "Flattened" draws all marks of a page into its content at once: smaller, faster PDFs.
+        output_mode = st.radio(
+            "Select Output Mode:",
+            options=[OUTPUT_ANNOTATIONS, OUTPUT_FLATTENED],
+            index=0
+        )
+ 
+    with col4:
         # Year selection: restrict to current year (no future year)
         selected_year = st.number_input("Select Year", min_value=1900, max_value=current_year, step=1, value=current_year)
  
-    with col4:
+    with col5:
         # If the selected year is the current year, only allow months up to the current month.
         if selected_year == current_year:
             allowed_months = month_names[:current_month]
@@ -59,7 +91,7 @@ def run_esic_section():
     ["-- Select Month --"] + allowed_months, 
     index=0
 )
-
+ 
     # --- Step 2 & Step 3: Side-by-Side Columns for File Upload ---
     col_pdf, col_excel = st.columns(2)
  
@@ -89,26 +121,11 @@ def run_esic_section():
     mode = "Highlight Relevant" if masking_mode == "Highlight Relevant" else "Mask All Not Relevant"
     page_mode = "Keep the original doc" if page_selection_mode == "All Pages" else "Keep relevant pages"
  
-    # Create a progress bar and a status text placeholder
-    progress_bar = st.progress(0)
-    status_text = st.empty()
- 
-    # Global statistics dictionary
-    stats = {
-        "pages_total": 0,
-        "pages_processed": 0,
-        "highlight": 0,
-        "mask": 0,
-        "start_time": time.time()
-    }
- 
-    # Initialize an error flag; if any error message is encountered, this will be set to True.
-    error_occurred = False
- 
-    def process_pdf(pdf_file, unit_esino_dict, mode, page_mode, stats, progress_bar, status_text, unit_highlights, unit_matched):
+    def process_pdf(pdf_file, unit_esino_dict, esino_index, mode, page_mode, output_mode, stats, progress_bar, status_text, unit_highlights, unit_matched, metrics, page_ids, cancelled=None):
         """
-        Processes an uploaded PDF by searching for candidate numbers (10–12 digit numbers)
-        and comparing them with ESINO values for each UNIT.
+        Processes a spooled PDF upload (see upload_spool) by searching for candidate numbers (10–12 digit numbers)
+        and comparing them with ESINO values for each UNIT. Each page is scanned once against
+        esino_index (ESINO -> units); the result drives the annotations of every unit.
  
         Modes:
           - "Highlight Relevant": Only matching ESINO candidates are highlighted (yellow).
@@ -116,198 +133,30 @@ def run_esic_section():
                  • If it is in the ESINO list, a white annotation is added (with slight transparency);
                  • Otherwise, a dark gray annotation is added.
  
+        Output Modes (see draw_marks):
+          - "Annotations": one annotation object per mark.
+          - "Flattened": all marks of a page are drawn into the page content in one pass.
+ 
         Page Modes:
           - "Keep the original doc": Every page is processed.
           - "Keep relevant pages": First and last pages are always processed, while other pages are
                                     processed only if they contain at least one matching candidate.
+ 
+        Pages are scanned first (scan_pdf) and only the pages kept by some unit are copied and
+        annotated afterwards (render_unit_pdfs). Stage timings and counters go to metrics; the
+        ESINOs found on each copied page go to page_ids (see render_unit_pdfs).
+        Returns {} when the PDF has no ESINO match at all, and None when cancelled() turned
+        True before the last page (scan and render stop at the next page; documents are closed).
         """
         esino_regex = re.compile(r"\b\d{10,12}\b")
  
-        # Check if pdf_file is a file-like object or a string (file path)
-        if hasattr(pdf_file, "getvalue"):
-            file_bytes = pdf_file.getvalue()
-        else:
-            with open(pdf_file, "rb") as f:
-                file_bytes = f.read()
- 
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
+        # Opened from the spooled file: pages are read from disk as they are needed.
+        with stage(metrics, "pdf_open"):
+            doc = fitz.open(pdf_file["path"], filetype="pdf")
         total_pages = doc.page_count
         stats["pages_total"] += total_pages
  
-        # Create an output PDF for each UNIT.
-        unit_pdfs = {unit: fitz.open() for unit in unit_esino_dict.keys()}
- 
-        for page in doc:
-            # ----- KEEP ALL PAGES MODE -----
-            if page_mode == "Keep the original doc":
-                for unit, esino_list in unit_esino_dict.items():
-                    temp_doc = fitz.open()
-                    temp_doc.insert_pdf(doc, from_page=page.number, to_page=page.number)
-                    temp_page = temp_doc[0]
-                    words = page.get_text("words")
-                    if mode == "Mask All Not Relevant":
-                        for w in words:
-                            word_text = w[4]
-                            x0, y0, x1, y1 = w[0]-96, w[1]-5, w[2]+457, w[3]+5
-                            rect = fitz.Rect(x0, y0, x1, y1)
-                            if esino_regex.fullmatch(word_text):
-                                if word_text in esino_list:
-                                    annot = temp_page.add_rect_annot(rect)
-                                    annot.set_colors(stroke=(1, 1, 1), fill=(1, 1, 1))
-                                    annot.set_border(width=1)
-                                    annot.set_opacity(0.3)
-                                    annot.set_flags(64)  # ANNOT_FLAG_READONLY
-                                    annot.update()
-                                    stats["highlight"] += 1
-                                    unit_highlights[unit] = True
-                                    unit_matched[unit].add(word_text)
-                                else:
-                                    annot = temp_page.add_rect_annot(rect)
-                                    annot.set_colors(stroke=(0.5, 0.5, 0.5), fill=(0.5, 0.5, 0.5))
-                                    annot.set_border(width=1)
-                                    annot.set_opacity(1)
-                                    annot.set_flags(64)
-                                    annot.update()
-                                    stats["mask"] += 1
-                    elif mode == "Highlight Relevant":
-                        for w in words:
-                            word_text = w[4]
-                            x0, y0, x1, y1 = w[0]-96, w[1]-5, w[2]+457, w[3]+5
-                            rect = fitz.Rect(x0, y0, x1, y1)
-                            if esino_regex.fullmatch(word_text) and word_text in esino_list:
-                                annot = temp_page.add_rect_annot(rect)
-                                annot.set_colors(stroke=(1, 1, 0), fill=(1, 1, 0))
-                                annot.set_border(width=1)
-                                annot.set_opacity(0.3)
-                                annot.set_flags(64)
-                                annot.update()
-                                stats["highlight"] += 1
-                                unit_highlights[unit] = True
-                                unit_matched[unit].add(word_text)
-                    # Add annotation for the unit name wherever it appears.
-                    for r in temp_page.search_for(unit):
-                        annot = temp_page.add_rect_annot(r)
-                        annot.set_colors(stroke=(0, 0, 1), fill=(0, 0, 1))
-                        annot.set_border(width=1)
-                        annot.set_opacity(0.3)
-                        annot.update()
-                    unit_pdfs[unit].insert_pdf(temp_doc)
-                    temp_doc.close()
- 
-            # ----- RELEVANT PAGES ONLY MODE -----
-            else:
-                if page.number in (0, total_pages - 1):
-                    for unit, esino_list in unit_esino_dict.items():
-                        temp_doc = fitz.open()
-                        temp_doc.insert_pdf(doc, from_page=page.number, to_page=page.number)
-                        temp_page = temp_doc[0]
-                        words = page.get_text("words")
-                        if mode == "Mask All Not Relevant":
-                            for w in words:
-                                word_text = w[4]
-                                x0, y0, x1, y1 = w[0]-96, w[1]-5, w[2]+457, w[3]+5
-                                rect = fitz.Rect(x0, y0, x1, y1)
-                                if esino_regex.fullmatch(word_text):
-                                    if word_text in esino_list:
-                                        annot = temp_page.add_rect_annot(rect)
-                                        annot.set_colors(stroke=(1, 1, 1), fill=(1, 1, 1))
-                                        annot.set_border(width=1)
-                                        annot.set_opacity(0.3)
-                                        annot.set_flags(64)
-                                        annot.update()
-                                        stats["highlight"] += 1
-                                        unit_highlights[unit] = True
-                                        unit_matched[unit].add(word_text)
-                                    else:
-                                        annot = temp_page.add_rect_annot(rect)
-                                        annot.set_colors(stroke=(0.5, 0.5, 0.5), fill=(0.5, 0.5, 0.5))
-                                        annot.set_border(width=1)
-                                        annot.set_opacity(1)
-                                        annot.set_flags(64)
-                                        annot.update()
-                                        stats["mask"] += 1
-                        elif mode == "Highlight Relevant":
-                            for w in words:
-                                word_text = w[4]
-                                x0, y0, x1, y1 = w[0]-96, w[1]-5, w[2]+457, w[3]+5
-                                rect = fitz.Rect(x0, y0, x1, y1)
-                                if esino_regex.fullmatch(word_text) and word_text in esino_list:
-                                    annot = temp_page.add_rect_annot(rect)
-                                    annot.set_colors(stroke=(1, 1, 0), fill=(1, 1, 0))
-                                    annot.set_border(width=1)
-                                    annot.set_opacity(0.3)
-                                    annot.set_flags(64)
-                                    annot.update()
-                                    stats["highlight"] += 1
-                                    unit_highlights[unit] = True
-                                    unit_matched[unit].add(word_text)
-                        for r in temp_page.search_for(unit):
-                            annot = temp_page.add_rect_annot(r)
-                            annot.set_colors(stroke=(0, 0, 1), fill=(0, 0, 1))
-                            annot.set_border(width=1)
-                            annot.set_opacity(0.3)
-                            annot.update()
-                        unit_pdfs[unit].insert_pdf(temp_doc)
-                        temp_doc.close()
- 
-                else:
-                    words = page.get_text("words")
-                    for unit, esino_list in unit_esino_dict.items():
-                        page_has_unit = any(esino_regex.fullmatch(w[4]) and w[4] in esino_list for w in words)
-                        if not page_has_unit:
-                            continue
- 
-                        temp_doc = fitz.open()
-                        temp_doc.insert_pdf(doc, from_page=page.number, to_page=page.number)
-                        temp_page = temp_doc[0]
-                        if mode == "Mask All Not Relevant":
-                            for w in words:
-                                word_text = w[4]
-                                x0, y0, x1, y1 = w[0]-96, w[1]-5, w[2]+457, w[3]+5
-                                rect = fitz.Rect(x0, y0, x1, y1)
-                                if esino_regex.fullmatch(word_text):
-                                    if word_text in esino_list:
-                                        annot = temp_page.add_rect_annot(rect)
-                                        annot.set_colors(stroke=(1, 1, 1), fill=(1, 1, 1))
-                                        annot.set_border(width=1)
-                                        annot.set_opacity(0.3)
-                                        annot.set_flags(64)
-                                        annot.update()
-                                        stats["highlight"] += 1
-                                        unit_highlights[unit] = True
-                                        unit_matched[unit].add(word_text)
-                                    else:
-                                        annot = temp_page.add_rect_annot(rect)
-                                        annot.set_colors(stroke=(0.5, 0.5, 0.5), fill=(0.5, 0.5, 0.5))
-                                        annot.set_border(width=1)
-                                        annot.set_opacity(1)
-                                        annot.set_flags(64)
-                                        annot.update()
-                                        stats["mask"] += 1
-                        elif mode == "Highlight Relevant":
-                            for w in words:
-                                word_text = w[4]
-                                x0, y0, x1, y1 = w[0]-96, w[1]-5, w[2]+457, w[3]+5
-                                rect = fitz.Rect(x0, y0, x1, y1)
-                                if esino_regex.fullmatch(word_text) and word_text in esino_list:
-                                    annot = temp_page.add_rect_annot(rect)
-                                    annot.set_colors(stroke=(1, 1, 0), fill=(1, 1, 0))
-                                    annot.set_border(width=1)
-                                    annot.set_opacity(0.3)
-                                    annot.set_flags(64)
-                                    annot.update()
-                                    stats["highlight"] += 1
-                                    unit_highlights[unit] = True
-                                    unit_matched[unit].add(word_text)
-                        for r in temp_page.search_for(unit):
-                            annot = temp_page.add_rect_annot(r)
-                            annot.set_colors(stroke=(0, 0, 1), fill=(0, 0, 1))
-                            annot.set_border(width=1)
-                            annot.set_opacity(0.3)
-                            annot.update()
-                        unit_pdfs[unit].insert_pdf(temp_doc)
-                        temp_doc.close()
- 
+        def on_page(page_number):
             stats["pages_processed"] += 1
             progress = stats["pages_processed"] / stats["pages_total"]
             progress_bar.progress(progress)
@@ -315,171 +164,349 @@ def run_esic_section():
             remaining = (elapsed / stats["pages_processed"]) * (stats["pages_total"] - stats["pages_processed"])
             status_text.text(f"Estimated time remaining: {remaining:.1f} seconds.")
  
+        # ----- SCAN PHASE -----
+        # "Keep the original doc" keeps every page for every unit; "Keep relevant pages" keeps the
+        # first and last pages for every unit and any other page only for the units matched on it.
+        page_plans = scan_pdf(
+            doc, list(unit_esino_dict), esino_index, esino_regex,
+            page_mode != "Keep the original doc", on_page, metrics=metrics, cancelled=cancelled,
+            doc_sha256=pdf_file["sha256"]
+        )
+        if cancelled is not None and cancelled():
+            doc.close()
+            return None
+        if not has_roster_hits(page_plans):
+            doc.close()
+            return {}
+ 
+        def draw_page(unit, temp_page, plan):
+            words = plan["words"]
+            hits = plan["unit_hits"].get(unit, [])
+            marks = []
+            if mode == "Mask All Not Relevant":
+                hit_set = set(hits)
+                for w_idx in plan["candidates"]:
+                    w = words[w_idx]
+                    rect = (w[0]-96, w[1]-5, w[2]+457, w[3]+5)
+                    if w_idx in hit_set:
+                        marks.append((rect, "matched"))
+                        unit_highlights[unit] = True
+                        unit_matched[unit].add(w[4])
+                    else:
+                        marks.append((rect, "mask"))
+            elif mode == "Highlight Relevant":
+                for w_idx in hits:
+                    w = words[w_idx]
+                    marks.append(((w[0]-96, w[1]-5, w[2]+457, w[3]+5), "highlight"))
+                    unit_highlights[unit] = True
+                    unit_matched[unit].add(w[4])
+            # Add annotation for the unit name wherever it appears.
+            for r in temp_page.search_for(unit):
+                marks.append((r, "unit_label"))
+            drawn = draw_marks(temp_page, marks, output_mode)
+            stats["highlight"] += drawn.get("highlight", 0) + drawn.get("matched", 0)
+            stats["mask"] += drawn.get("mask", 0)
+            count(metrics, "marks", sum(drawn.values()))
+ 
+        # ----- RENDER PHASE -----
+        # Only the selected pages are copied, straight into each unit's PDF.
+        unit_pdfs = render_unit_pdfs(
+            doc, page_plans, draw_page, metrics=metrics, page_ids=page_ids, cancelled=cancelled
+        )
+        doc.close()
+        if cancelled is not None and cancelled():
+            for unit_doc in unit_pdfs.values():
+                unit_doc.close()
+            return None
         return unit_pdfs
  
+    # ----------------------- Background Job -----------------------
+    def generate_outputs(ui, pdf_files, excel_file, result_key):
+        """
+        One Generate run (processing, ZIP, S3 archiving), executed as a background job
+        (jobs.py). ui takes the place of st: what it is given is shown later by show_job.
+        """
+        # Create a progress bar and a status text placeholder
+        progress_bar = ui.progress(0)
+        status_text = ui.empty()
+ 
+        # Statistics of this run
+        stats = {
+            "pages_total": 0,
+            "pages_processed": 0,
+            "highlight": 0,
+            "mask": 0,
+            "start_time": time.time()
+        }
+ 
+        # Initialize an error flag; if any error message is encountered, this will be set to True.
+        error_occurred = False
+ 
+        # Stage timings and counters of this run (shown at the end and written to metrics files).
+        metrics = start_metrics("ESIC")
+        try:
+            excel_started = time.perf_counter()
+            df = read_roster(excel_file)
+            df['ESINO'] = df['ESINO'].fillna(0).astype(np.int64).astype(str)
+            # Map each UNIT to its list of ESINO values.
+            unit_esino_dict = build_unit_mapping(df, 'ESINO')
+            # ESINO -> unit(s), built once for all PDFs.
+            esino_index = build_id_index(unit_esino_dict)
+            # Track whether each unit gets any highlight annotation
+            unit_highlights = {unit: False for unit in unit_esino_dict.keys()}
+            # Track matched ESINO numbers for each unit
+            unit_matched = {unit: set() for unit in unit_esino_dict.keys()}
+            add_time(metrics, "excel_load", time.perf_counter() - excel_started)
+        except Exception as e:
+            ui.error("❌ Error reading Excel file. Please ensure it has 'UNIT' and 'ESINO' columns.")
+            ui.error(e)
+            error_occurred = True
+            ui.stop()
+        else:
+            # Pages of every unit, kept in memory up to OUTPUT_MEMORY_MAX_BYTES and on disk beyond.
+            all_unit_files = start_unit_parts(metrics)
+            # ESINOs on each page of every unit part, in the same order (for the archive manifest).
+            all_unit_page_ids = {}
+            # Checkpoint after each source PDF (see checkpoints.py), so pressing Generate again
+            # after a failure or a dropped session continues from the first PDF not yet done.
+            checkpoints = open_checkpoints(result_key, unit_esino_dict)
+            if checkpoints["done"]:
+                ui.info(
+                    f"Resuming an interrupted run: {len(checkpoints['done'])} of {len(pdf_files)} "
+                    f"PDF files were already processed."
+                )
+            # Cancel stops the loop at the next page; the PDFs finished until then make a partial output.
+            run_cancelled = False
+            for i, pdf in enumerate(pdf_files):
+                if ui.cancelled():
+                    run_cancelled = True
+                    break
+                part = load_checkpoint(checkpoints, i)
+                if part is None:
+                    pdf_page_ids = {}
+                    pdf_matched = {unit: set() for unit in unit_esino_dict}
+                    pdf_highlights = {unit: False for unit in unit_esino_dict}
+                    stats_before = dict(stats)
+                    unit_pdfs = process_pdf(pdf, unit_esino_dict, esino_index, mode, page_mode, output_mode, stats, progress_bar, status_text, pdf_highlights, pdf_matched, metrics, pdf_page_ids, ui.cancelled)
+                    if unit_pdfs is None:
+                        # Counts of the unfinished PDF are dropped with it.
+                        stats.update(stats_before)
+                        run_cancelled = True
+                        break
+                    count(metrics, "pdfs")
+                    unit_files = {}
+                    for unit, new_doc in unit_pdfs.items():
+                        if new_doc.page_count > 0:
+                            with stage(metrics, "pdf_write"):
+                                unit_files[unit] = new_doc.write()
+                        new_doc.close()
+                    part = {
+                        "unit_files": unit_files,
+                        "page_ids": {unit: pdf_page_ids[unit] for unit in unit_files},
+                        "matched": pdf_matched,
+                        "counts": {name: stats[name] - stats_before[name] for name in ("pages_total", "highlight", "mask")},
+                    }
+                    save_checkpoint(checkpoints, i, **part)
+                else:
+                    # Pages of a PDF processed by the interrupted run count as processed now.
+                    for name in ("pages_total", "highlight", "mask"):
+                        stats[name] += part["counts"][name]
+                    stats["pages_processed"] += part["counts"]["pages_total"]
+                    count(metrics, "resumed_pdfs")
+ 
+                if not part["unit_files"]:
+                    ui.warning(f"No ESINO from the Excel file was found in {pdf['name']}. File skipped.")
+                # A unit gets a highlight annotation exactly when one of its ESINOs is matched.
+                for unit, ids in part["matched"].items():
+                    if ids:
+                        unit_matched[unit].update(ids)
+                        unit_highlights[unit] = True
+                add_unit_parts(all_unit_files, i, part["unit_files"])
+                for unit in part["unit_files"]:
+                    all_unit_page_ids.setdefault(unit, []).append(part["page_ids"][unit])
+            total_time = time.time() - stats["start_time"]
+            # Do not show the "processing completed" message yet.
+            if run_cancelled:
+                ui.warning(
+                    f"⏹ Run cancelled after {i} of {len(pdf_files)} PDF files. The output below covers only "
+                    f"those files and was not archived to S3. Generate again with the same files and options "
+                    f"to continue from there."
+                )
+ 
+            # Create one folder per unit inside the output ZIP (written to disk unit by unit);
+            # each unit's files are queued for S3 right away and upload while the next units merge.
+            # Skip units with no highlights
+            report_units = [
+                unit for unit in finish_unit_parts(all_unit_files)
+                if unit_highlights.get(unit, False)
+            ]
+            # Matched / unmatched Excel files, built a few units at a time as the units are written.
+            with stage(metrics, "excel_report"):
+                flags = matched_flags(df, 'ESINO', unit_matched)
+                unit_reports = iter_unit_reports(
+                    df, flags, report_units,
+                    ["SNO", "EMP CODE", "EMP NAME", "BRANCH", "BRANCH 1", "UNIT", "STATE", "ESINO"]
+                )
+                match_counts = unit_match_counts(df, flags)
+            month_prefix = f"{S3_FOLDER}{selected_month}-{selected_year}/"
+            # What is uploaded is also described in the month's archive manifest.
+            manifest = start_manifest("ESIC", month_prefix)
+            output = start_output_zip()
+            # Partial outputs of cancelled runs are not archived.
+            uploads = None if run_cancelled else start_uploads(AWS_ACCESS_KEY, AWS_SECRET_KEY, S3_BUCKET_NAME)
+            try:
+                for unit in report_units:
+                    with stage(metrics, "unit_merge"):
+                        merged_pdf = merge_unit_parts(all_unit_files, unit)
+                    with stage(metrics, "pdf_write"):
+                        pdf_bytes = merged_pdf.write()
+                    merged_pages = merged_pdf.page_count
+                    merged_pdf.close()
+                    count(metrics, "units")
+ 
+                    with stage(metrics, "excel_report"):
+                        matched_bytes, unmatched_bytes = next(unit_reports)
+                    with stage(metrics, "zip"):
+                        add_unit_files(output, unit, unit, {
+                            f"{unit}_ESINO.pdf": pdf_bytes,
+                            f"{unit}_Matched.xlsx": matched_bytes,
+                            f"{unit}_Unmatched.xlsx": unmatched_bytes,
+                        })
+                    matched_rows, unmatched_rows = match_counts.get(unit, (0, 0))
+                    add_manifest_unit(manifest, unit, {
+                        f"{month_prefix}{unit}/{unit}_ESINO.pdf": pdf_bytes,
+                        f"{month_prefix}{unit}/{unit}_Matched.xlsx": matched_bytes,
+                        f"{month_prefix}{unit}/{unit}_Unmatched.xlsx": unmatched_bytes,
+                    }, matched=matched_rows, unmatched=unmatched_rows, pages=merged_pages,
+                       pdf=f"{unit}_ESINO.pdf", ids=identifier_pages(all_unit_page_ids.pop(unit)))
+                    if uploads is not None:
+                        for file_name in output["units"][unit]:
+                            submit_upload(
+                                uploads,
+                                f"{month_prefix}{unit}/{file_name}",
+                                functools.partial(read_output_file, output, unit, file_name)
+                            )
+            except Exception:
+                if uploads is not None:
+                    cancel_uploads(uploads)
+                discard_output_zip(output)
+                raise
+            finally:
+                discard_unit_parts(all_unit_files)
+            # Cached under result_key (returned at once by Generate) only once the month is archived;
+            # until then the checkpoints stay, so Generate resumes a cancelled run or retries the upload.
+            if run_cancelled:
+                output_key = cache_key("ESIC", "cancelled", result_key, i)
+            else:
+                output_key = cache_key("ESIC", "unarchived", result_key)
+            with stage(metrics, "zip"):
+                output_zip_path = finish_output_zip(output, output_key, result_cache_max_bytes())
+ 
+            if output_zip_path is None:
+                ui.error("Mismatch: PDF & Excel file data not matching. Please upload proper data.")
+                error_occurred = True
+            else:
+                # ---------------- S3 UPLOAD FUNCTIONALITY ----------------
+                if uploads is None:
+                    close_output_reader(output)
+                else:
+                    try:
+                        with stage(metrics, "s3_wait"):
+                            upload_stats = finish_uploads(uploads)
+                            write_manifest(uploads["client"], S3_BUCKET_NAME, manifest)
+                        output_zip_path = cache_rename("results", output_key, result_key)
+                        clear_checkpoints(checkpoints)
+                        add_time(metrics, "s3_upload", upload_stats["seconds"])
+                        count(metrics, "s3_objects", upload_stats["objects"])
+                        count(metrics, "s3_bytes", upload_stats["bytes"])
+                        ui.success(f"Data processed & generated files are archived for future use.")
+                        ui.info(describe_upload_stats(upload_stats))
+                    except NoCredentialsError:
+                        ui.error("AWS credentials not found. Could not upload to S3. Press Generate again to retry the archive.")
+                        error_occurred = True
+                    except Exception as e:
+                        ui.error(f"Failed to upload to S3: {e}. Press Generate again to retry the archive.")
+                        error_occurred = True
+                    finally:
+                        close_output_reader(output)
+                        invalidate_archive_prefix(month_prefix)
+                # ---------------------------------------------------------
+ 
+                output_zip_name = f"{selected_month}-{selected_year}.zip"
+                with open(output_zip_path, "rb") as output_zip_file:
+                    ui.download_button(
+                        label="Download Output in ZIP",
+                        data=output_zip_file,
+                        file_name=output_zip_name,
+                        mime="application/zip"
+                    )
+                with ui.expander("Performance details"):
+                    ui.json(finish_metrics(metrics))
+ 
+        # At the end of processing, show the "Processing completed" status only if no errors occurred.
+        if not error_occurred:
+            total_time = time.time() - stats["start_time"]
+            ui.success(f"Processing completed in {total_time:.1f} seconds. Highlight annotations: {stats['highlight']}, Mask annotations: {stats['mask']}.")
+ 
     # Use the "Generate" button value as our submission trigger.
     submit = generate_button
+    job_id = session_job_id("ESIC")
  
     if submit:
         if selected_month == "-- Select Month --":
             st.error("Please select month before proceeding.")
             st.stop()
-
+ 
         if not selected_month:
             st.error("Please select month before proceeding.")
             st.stop()
-
+ 
         if pdf_files and excel_file:
             # Duplicate PDF check using file names.
             file_names = [pdf.name for pdf in pdf_files]
             if len(file_names) != len(set(file_names)):
                 st.error("Duplicate PDF files detected. Please upload only unique PDF files.")
-                error_occurred = True
                 st.stop()
-            try:
-                df = pd.read_excel(excel_file)
-                df['ESINO'] = df['ESINO'].fillna(0).astype(np.int64).astype(str)
-                unit_esino_dict = {}
-                for _, row in df.iterrows():
-                    unit = row['UNIT']
-                    esino = row['ESINO']
-                    if unit not in unit_esino_dict:
-                        unit_esino_dict[unit] = []
-                    unit_esino_dict[unit].append(esino)
-                # Track whether each unit gets any highlight annotation
-                unit_highlights = {unit: False for unit in unit_esino_dict.keys()}
-                # Track matched ESINO numbers for each unit
-                unit_matched = {unit: set() for unit in unit_esino_dict.keys()}
-            except Exception as e:
-                st.error("❌ Error reading Excel file. Please ensure it has 'UNIT' and 'ESINO' columns.")
-                st.error(e)
-                error_occurred = True
+ 
+            # Each PDF is copied to disk once (hashed on the way); the run only keeps the paths.
+            pdf_uploads = spool_uploads(pdf_files)
+ 
+            # Result cache: same files and options as an earlier run return its ZIP at once.
+            result_key = cache_key(
+                "ESIC",
+                *[pdf["sha256"] for pdf in pdf_uploads],
+                content_hash(excel_file.getvalue()),
+                mode, page_mode, output_mode, selected_month, selected_year
+            )
+            cached_zip_path = cache_get("results", result_key)
+            if cached_zip_path is not None:
+                st.success("These files were already processed with the same options. Returning the previous output.")
+                st.download_button(
+                    label="Download Output in ZIP",
+                    data=deferred_file(cached_zip_path),
+                    file_name=f"{selected_month}-{selected_year}.zip",
+                    mime="application/zip"
+                )
                 st.stop()
+ 
+            # Run in the background: the page polls the job and shows its results.
+            if job_id and is_job_active(job_id):
+                st.warning("An ESIC run of this session is still in progress. Please wait for it to finish.")
             else:
-                all_unit_files = {}
-                for pdf in pdf_files:
-                    unit_pdfs = process_pdf(pdf, unit_esino_dict, mode, page_mode, stats, progress_bar, status_text, unit_highlights, unit_matched)
-                    for unit, new_doc in unit_pdfs.items():
-                        if new_doc.page_count > 0:
-                            pdf_bytes = new_doc.write()
-                            new_doc.close()
-                            all_unit_files.setdefault(unit, []).append(
-                                fitz.open(stream=pdf_bytes, filetype="pdf")
-                            )
-                total_time = time.time() - stats["start_time"]
-                # Do not show the "processing completed" message yet.
- 
-                # Create nested folder structure inside a ZIP.
-                unit_zip_data = {}
- 
-                for unit, doc_list in all_unit_files.items():
-                    # Skip units with no highlights
-                    if not unit_highlights.get(unit, False):
-                        continue
-                    if doc_list:
-                        merged_pdf = fitz.open()
-                        for doc_obj in doc_list:
-                            merged_pdf.insert_pdf(doc_obj)
-                            doc_obj.close()
-                        pdf_bytes = merged_pdf.write()
-                        merged_pdf.close()
- 
-                        # Prepare Excel files for matched/unmatched
-                        unit_df = df[df['UNIT'] == unit]
-                        matched_df = unit_df[unit_df['ESINO'].isin(unit_matched[unit])]
-                        unmatched_df = unit_df[~unit_df['ESINO'].isin(unit_matched[unit])]
- 
-                        desired_cols = [
-                            "SNO", "EMP CODE", "EMP NAME", "BRANCH", "BRANCH 1", "UNIT", "STATE", "ESINO"
-                        ]
-                        desired_cols_filtered = [col for col in desired_cols if col in df.columns]
-                        matched_df = matched_df[desired_cols_filtered]
-                        unmatched_df = unmatched_df[desired_cols_filtered]
- 
-                        match_buffer = io.BytesIO()
-                        with pd.ExcelWriter(match_buffer, engine='xlsxwriter') as writer:
-                            matched_df.to_excel(writer, index=False)
-                        match_buffer.seek(0)
- 
-                        unmatch_buffer = io.BytesIO()
-                        with pd.ExcelWriter(unmatch_buffer, engine='xlsxwriter') as writer:
-                            unmatched_df.to_excel(writer, index=False)
-                        unmatch_buffer.seek(0)
- 
-                        unit_zip_buffer = io.BytesIO()
-                        with zipfile.ZipFile(unit_zip_buffer, "w", zipfile.ZIP_DEFLATED) as unit_zip:
-                            unit_zip.writestr(f"{unit}_ESINO.pdf", pdf_bytes)
-                            unit_zip.writestr(f"{unit}_Matched.xlsx", match_buffer.getvalue())
-                            unit_zip.writestr(f"{unit}_Unmatched.xlsx", unmatch_buffer.getvalue())
-                        unit_zip_buffer.seek(0)
-                        unit_zip_data[unit] = unit_zip_buffer.getvalue()
- 
-                if not unit_zip_data:
-                    st.error("Mismatch: PDF & Excel file data not matching. Please upload proper data.")
-                    error_occurred = True
+                new_job_id = submit_job(
+                    "ESIC", f"ESIC {selected_month}-{selected_year}",
+                    sum(pdf["size"] for pdf in pdf_uploads) + excel_file.size,
+                    generate_outputs, pdf_uploads, excel_file, result_key,
+                    dedupe_key=result_key
+                )
+                if new_job_id is None:
+                    st.error("Too many runs are waiting to be processed. Please try again in a few minutes.")
                 else:
-                    zip_buffer_all = io.BytesIO()
-                    with zipfile.ZipFile(zip_buffer_all, "w", zipfile.ZIP_DEFLATED) as master_zip:
-                        for unit, zip_bytes in unit_zip_data.items():
-                            master_zip.writestr(f"{unit}.zip", zip_bytes)
-                    zip_buffer_all.seek(0)
- 
-                    # ---------------- S3 UPLOAD FUNCTIONALITY ----------------
-                    try:
-                        s3_client = boto3.client(
-                            's3',
-                            aws_access_key_id=AWS_ACCESS_KEY,
-                            aws_secret_access_key=AWS_SECRET_KEY
-                        )
-                        unit_pdf_data = {}
-                        unit_excel_data = {}
-                        for unit, zip_data in unit_zip_data.items():
-                            zip_file = zipfile.ZipFile(io.BytesIO(zip_data))
-                            pdf_bytes = zip_file.read(f"{unit}_ESINO.pdf")
-                            matched_bytes = zip_file.read(f"{unit}_Matched.xlsx")
-                            unmatched_bytes = zip_file.read(f"{unit}_Unmatched.xlsx")
-                            unit_pdf_data[unit] = pdf_bytes
-                            unit_excel_data[unit] = (matched_bytes, unmatched_bytes)
-                        for unit, pdf_bytes in unit_pdf_data.items():
-                            s3_client.upload_fileobj(
-                                io.BytesIO(pdf_bytes),
-                                S3_BUCKET_NAME,
-                                f"{S3_FOLDER}{selected_month}-{selected_year}/{unit}/{unit}_ESINO.pdf"
-                            )
-                            if unit in unit_excel_data:
-                                matched_bytes, unmatched_bytes = unit_excel_data[unit]
-                                s3_client.upload_fileobj(
-                                    io.BytesIO(matched_bytes),
-                                    S3_BUCKET_NAME,
-                                    f"{S3_FOLDER}{selected_month}-{selected_year}/{unit}/{unit}_Matched.xlsx"
-                                )
-                                s3_client.upload_fileobj(
-                                    io.BytesIO(unmatched_bytes),
-                                    S3_BUCKET_NAME,
-                                    f"{S3_FOLDER}{selected_month}-{selected_year}/{unit}/{unit}_Unmatched.xlsx"
-                                )
-                        st.success(f"Data processed & generated files are archived for future use.")
-                    except NoCredentialsError:
-                        st.error("AWS credentials not found. Could not upload to S3.")
-                        error_occurred = True
-                    except Exception as e:
-                        st.error(f"Failed to upload to S3: {e}")
-                        error_occurred = True
-                    # ---------------------------------------------------------
- 
-                    output_zip_name = f"{selected_month}-{selected_year}.zip"
-                    st.download_button(
-                        label="Download Output in ZIP",
-                        data=zip_buffer_all.getvalue(),
-                        file_name=output_zip_name,
-                        mime="application/zip"
-                    )
+                    job_id = new_job_id
+                    remember_job("ESIC", job_id)
         else:
             st.info("ℹ️ Please upload the PDF(s) and the Excel file using the file uploaders above.")
  
-        # At the end of processing, show the "Processing completed" status only if no errors occurred.
-        if not error_occurred:
-            total_time = time.time() - stats["start_time"]
-            st.success(f"Processing completed in {total_time:.1f} seconds. Highlight annotations: {stats['highlight']}, Mask annotations: {stats['mask']}.")
- 
- 
\ No newline at end of file
+    # Latest job of this session (also after a rerun or a reconnect), refreshed until it ends.
+    if job_id and show_job(job_id):
+        poll_job(job_id)
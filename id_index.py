@@ -0,0 +1,36 @@
+def build_id_index(unit_id_dict):
+    """
+    Inverts a { unit: [identifiers] } roster mapping into { identifier: [units] }.
+    An identifier listed under several units maps to all of them, in roster order.
+    Built once per run so that every word on every page costs a single hash lookup,
+    whatever the number of units or employees.
+    """
+    id_index = {}
+    for unit, identifiers in unit_id_dict.items():
+        for identifier in identifiers:
+            units = id_index.setdefault(identifier, [])
+            if not units or units[-1] != unit:
+                units.append(unit)
+    return id_index
+
+
+def scan_page_words(words, id_index, id_regex):
+    """
+    Scans the words of one page exactly once.
+
+    Returns a tuple:
+        (candidates, unit_hits)
+          - candidates: indices of words whose text fully matches id_regex
+          - unit_hits:  { unit: [indices of candidate words found in that unit's roster] }
+                        (units without a hit on the page are absent)
+    """
+    candidates = []
+    unit_hits = {}
+    for w_idx, w in enumerate(words):
+        word_text = w[4]
+        if not id_regex.fullmatch(word_text):
+            continue
+        candidates.append(w_idx)
+        for unit in id_index.get(word_text, ()):
+            unit_hits.setdefault(unit, []).append(w_idx)
+    return candidates, unit_hits
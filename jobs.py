@@ -0,0 +1,368 @@
+import contextlib
+import heapq
+import itertools
+import os
+import threading
+import time
+import traceback
+import uuid
+from types import SimpleNamespace
+
+from disk_cache import cache_dir, env_bytes, env_int, env_seconds
+
+# Background jobs: PF, ESIC and Bank runs are queued here instead of running inside the
+# Streamlit script, so reruns and reconnects do not lose them and every session shares the
+# same worker. Jobs run one at a time, in a single worker thread: every section opens and
+# writes PDFs with PyMuPDF in the job itself, and PyMuPDF is not thread-safe (a second job
+# thread would not add CPU either, because of the GIL). Parallel work happens in processes
+# (Bank's worker pool). Settings (.env file):
+#   JOB_MAX_QUEUED               jobs waiting at most; Generate is refused beyond that (default 8)
+#   JOB_RETENTION_SECONDS        finished jobs (and their results) kept for this long (default 6 h)
+#   JOB_AGING_BYTES_PER_SECOND   cost a queued job loses per second waited (default 2 MB)
+DEFAULT_JOB_MAX_QUEUED = 8
+DEFAULT_JOB_RETENTION_SECONDS = 6 * 3600
+DEFAULT_JOB_AGING_BYTES_PER_SECOND = 2 * 1024 ** 2
+# Seconds between two status refreshes of a page showing an unfinished job.
+JOB_POLL_SECONDS = 1
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+ACTIVE_JOB_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+
+# job id -> job dict (see submit_job). Shared by every session of this process.
+_jobs = {}
+# Heap of (priority, submission order, job id): the waiting job with the smallest cost minus
+# aging for the time it waited runs first. With the same aging rate for every job, that order
+# never changes while they wait, so the priority is fixed at submission (see submit_job).
+_queue = []
+_sequence = itertools.count()
+_jobs_lock = threading.Condition()
+_worker = None
+
+
+class JobStopped(Exception):
+    """Raised by ui.stop() inside a job: the job ends there, like st.stop() ends a script run."""
+
+
+def job_max_queued():
+    """Number of jobs allowed to wait for a worker."""
+    max_queued = env_int("JOB_MAX_QUEUED", DEFAULT_JOB_MAX_QUEUED)
+    return max_queued if max_queued > 0 else DEFAULT_JOB_MAX_QUEUED
+
+
+def job_retention_seconds():
+    """Seconds a finished job is kept."""
+    return env_seconds("JOB_RETENTION_SECONDS", DEFAULT_JOB_RETENTION_SECONDS)
+
+
+def job_aging_bytes_per_second():
+    """Cost a queued job loses for every second it waits, so large jobs are not starved."""
+    return env_bytes("JOB_AGING_BYTES_PER_SECOND", DEFAULT_JOB_AGING_BYTES_PER_SECOND)
+
+
+def _prune_jobs():
+    """Drops the finished jobs older than JOB_RETENTION_SECONDS (caller holds _jobs_lock)."""
+    oldest = time.time() - job_retention_seconds()
+    for job_id, job in list(_jobs.items()):
+        if job["status"] not in ACTIVE_JOB_STATUSES and job["finished"] < oldest:
+            for path in job["owned_files"]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            del _jobs[job_id]
+
+
+def _start_worker():
+    """Starts the worker thread unless it is running (caller holds _jobs_lock)."""
+    global _worker
+    if _worker is None or not _worker.is_alive():
+        _worker = threading.Thread(target=_run_jobs, name="job-worker", daemon=True)
+        _worker.start()
+
+
+def _run_jobs():
+    """Worker loop: runs the queued job with the smallest priority, forever."""
+    while True:
+        with _jobs_lock:
+            while not _queue:
+                _jobs_lock.wait()
+            _, _, job_id = heapq.heappop(_queue)
+            job = _jobs[job_id]
+            job["status"] = JOB_RUNNING
+            job["started"] = time.time()
+        target, args = job.pop("target"), job.pop("args")
+        status = JOB_FAILED
+        try:
+            target(job_ui(job), *args)
+            status = JOB_DONE
+        except JobStopped:
+            status = JOB_DONE
+        except BaseException as e:
+            # Anything escaping the job (SystemExit included) fails the job, not the worker.
+            job["error"] = str(e) or type(e).__name__
+            job["traceback"] = traceback.format_exc()
+        finally:
+            if status == JOB_DONE and job["cancel"].is_set():
+                status = JOB_CANCELLED
+            with _jobs_lock:
+                job["status"] = status
+                job["progress"] = None
+                job["finished"] = time.time()
+
+
+def submit_job(section, label, cost, target, *args, dedupe_key=None):
+    """
+    Queues target(ui, *args) and returns the job id. ui (see job_ui) stands in for streamlit
+    inside the job; what the job shows is recorded and replayed by show_job.
+
+    cost orders the queue: the job with the smallest cost (e.g. bytes uploaded) runs first,
+    ties in submission order, and a waiting job's cost drops by JOB_AGING_BYTES_PER_SECOND
+    for every second it waited, so a stream of small jobs cannot hold back a large one. A job with the same dedupe_key still queued or running is
+    returned instead of queuing the same work twice.
+    Returns None when JOB_MAX_QUEUED jobs are already waiting.
+    """
+    with _jobs_lock:
+        _prune_jobs()
+        if dedupe_key is not None:
+            for job in _jobs.values():
+                if job["dedupe_key"] == dedupe_key and job["status"] in ACTIVE_JOB_STATUSES:
+                    return job["id"]
+        if len(_queue) >= job_max_queued():
+            return None
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {
+            "id": job_id,
+            "section": section,
+            "label": label,
+            "cost": cost,
+            "dedupe_key": dedupe_key,
+            "status": JOB_QUEUED,
+            "submitted": time.time(),
+            "started": None,
+            "finished": None,
+            "progress": None,
+            "status_text": "",
+            "events": [],
+            "owned_files": [],
+            "error": None,
+            "traceback": None,
+            "cancel": threading.Event(),
+            "cancel_flag": os.path.join(cache_dir("jobs"), f"{job_id}.cancel"),
+            "target": target,
+            "args": args,
+        }
+        # cost - aging * (now - submitted) compares like cost + aging * submitted.
+        priority = cost + job_aging_bytes_per_second() * time.monotonic()
+        heapq.heappush(_queue, (priority, next(_sequence), job_id))
+        _start_worker()
+        _jobs_lock.notify()
+    return job_id
+
+
+def get_job(job_id):
+    """A copy of the job (without its callable), or None when unknown or no longer kept."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        snapshot = {name: value for name, value in job.items() if name not in ("target", "args", "cancel")}
+        snapshot["cancel_requested"] = job["cancel"].is_set()
+        snapshot["events"] = list(job["events"])
+        if job["status"] == JOB_QUEUED:
+            own_entry = next(entry for entry in _queue if entry[2] == job_id)
+            snapshot["ahead"] = sum(1 for entry in _queue if entry < own_entry)
+        return snapshot
+
+
+def cancel_job(job_id):
+    """
+    Cancels a job. A queued job is dropped at once. A running job is asked to stop: ui.cancelled()
+    turns true and its cancel flag file (ui.cancel_flag_path, for worker processes) is created;
+    the job stops at its next page boundary and shows what it completed until then.
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None or job["status"] not in ACTIVE_JOB_STATUSES:
+            return
+        if job["status"] == JOB_QUEUED:
+            _queue[:] = [entry for entry in _queue if entry[2] != job_id]
+            heapq.heapify(_queue)
+            job.pop("target")
+            job.pop("args")
+            job["status"] = JOB_CANCELLED
+            job["finished"] = time.time()
+            return
+        job["cancel"].set()
+        with open(job["cancel_flag"], "w"):
+            pass
+        job["owned_files"].append(job["cancel_flag"])
+
+
+def is_job_active(job_id):
+    """True while the job is queued or running."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return job is not None and job["status"] in ACTIVE_JOB_STATUSES
+
+
+def job_counts():
+    """{ "queued": waiting jobs, "running": jobs being run } across every session."""
+    with _jobs_lock:
+        return {
+            JOB_QUEUED: sum(1 for job in _jobs.values() if job["status"] == JOB_QUEUED),
+            JOB_RUNNING: sum(1 for job in _jobs.values() if job["status"] == JOB_RUNNING),
+        }
+
+
+def job_ui(job):
+    """
+    The streamlit calls a section makes while generating, recorded into the job instead:
+    error / warning / success / info, progress and empty placeholders (progress(), text(),
+    empty()), download_button (an open file is kept by path, bytes are written to disk),
+    expander + json, and stop (raises JobStopped).
+    Jobs check ui.cancelled() at page boundaries (see cancel_job); code running in worker
+    processes checks whether the file ui.cancel_flag_path exists instead.
+    """
+    expander_label = [None]
+
+    def record(kind, *payload):
+        with _jobs_lock:
+            job["events"].append((kind, *payload))
+
+    def set_progress(value, text=None):
+        job["progress"] = value
+
+    def set_status_text(text):
+        job["status_text"] = str(text)
+
+    def clear():
+        job["progress"] = None
+        job["status_text"] = ""
+
+    placeholder = SimpleNamespace(progress=set_progress, text=set_status_text, empty=clear)
+
+    def progress(value=0, text=None):
+        set_progress(value)
+        return placeholder
+
+    def download_button(label, data, file_name, mime=None, **_):
+        path = getattr(data, "name", None)
+        if not isinstance(path, str):
+            path = os.path.join(cache_dir("jobs"), f"{job['id']}-{len(job['owned_files'])}")
+            with open(path, "wb") as f:
+                f.write(data if isinstance(data, bytes) else data.getvalue())
+            job["owned_files"].append(path)
+        record("download", label, path, file_name, mime)
+
+    @contextlib.contextmanager
+    def expander(label, **_):
+        expander_label[0] = label
+        try:
+            yield
+        finally:
+            expander_label[0] = None
+
+    def stop():
+        raise JobStopped()
+
+    return SimpleNamespace(
+        error=lambda message: record("error", str(message)),
+        warning=lambda message: record("warning", str(message)),
+        success=lambda message: record("success", str(message)),
+        info=lambda message: record("info", str(message)),
+        progress=progress,
+        empty=lambda: placeholder,
+        download_button=download_button,
+        expander=expander,
+        json=lambda value: record("json", expander_label[0], value),
+        stop=stop,
+        cancelled=job["cancel"].is_set,
+        cancel_flag_path=job["cancel_flag"],
+    )
+
+
+def session_job_id(section):
+    """Id of the section's latest job in this browser session (kept in the URL across reconnects)."""
+    import streamlit as st
+    param = f"{section.lower()}_job"
+    job_id = st.session_state.get(param) or st.query_params.get(param)
+    if job_id:
+        st.session_state[param] = job_id
+    return job_id
+
+
+def remember_job(section, job_id):
+    """Makes job_id the section's latest job for this session (see session_job_id)."""
+    import streamlit as st
+    param = f"{section.lower()}_job"
+    st.session_state[param] = job_id
+    st.query_params[param] = job_id
+
+
+def deferred_file(path):
+    """
+    data for st.download_button that reads the file at path only when the button is clicked:
+    reruns showing the button do not load the whole file into memory.
+    """
+    def read():
+        with open(path, "rb") as f:
+            return f.read()
+    return read
+
+
+def show_job(job_id):
+    """
+    Shows a job: its place in the queue, its progress while it runs, then everything it
+    recorded (messages, downloads, details). Returns True while the job is unfinished;
+    the caller then polls with poll_job once the rest of the page is drawn.
+    """
+    import streamlit as st
+    job = get_job(job_id)
+    if job is None:
+        return False
+    if job["status"] in ACTIVE_JOB_STATUSES and not job["cancel_requested"]:
+        if st.button("⏹ Cancel", key=f"cancel-{job_id}"):
+            cancel_job(job_id)
+            job = get_job(job_id)
+    if job["cancel_requested"] and job["status"] == JOB_RUNNING:
+        st.info("⏹ Cancelling: processing stops at the next page and keeps the files already finished.")
+    if job["status"] == JOB_QUEUED:
+        st.info(f"⏳ {job['label']} is queued ({job['ahead']} job(s) ahead). You can leave this page open or come back later.")
+    elif job["status"] == JOB_RUNNING:
+        st.progress(min(max(job["progress"] or 0.0, 0.0), 1.0))
+    if job["status_text"]:
+        st.text(job["status_text"])
+
+    for position, (kind, *payload) in enumerate(job["events"]):
+        if kind == "download":
+            label, path, file_name, mime = payload
+            if not os.path.exists(path):
+                st.warning(f"{file_name} is no longer kept on the server. Please generate it again.")
+                continue
+            st.download_button(
+                label=label, data=deferred_file(path), file_name=file_name, mime=mime, key=f"{job_id}-{position}"
+            )
+        elif kind == "json":
+            label, value = payload
+            with st.expander(label or "Details"):
+                st.json(value)
+        else:
+            getattr(st, kind)(payload[0])
+
+    if job["status"] == JOB_CANCELLED and not job["events"]:
+        st.warning("⏹ The run was cancelled before it started.")
+    if job["status"] == JOB_FAILED:
+        st.error(f"❌ Processing failed: {job['error']}")
+        with st.expander("Error details"):
+            st.code(job["traceback"])
+    return job["status"] in ACTIVE_JOB_STATUSES
+
+
+def poll_job(job_id):
+    """Reruns the page after JOB_POLL_SECONDS while the job is unfinished."""
+    import streamlit as st
+    if is_job_active(job_id):
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
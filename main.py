@@ -6,6 +6,7 @@ import bank_full_code
 import esic_full_code
 import archive_full_code
 import base64
+from jobs import job_counts
 from streamlit_cookies_manager import EncryptedCookieManager
  
 # ---------- CSS ---------- #
@@ -151,6 +152,11 @@ def show_sidebar():
         selected_option = st.radio("Select Section", list(options.keys()))
         st.session_state.selected_section = options[selected_option]
  
+        # Generate runs of every user share the same job worker (see jobs.py).
+        counts = job_counts()
+        if counts["running"] or counts["queued"]:
+            st.caption(f"⚙️ Processing: {counts['running']} running, {counts['queued']} queued")
+ 
         st.markdown("---")
         if st.button("LOGOUT"):
             st.session_state.authenticated = False
@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from disk_cache import content_hash
+
+# Every month folder of the archive ("PF/March-2025/") gets one manifest object describing
+# what the runs uploaded there, so the Archive can show a month from a single GET.
+MANIFEST_NAME = "_manifest.json"
+MANIFEST_VERSION = 1
+# A manifest is rewritten conditionally (If-Match the ETag read, or If-None-Match when there was
+# none), so two runs of the same month never drop each other's units; a run that loses the race
+# reads the manifest again and retries, up to this many times.
+MANIFEST_WRITE_ATTEMPTS = 5
+# Precondition failures of a conditional put (412) and conflicting concurrent puts (409).
+CONDITIONAL_WRITE_CONFLICTS = ("PreconditionFailed", "ConditionalRequestConflict")
+
+# (bucket, month prefix) -> lock: runs of this process write a month's manifest one at a time.
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+
+def manifest_key(month_prefix):
+    """S3 key of the manifest of a month folder ("PF/March-2025/")."""
+    return f"{month_prefix}{MANIFEST_NAME}"
+
+
+def start_manifest(section, month_prefix):
+    """New, empty manifest of one run of a section into month_prefix."""
+    return {"version": MANIFEST_VERSION, "section": section, "prefix": month_prefix, "units": {}}
+
+
+def add_manifest_unit(manifest, unit, files, **stats):
+    """
+    Records one uploaded unit. files maps S3 keys to the bytes uploaded there (hashed here);
+    stats are the unit's figures (e.g. matched=, unmatched=, pages=).
+    """
+    manifest["units"][unit] = {
+        **stats,
+        "files": {
+            key.rsplit("/", 1)[-1]: {"key": key, "size": len(data), "sha256": content_hash(data)}
+            for key, data in files.items()
+        },
+    }
+
+
+def _get_manifest(s3_client, bucket, month_prefix):
+    """(manifest or None, ETag or None) of a month folder; the ETag is None when there is no object."""
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=manifest_key(month_prefix))
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None, None
+        raise
+    manifest = json.loads(response["Body"].read())
+    return (manifest if manifest.get("version") == MANIFEST_VERSION else None), response["ETag"]
+
+
+def read_manifest(s3_client, bucket, month_prefix):
+    """The manifest of a month folder, or None when it has none (or one of another version)."""
+    return _get_manifest(s3_client, bucket, month_prefix)[0]
+
+
+def _month_write_lock(bucket, month_prefix):
+    with _write_locks_lock:
+        return _write_locks.setdefault((bucket, month_prefix), threading.Lock())
+
+
+def write_manifest(s3_client, bucket, manifest):
+    """
+    Writes a run's manifest, merged into the month's existing one: units of earlier runs stay,
+    units uploaded again by this run are replaced. Returns the manifest written.
+    The put only succeeds if the manifest is still the one merged into; otherwise (another
+    server wrote it in between) it is read, merged and put again, MANIFEST_WRITE_ATTEMPTS times
+    at most, after which the conflict is raised.
+    """
+    with _month_write_lock(bucket, manifest["prefix"]):
+        for attempt in range(MANIFEST_WRITE_ATTEMPTS):
+            existing, etag = _get_manifest(s3_client, bucket, manifest["prefix"])
+            units = dict(existing["units"]) if existing else {}
+            units.update(manifest["units"])
+            merged = {
+                **manifest,
+                "written": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "units": dict(sorted(units.items())),
+            }
+            condition = {"IfMatch": etag} if etag is not None else {"IfNoneMatch": "*"}
+            try:
+                s3_client.put_object(
+                    Bucket=bucket,
+                    Key=manifest_key(manifest["prefix"]),
+                    Body=json.dumps(merged, separators=(",", ":")).encode("utf-8"),
+                    ContentType="application/json",
+                    **condition,
+                )
+                return merged
+            except ClientError as e:
+                conflict = e.response.get("Error", {}).get("Code") in CONDITIONAL_WRITE_CONFLICTS
+                if not conflict or attempt == MANIFEST_WRITE_ATTEMPTS - 1:
+                    raise
+                time.sleep(0.2 * (attempt + 1))
+
@@ -0,0 +1,165 @@
+import contextlib
+import json
+import os
+import tempfile
+import time
+
+from disk_cache import cache_root
+
+# Stages timed by the processors, in pipeline order (the summary lists them in this order).
+STAGES = [
+    "excel_load",        # roster read + unit mapping / identifier index
+    "pdf_open",          # opening uploaded PDFs
+    "text_extraction",   # page words (PyMuPDF or the word cache)
+    "matching",          # identifier matching and page selection
+    "page_copy",         # copying selected pages into unit documents
+    "annotation",        # drawing highlights / masks
+    "pdf_write",         # Document.write of unit documents
+    "unit_spill",        # appending unit parts to on-disk PDFs (over the output memory budget)
+    "unit_merge",        # merging each unit's parts
+    "excel_report",      # Matched / Unmatched workbooks
+    "zip",               # writing the output ZIP
+    "s3_upload",         # first upload start to last upload end (overlaps the stages above)
+    "s3_wait",           # time the run waited for uploads after the last unit
+]
+
+# Counters reported per second of total run time.
+RATE_COUNTERS = ["pages", "words", "marks"]
+
+
+def metrics_dir():
+    """Folder of the metrics files (METRICS_DIR in the .env file)."""
+    return os.getenv("METRICS_DIR", os.path.join(cache_root(), "metrics"))
+
+
+def start_metrics(section):
+    """New, empty metrics of one run of a section ("PF", "ESIC", "Bank")."""
+    return {"section": section, "started": time.perf_counter(), "stages": {}, "counters": {}}
+
+
+def add_time(metrics, stage_name, seconds):
+    """Adds seconds to a stage. metrics may be None (nothing is recorded)."""
+    if metrics is not None:
+        metrics["stages"][stage_name] = metrics["stages"].get(stage_name, 0.0) + seconds
+
+
+def count(metrics, name, n=1):
+    """Adds n to a counter. metrics may be None (nothing is recorded)."""
+    if metrics is not None:
+        metrics["counters"][name] = metrics["counters"].get(name, 0) + n
+
+
+@contextlib.contextmanager
+def stage(metrics, stage_name):
+    """Times the with block into a stage (nothing is recorded when metrics is None)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(metrics, stage_name, time.perf_counter() - started)
+
+
+def merge_metrics(metrics, other):
+    """
+    Adds the stages and counters of other (e.g. returned by a worker process) into metrics.
+    Stage times of parallel workers add up, so they can exceed the run's wall time.
+    """
+    for stage_name, seconds in other["stages"].items():
+        add_time(metrics, stage_name, seconds)
+    for name, n in other["counters"].items():
+        count(metrics, name, n)
+
+
+def metrics_summary(metrics):
+    """
+    Structured view of a run:
+        {
+          "section":  section name,
+          "seconds":  wall time since start_metrics,
+          "stages":   { stage: seconds }        (known stages first, in pipeline order),
+          "counters": { name: value },
+          "rates":    { "<counter>_per_second": value }
+        }
+    """
+    seconds = time.perf_counter() - metrics["started"]
+    order = STAGES + sorted(set(metrics["stages"]) - set(STAGES))
+    counters = dict(sorted(metrics["counters"].items()))
+    return {
+        "section": metrics["section"],
+        "seconds": round(seconds, 3),
+        "stages": {name: round(metrics["stages"][name], 3) for name in order if name in metrics["stages"]},
+        "counters": counters,
+        "rates": {
+            f"{name}_per_second": round(counters[name] / seconds, 1) if seconds > 0 else 0.0
+            for name in RATE_COUNTERS if name in counters
+        },
+    }
+
+
+def prometheus_text(summary):
+    """Prometheus text exposition (textfile collector format) of a metrics_summary."""
+    section = summary["section"]
+    lines = [
+        "# HELP core_integra_run_seconds Wall time of the last run.",
+        "# TYPE core_integra_run_seconds gauge",
+        f'core_integra_run_seconds{{section="{section}"}} {summary["seconds"]}',
+        "# HELP core_integra_run_timestamp_seconds Unix time the last run finished.",
+        "# TYPE core_integra_run_timestamp_seconds gauge",
+        f'core_integra_run_timestamp_seconds{{section="{section}"}} {int(time.time())}',
+        "# HELP core_integra_stage_seconds Time spent per stage in the last run.",
+        "# TYPE core_integra_stage_seconds gauge",
+    ]
+    for stage_name, seconds in summary["stages"].items():
+        lines.append(f'core_integra_stage_seconds{{section="{section}",stage="{stage_name}"}} {seconds}')
+    lines += [
+        "# HELP core_integra_count Counters of the last run (pages, words, marks, ...).",
+        "# TYPE core_integra_count gauge",
+    ]
+    for name, value in summary["counters"].items():
+        lines.append(f'core_integra_count{{section="{section}",name="{name}"}} {value}')
+    lines += [
+        "# HELP core_integra_rate_per_second Counters per second of wall time in the last run.",
+        "# TYPE core_integra_rate_per_second gauge",
+    ]
+    for name in RATE_COUNTERS:
+        if f"{name}_per_second" in summary["rates"]:
+            value = summary["rates"][f"{name}_per_second"]
+            lines.append(f'core_integra_rate_per_second{{section="{section}",name="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_metrics(summary):
+    """
+    Writes a metrics_summary as <section>.json and <section>.prom in metrics_dir(), replacing
+    the previous run's files (the .prom file suits node_exporter's textfile collector).
+    Returns the two paths.
+    """
+    folder = metrics_dir()
+    os.makedirs(folder, exist_ok=True)
+    name = summary["section"].lower()
+    json_path = os.path.join(folder, f"{name}.json")
+    prom_path = os.path.join(folder, f"{name}.prom")
+    _write_atomic(json_path, json.dumps(summary, indent=2))
+    _write_atomic(prom_path, prometheus_text(summary))
+    return json_path, prom_path
+
+
+def finish_metrics(metrics):
+    """
+    Summarizes a finished run and writes its metrics files.
+    Returns the metrics_summary with "files" (paths written) or "files_error" added;
+    a metrics folder that cannot be written never fails the run.
+    """
+    summary = metrics_summary(metrics)
+    try:
+        summary["files"] = list(write_metrics(summary))
+    except OSError as e:
+        summary["files_error"] = str(e)
+    return summary
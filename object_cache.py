@@ -0,0 +1,84 @@
+import os
+import tempfile
+import threading
+
+from disk_cache import cache_dir, cache_get, cache_key, cache_put_file, env_bytes
+
+# Local read-through cache of archived S3 objects, keyed by bucket + key + ETag, so an object
+# that changed in S3 is never served stale (.env file):
+#   OBJECT_CACHE_MAX_BYTES   byte budget of the cache, least recently used evicted (default 4 GB)
+DEFAULT_OBJECT_CACHE_MAX_BYTES = 4 * 1024 ** 3
+# Lookups of an object before giving up when concurrent misses keep evicting its local copy.
+OBJECT_OPEN_ATTEMPTS = 3
+
+# Hits and misses since the process started, shared by every session.
+_stats = {"hits": 0, "misses": 0, "hit_bytes": 0, "miss_bytes": 0}
+_stats_lock = threading.Lock()
+
+
+def object_cache_max_bytes():
+    """Byte budget of the object cache."""
+    return env_bytes("OBJECT_CACHE_MAX_BYTES", DEFAULT_OBJECT_CACHE_MAX_BYTES)
+
+
+def _record(hit, size):
+    with _stats_lock:
+        _stats["hits" if hit else "misses"] += 1
+        _stats["hit_bytes" if hit else "miss_bytes"] += size
+
+
+def get_cached_object(s3_client, bucket, obj, config=None):
+    """
+    Path of a local copy of obj (a listing entry with Key and ETag), downloaded on a miss with
+    download_file (parallel ranged GETs for large objects, per config). The path may be evicted
+    by misses of other sessions at any time: use open_cached_object to read it.
+    """
+    entry_key = cache_key("s3-object", bucket, obj['Key'], obj.get('ETag', ''))
+    cached_path = cache_get("s3_objects", entry_key)
+    if cached_path is not None:
+        try:
+            _record(True, os.path.getsize(cached_path))
+            return cached_path
+        except FileNotFoundError:
+            pass  # Evicted right after the lookup: a miss.
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir("s3_objects"), suffix=".tmp")
+    os.close(fd)
+    try:
+        s3_client.download_file(bucket, obj['Key'], tmp_path, Config=config)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    _record(False, os.path.getsize(tmp_path))
+    return cache_put_file("s3_objects", entry_key, tmp_path, object_cache_max_bytes())
+
+
+def open_cached_object(s3_client, bucket, obj, config=None, opener=None):
+    """
+    get_cached_object, opened with opener(path) (default: open for binary reading); the open
+    file outlives an eviction. A copy evicted between the lookup and the open (opener raises
+    FileNotFoundError) counts as a miss and is looked up again, OBJECT_OPEN_ATTEMPTS times.
+    """
+    for attempt in range(OBJECT_OPEN_ATTEMPTS):
+        path = get_cached_object(s3_client, bucket, obj, config)
+        try:
+            return opener(path) if opener is not None else open(path, "rb")
+        except FileNotFoundError:
+            if attempt == OBJECT_OPEN_ATTEMPTS - 1:
+                raise
+
+
+def object_cache_stats():
+    """{ "hits", "misses", "hit_bytes", "miss_bytes" } since the process started."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def describe_object_cache_stats(stats):
+    """One-line summary of object_cache_stats for the UI."""
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups * 100 if lookups else 0.0
+    return (
+        f"Local archive cache: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.0f}% hit rate); "
+        f"{stats['hit_bytes'] / 1024 ** 2:.1f} MB served from disk, "
+        f"{stats['miss_bytes'] / 1024 ** 2:.1f} MB downloaded from S3."
+    )
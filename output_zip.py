@@ -0,0 +1,92 @@
+import io
+import os
+import struct
+import tempfile
+import zipfile
+
+from disk_cache import cache_dir, cache_put_file
+
+
+def start_output_zip():
+    """
+    Opens the month's output archive as a temporary file on disk (in the result cache folder).
+    Units are appended one at a time with add_unit_files, so memory holds one unit's files at
+    most, never the whole month. Every entry is ZIP_STORED: PDFs and xlsx workbooks are already
+    compressed, so deflating them again costs time for almost no gain.
+
+    Returns the output state:
+        {
+          "path":   temporary archive path,
+          "zip":    zipfile.ZipFile open for writing,
+          "reader": read-only descriptor of the archive (see read_output_file),
+          "units":  { unit: { file name: archive member } }  (in the order units were added)
+        }
+    """
+    fd, path = tempfile.mkstemp(dir=cache_dir("results"), suffix=".tmp")
+    os.close(fd)
+    output_zip = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True)
+    return {
+        "path": path,
+        "zip": output_zip,
+        "reader": os.open(path, os.O_RDONLY),
+        "units": {},
+    }
+
+
+def add_unit_files(output, unit, folder, files):
+    """
+    Writes one unit's files ({ file name: bytes }) into the folder of the archive
+    (e.g. "<unit>_PF/<unit>_PF.pdf"). The bytes can be dropped by the caller afterwards.
+    """
+    members = {}
+    for file_name, data in files.items():
+        member = f"{folder}/{file_name}"
+        output["zip"].writestr(member, data)
+        members[file_name] = member
+    output["zip"].fp.flush()
+    output["units"][unit] = members
+
+
+def read_output_file(output, unit, file_name):
+    """
+    Returns one file already added to the archive as a BytesIO, read straight from its stored
+    bytes on disk (no ZIP parsing, nothing to decompress). Safe to call from other threads
+    while units are still being added, and after finish_output_zip moved the archive.
+    """
+    info = output["zip"].getinfo(output["units"][unit][file_name])
+    header = os.pread(output["reader"], 30, info.header_offset)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    data_offset = info.header_offset + 30 + name_length + extra_length
+    return io.BytesIO(os.pread(output["reader"], info.file_size, data_offset))
+
+
+def finish_output_zip(output, key, max_bytes):
+    """
+    Closes the archive and stores it in the result cache under key.
+    Returns the archive path, or None (and removes the file) if no unit was added.
+    read_output_file keeps working until close_output_reader is called.
+    """
+    output["zip"].close()
+    if not output["units"]:
+        discard_output_zip(output)
+        return None
+    return cache_put_file("results", key, output["path"], max_bytes)
+
+
+def close_output_reader(output):
+    """Closes the descriptor used by read_output_file (once every upload is done)."""
+    if output["reader"] is not None:
+        os.close(output["reader"])
+        output["reader"] = None
+
+
+def discard_output_zip(output):
+    """Closes and deletes an unfinished archive (e.g. after an error)."""
+    try:
+        output["zip"].close()
+        close_output_reader(output)
+    finally:
+        try:
+            os.remove(output["path"])
+        except FileNotFoundError:
+            pass
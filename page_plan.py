@@ -0,0 +1,115 @@
+import fitz  # PyMuPDF
+
+from id_index import scan_page_words
+from metrics import count, stage
+from word_cache import get_doc_words
+
+
+def scan_pdf(doc, units, id_index, id_regex, relevant_only, on_page=None, metrics=None, cancelled=None,
+             doc_sha256=None):
+    """
+    Scan phase: extracts the words of every page once and decides which units keep each page.
+    Nothing is copied or annotated here. Words of pages seen before come from the word cache.
+
+    Page selection (shared by PF, ESIC and Bank):
+      - relevant_only=False: every page is kept for every unit.
+      - relevant_only=True:  the first and last pages are kept for every unit; any other page
+                             only for the units with at least one roster hit on it.
+
+    on_page(page_number) is called after each page is scanned (progress reporting).
+    metrics (see metrics.py) receives the text_extraction and matching times and the
+    pages / words counters.
+    cancelled (a callable) is checked before each page; once it returns True the scan stops
+    there and the plans cover only the pages scanned so far (the caller drops them).
+    doc_sha256 (the SHA-256 of the source file) lets the word cache serve pages seen before.
+
+    Returns a list with one plan per page:
+        {
+          "number":     page number in the source PDF,
+          "height":     page height,
+          "words":      page.get_text("words") (possibly from the word cache),
+          "candidates": indices of words matching id_regex,
+          "unit_hits":  { unit: [indices of words found in that unit's roster] },
+          "units":      units that keep this page, in roster order
+        }
+    """
+    total_pages = doc.page_count
+    page_plans = []
+    with stage(metrics, "text_extraction"):
+        doc_words = get_doc_words(doc, doc_sha256, cancelled)
+    count(metrics, "pages", total_pages)
+    count(metrics, "words", sum(len(words) for words in doc_words))
+    for page, words in zip(doc, doc_words):
+        if cancelled is not None and cancelled():
+            break
+        with stage(metrics, "matching"):
+            candidates, unit_hits = scan_page_words(words, id_index, id_regex)
+        if relevant_only and page.number not in (0, total_pages - 1):
+            page_units = [unit for unit in units if unit in unit_hits]
+        else:
+            page_units = units
+        page_plans.append({
+            "number": page.number,
+            "height": page.rect.height,
+            "words": words,
+            "candidates": candidates,
+            "unit_hits": unit_hits,
+            "units": page_units,
+        })
+        if on_page is not None:
+            on_page(page.number)
+    return page_plans
+
+
+def has_roster_hits(page_plans):
+    """True if at least one page of the scanned PDF matched any roster identifier."""
+    return any(plan["unit_hits"] for plan in page_plans)
+
+
+def render_unit_pdfs(doc, page_plans, draw_page, metrics=None, page_ids=None, cancelled=None):
+    """
+    Render phase: copies only the selected pages straight into one output document per unit
+    (created on its first page), in source page order, and lets draw_page annotate the copy:
+
+        draw_page(unit, out_page, plan)
+
+    Pages selected by no unit are never copied. Returns { unit: fitz.Document }.
+    metrics (see metrics.py) receives the page_copy and annotation times.
+    page_ids, when given a dict, receives { unit: [identifiers matched on each copied page] },
+    one list per page of the unit's document (see identifier_pages).
+    cancelled (a callable) is checked before each page, like in scan_pdf: the documents are then
+    incomplete and the caller closes them.
+    """
+    unit_pdfs = {}
+    for plan in page_plans:
+        if cancelled is not None and cancelled():
+            break
+        for unit in plan["units"]:
+            if unit not in unit_pdfs:
+                unit_pdfs[unit] = fitz.open()
+            out_doc = unit_pdfs[unit]
+            if page_ids is not None:
+                page_ids.setdefault(unit, []).append(
+                    sorted({plan["words"][w_idx][4] for w_idx in plan["unit_hits"].get(unit, [])})
+                )
+            with stage(metrics, "page_copy"):
+                out_doc.insert_pdf(doc, from_page=plan["number"], to_page=plan["number"])
+            with stage(metrics, "annotation"):
+                draw_page(unit, out_doc[-1], plan)
+    return unit_pdfs
+
+
+def identifier_pages(parts_page_ids):
+    """
+    Pages of every identifier in a unit document merged from several parts, in order.
+    parts_page_ids lists the page_ids of each part (see render_unit_pdfs).
+    Returns { identifier: [page numbers in the merged document, starting at 1] }.
+    """
+    pages = {}
+    page_number = 0
+    for part in parts_page_ids:
+        for identifiers in part:
+            page_number += 1
+            for identifier in identifiers:
+                pages.setdefault(identifier, []).append(page_number)
+    return pages
@@ -0,0 +1,73 @@
+import fitz  # PyMuPDF
+
+# Read-only annotation flag (prevents moving/editing in most PDF viewers)
+ANNOT_FLAG_READONLY = 64
+
+# Output modes offered by every section.
+OUTPUT_ANNOTATIONS = "Annotations"
+OUTPUT_FLATTENED = "Flattened"
+
+# Every kind of mark drawn on an output page: fill/stroke color, opacity, read-only flag.
+MARK_STYLES = {
+    "highlight": {"color": (1, 1, 0), "opacity": 0.3, "readonly": True},        # matched row / id (yellow)
+    "matched": {"color": (1, 1, 1), "opacity": 0.3, "readonly": True},          # matched id in mask mode (white)
+    "mask": {"color": (0.5, 0.5, 0.5), "opacity": 1.0, "readonly": True},       # not relevant (gray)
+    "unit_name": {"color": (1, 1, 0), "opacity": 0.5, "readonly": True},        # Bank: unit name
+    "unit_label": {"color": (0, 0, 1), "opacity": 0.3, "readonly": False},      # ESIC: unit name
+}
+
+
+def draw_marks(page, marks, output_mode):
+    """
+    Draws a page's marks, given as a list of (rect, style) with style a MARK_STYLES key.
+
+    Output modes:
+      - OUTPUT_ANNOTATIONS: one rectangle annotation per mark (editable objects, as before).
+      - OUTPUT_FLATTENED:   every mark is drawn into the page content in a single Shape,
+                            committed once. No annotation objects are created, so files are
+                            smaller and faster to write and merge. As with annotations, masked
+                            text is covered, not removed.
+
+    Paint order, which decides how overlapping highlights and masks look:
+      - OUTPUT_ANNOTATIONS: list order, one mark after the other.
+      - OUTPUT_FLATTENED:   by style, in the order each style first appears in the list; within
+                            a style, in list order. [mask, highlight, mask] paints both masks,
+                            then the highlight over them, where list order would have the
+                            second mask cover the highlight.
+    Returns { style: number of marks }.
+    """
+    counts = {}
+    if not marks:
+        return counts
+
+    if output_mode == OUTPUT_FLATTENED:
+        rects_by_style = {}
+        for rect, style in marks:
+            rects_by_style.setdefault(style, []).append(rect)
+        shape = page.new_shape()
+        for style, rects in rects_by_style.items():
+            spec = MARK_STYLES[style]
+            for rect in rects:
+                shape.draw_rect(rect)
+            shape.finish(
+                color=spec["color"],
+                fill=spec["color"],
+                width=1,
+                stroke_opacity=spec["opacity"],
+                fill_opacity=spec["opacity"],
+            )
+            counts[style] = len(rects)
+        shape.commit(overlay=True)
+        return counts
+
+    for rect, style in marks:
+        spec = MARK_STYLES[style]
+        annot = page.add_rect_annot(fitz.Rect(rect))
+        annot.set_colors(stroke=spec["color"], fill=spec["color"])
+        annot.set_border(width=1)
+        annot.set_opacity(spec["opacity"])
+        if spec["readonly"]:
+            annot.set_flags(ANNOT_FLAG_READONLY)
+        annot.update()
+        counts[style] = counts.get(style, 0) + 1
+    return counts
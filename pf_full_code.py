@@ -1,17 +1,34 @@
 def run_pf_section():
     import streamlit as st
-    import pandas as pd
     import fitz  # PyMuPDF
     import re
-    import io
     import numpy as np  # For int64 conversion
-    import zipfile
     import time  # For timing and progress
-    import boto3
     from botocore.exceptions import NoCredentialsError
     import datetime
+    import functools
     import os
     from dotenv import load_dotenv
+    from id_index import build_id_index
+    from roster import read_roster, build_unit_mapping
+    from reports import iter_unit_reports, matched_flags, unit_match_counts
+    from page_plan import scan_pdf, has_roster_hits, render_unit_pdfs, identifier_pages
+    from pdf_marks import draw_marks, OUTPUT_ANNOTATIONS, OUTPUT_FLATTENED
+    from disk_cache import cache_key, content_hash, cache_get, cache_rename, result_cache_max_bytes
+    from output_zip import (
+        start_output_zip, add_unit_files, read_output_file, finish_output_zip, close_output_reader,
+        discard_output_zip
+    )
+    from metrics import start_metrics, stage, count, add_time, finish_metrics
+    from archive_tree import invalidate_archive_prefix
+    from manifest import start_manifest, add_manifest_unit, write_manifest
+    from s3_upload import start_uploads, submit_upload, cancel_uploads, finish_uploads, describe_upload_stats
+    from checkpoints import open_checkpoints, load_checkpoint, save_checkpoint, clear_checkpoints
+    from jobs import submit_job, is_job_active, session_job_id, remember_job, show_job, poll_job, deferred_file
+    from upload_spool import spool_uploads
+    from unit_parts import (
+        start_unit_parts, add_unit_parts, finish_unit_parts, merge_unit_parts, discard_unit_parts
+    )
  
  
     load_dotenv()
@@ -20,28 +37,28 @@ def run_pf_section():
     S3_BUCKET_NAME = "sanj0908"
     S3_FOLDER = "PF/"  # Optional folder inside the bucket
  
-    # Define a constant for read-only annotations (prevents moving/editing)
-    ANNOT_FLAG_READONLY = 64
- 
     # ----------------------- Streamlit Layout -----------------------
     st.title("PF Statement")
  
     # Step 2: Processing Options
     st.header("Choose Processing Options")
-    # Use 4 columns: first two for processing options, then year and month (with restrictions)
-    col1, col2, col3, col4 = st.columns(4)
+    # Use 5 columns: first three for processing options, then year and month (with restrictions)
+    col1, col2, col3, col4, col5 = st.columns(5)
     with col1:
         mode = st.radio("Select masking mode:", ["Mask all not relevant", "Highlight Relevant"], index=0)
     with col2:
         page_mode = st.radio("Select Page Mode:", ["All Pages", "Relevant Pages"], index=0)
     with col3:
+        # "Flattened" draws all marks of a page into its content at once: smaller, faster PDFs.
+        output_mode = st.radio("Select Output Mode:", [OUTPUT_ANNOTATIONS, OUTPUT_FLATTENED], index=0)
+    with col4:
         # Get current date details
         now = datetime.datetime.now()
         current_year = now.year
         current_month = now.month
         # Limit year selection to current year (no future)
         selected_year = st.number_input("Select Year", min_value=1900, max_value=current_year, step=1, value=current_year)
-    with col4:
+    with col5:
         month_names = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
                        "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
         # If current year is selected, allow only months up to current month.
@@ -58,118 +75,303 @@ def run_pf_section():
 )
  
     # ----------------------- Helper Function -----------------------
-    def process_pdf(pdf_file, unit_uan_dict, mode, page_mode, matched_uan_dict):
-        doc = fitz.open(stream=pdf_file.read(), filetype="pdf")
+    def process_pdf(pdf_file, unit_uan_dict, uan_index, mode, page_mode, output_mode, matched_uan_dict, mark_counts, metrics, page_ids, cancelled=None):
+        """
+        Two phases: scan_pdf reads every page's words once and decides which units keep it;
+        render_unit_pdfs then copies only those pages into each unit's PDF and annotates them.
+        Highlights and masks are drawn by draw_marks in the chosen output mode and counted
+        into mark_counts. Stage timings and counters go to metrics; the UANs found on each
+        copied page go to page_ids (see render_unit_pdfs).
+        pdf_file is a spooled upload (see upload_spool): the PDF is opened from its path, so
+        pages are read from disk as they are needed.
+        cancelled (a callable) stops the scan and render at the next page once it returns True.
+        Returns { unit: fitz.Document }, {} when the PDF has no roster hit at all, or None
+        when cancelled (every document is closed).
+        """
+        with stage(metrics, "pdf_open"):
+            doc = fitz.open(pdf_file["path"], filetype="pdf")
         uan_regex = re.compile(r"\b\d{12,15}\b")
-        total_pages = doc.page_count
  
-        # Create an empty PDF for each unit.
-        unit_pdfs = {unit: fitz.open() for unit in unit_uan_dict.keys()}
-        unit_modified = {unit: False for unit in unit_uan_dict.keys()}
- 
-        for page in doc:
-            words = page.get_text("words")
-            for unit, uan_list in unit_uan_dict.items():
-                # For "Relevant Pages" mode, force first and last pages to be considered relevant.
-                if page_mode == "Relevant Pages":
-                    if page.number in [0, total_pages - 1]:
-                        effective_page_has_unit = True
+        # Scan phase: "All Pages" keeps every page for every unit, "Relevant Pages" keeps the
+        # first and last pages for every unit and any other page only for the units matched on it.
+        page_plans = scan_pdf(
+            doc, list(unit_uan_dict), uan_index, uan_regex, page_mode == "Relevant Pages", metrics=metrics,
+            cancelled=cancelled, doc_sha256=pdf_file["sha256"]
+        )
+        if cancelled is not None and cancelled():
+            doc.close()
+            return None
+        if not has_roster_hits(page_plans):
+            doc.close()
+            return {}
+ 
+        def draw_page(unit, out_page, plan):
+            words = plan["words"]
+            hits = plan["unit_hits"].get(unit, [])
+            marks = []
+            if mode == "Highlight Relevant":
+                for w_idx in hits:
+                    w = words[w_idx]
+                    matched_uan_dict[unit].add(w[4])
+                    # Adjust rectangle dimensions as needed.
+                    marks.append(((w[0]-5, w[1]-718, w[2]+5, w[3]+38), "highlight"))
+            elif mode == "Mask all not relevant":
+                hit_set = set(hits)
+                for w_idx in plan["candidates"]:
+                    w = words[w_idx]
+                    rect = (w[0]-5, w[1]-718, w[2]+5, w[3]+38)
+                    if w_idx in hit_set:
+                        matched_uan_dict[unit].add(w[4])
+                        marks.append((rect, "matched"))
                     else:
-                        effective_page_has_unit = any(
-                            uan_regex.fullmatch(w[4]) and w[4] in uan_list for w in words
+                        marks.append((rect, "mask"))
+            drawn = draw_marks(out_page, marks, output_mode)
+            mark_counts["highlight"] += drawn.get("highlight", 0) + drawn.get("matched", 0)
+            mark_counts["mask"] += drawn.get("mask", 0)
+            count(metrics, "marks", sum(drawn.values()))
+ 
+        # Render phase: only the selected pages are copied, straight into each unit's PDF.
+        unit_pdfs = render_unit_pdfs(
+            doc, page_plans, draw_page, metrics=metrics, page_ids=page_ids, cancelled=cancelled
+        )
+        doc.close()
+        if cancelled is not None and cancelled():
+            for unit_doc in unit_pdfs.values():
+                unit_doc.close()
+            return None
+        return unit_pdfs
+ 
+    # ----------------------- Background Job -----------------------
+    def generate_outputs(ui, pdf_files, excel_file, result_key):
+        """
+        Processes the spooled PDF uploads and the roster and archives the outputs. Runs as a background job
+        (see jobs.py): ui records the messages, progress and downloads shown by show_job.
+        """
+        # Stage timings and counters of this run (shown at the end and written to metrics files).
+        metrics = start_metrics("PF")
+        try:
+            excel_started = time.perf_counter()
+            df = read_roster(excel_file)
+            # Check if required columns are present (use "PF UAN" instead of "UAN")
+            if 'UNIT' not in df.columns or 'PF UAN' not in df.columns:
+                ui.error("The Excel file must contain 'UNIT' and 'PF UAN' columns. Please upload the proper file.")
+            else:
+                # Ensure the PF UAN column is string type.
+                df['PF UAN'] = df['PF UAN'].fillna(0).astype(np.int64).astype(str)
+                # Build a dictionary mapping each UNIT to its list of PF UAN values.
+                unit_uan_dict = build_unit_mapping(df, 'PF UAN')
+                # UAN -> unit(s), built once for all PDFs.
+                uan_index = build_id_index(unit_uan_dict)
+                add_time(metrics, "excel_load", time.perf_counter() - excel_started)
+ 
+                # Initialize a dictionary to track matched UANs per unit.
+                matched_uan_dict = {unit: set() for unit in unit_uan_dict}
+ 
+                # Pages of every unit, kept in memory up to OUTPUT_MEMORY_MAX_BYTES and on disk beyond.
+                all_unit_files = start_unit_parts(metrics)
+                # UANs on each page of every unit part, in the same order (for the archive manifest).
+                all_unit_page_ids = {}
+                progress_bar = ui.progress(0)
+                status_text = ui.empty()
+                total_files = len(pdf_files)
+                # Highlight / mask marks drawn across all PDFs (annotations or flattened).
+                mark_counts = {"highlight": 0, "mask": 0}
+                start_time = time.time()
+ 
+                # Every finished PDF is checkpointed: a retried run with the same files and options
+                # reuses the PDFs already processed and goes on from the first unprocessed one.
+                checkpoints = open_checkpoints(result_key, unit_uan_dict)
+                if checkpoints["done"]:
+                    ui.info(
+                        f"Resuming an interrupted run: {len(checkpoints['done'])} of {total_files} "
+                        f"PDF files were already processed."
+                    )
+ 
+                # Cancel (see jobs.cancel_job) stops the run at the next page; the PDFs finished
+                # before that still make a (partial) output.
+                run_cancelled = False
+                for i, pdf in enumerate(pdf_files):
+                    if ui.cancelled():
+                        run_cancelled = True
+                        break
+                    part = load_checkpoint(checkpoints, i)
+                    if part is None:
+                        status_text.text(f"🔄 Processing file {i+1} of {total_files}: {pdf['name']}")
+                        pdf_page_ids = {}
+                        pdf_matched = {unit: set() for unit in unit_uan_dict}
+                        pdf_mark_counts = {"highlight": 0, "mask": 0}
+                        unit_pdfs = process_pdf(
+                            pdf, unit_uan_dict, uan_index, mode, page_mode, output_mode, pdf_matched, pdf_mark_counts,
+                            metrics, pdf_page_ids, ui.cancelled
                         )
-                else:  # page_mode == "All Pages"
-                    effective_page_has_unit = any(
-                        uan_regex.fullmatch(w[4]) and w[4] in uan_list for w in words
+                        if unit_pdfs is None:
+                            run_cancelled = True
+                            break
+                        count(metrics, "pdfs")
+                        unit_files = {}
+                        for unit, new_doc in unit_pdfs.items():
+                            if new_doc.page_count > 0:
+                                with stage(metrics, "pdf_write"):
+                                    unit_files[unit] = new_doc.write()
+                            new_doc.close()
+                        part = {
+                            "unit_files": unit_files,
+                            "page_ids": {unit: pdf_page_ids[unit] for unit in unit_files},
+                            "matched": pdf_matched,
+                            "counts": pdf_mark_counts,
+                        }
+                        save_checkpoint(checkpoints, i, **part)
+                    else:
+                        status_text.text(f"⏩ File {i+1} of {total_files} was already processed: {pdf['name']}")
+                        count(metrics, "resumed_pdfs")
+ 
+                    if not part["unit_files"]:
+                        ui.warning(f"No PF UAN from the Excel file was found in {pdf['name']}. File skipped.")
+                    for unit, ids in part["matched"].items():
+                        matched_uan_dict[unit].update(ids)
+                    for name in mark_counts:
+                        mark_counts[name] += part["counts"][name]
+                    add_unit_parts(all_unit_files, i, part["unit_files"])
+                    for unit in part["unit_files"]:
+                        all_unit_page_ids.setdefault(unit, []).append(part["page_ids"][unit])
+                    progress_bar.progress((i + 1) / total_files)
+ 
+                if run_cancelled:
+                    ui.warning(
+                        f"⏹ Run cancelled after {i} of {total_files} PDF files. The output below only covers "
+                        f"those files and is not archived to S3. Press Generate again with the same files "
+                        f"and options to continue where it stopped."
                     )
  
-                # Create a temporary document for the current page.
-                temp_doc = fitz.open()
-                temp_doc.insert_pdf(doc, from_page=page.number, to_page=page.number)
-                temp_page = temp_doc[0]
-                modified = False
+                # Additional check: if no files were processed, show an error.
+                output_units = finish_unit_parts(all_unit_files)
+                if not output_units:
+                    discard_unit_parts(all_unit_files)
+                    ui.error("Mismatch: PDF & Excel file data not matching. Please upload proper data.")
+                else:
+                    # Only create a folder for units that have processed documents and at least one matched UAN.
+                    report_units = [unit for unit in output_units if matched_uan_dict[unit]]
+                    # Matched / unmatched Excel files, built a few units at a time as the units are written.
+                    with stage(metrics, "excel_report"):
+                        flags = matched_flags(df, 'PF UAN', matched_uan_dict)
+                        unit_reports = iter_unit_reports(
+                            df, flags, report_units,
+                            ['SNO', 'EMP CODE', 'EMP NAME', 'BRANCH', 'BRANCH 1', 'UNIT', 'STATE', 'PFNO', 'PF UAN']
+                        )
+                        match_counts = unit_match_counts(df, flags)
+                    # Each unit is written to the output ZIP on disk as soon as it is merged, and its
+                    # files go straight onto the S3 upload queue, so uploads run while the next
+                    # units are merged.
+                    month_prefix = f"{S3_FOLDER}{selected_month}-{selected_year}/"
+                    # What is uploaded is also described in the month's archive manifest.
+                    manifest = start_manifest("PF", month_prefix)
+                    output = start_output_zip()
+                    # A cancelled run's partial output is only offered for download.
+                    uploads = None if run_cancelled else start_uploads(AWS_ACCESS_KEY, AWS_SECRET_KEY, S3_BUCKET_NAME)
+                    try:
+                        for unit in report_units:
+                            with stage(metrics, "unit_merge"):
+                                merged_pdf = merge_unit_parts(all_unit_files, unit)
+                            with stage(metrics, "pdf_write"):
+                                merged_bytes = merged_pdf.write()
+                            merged_pages = merged_pdf.page_count
+                            merged_pdf.close()
+                            count(metrics, "units")
+ 
+                            with stage(metrics, "excel_report"):
+                                match_bytes, unmatch_bytes = next(unit_reports)
+                            with stage(metrics, "zip"):
+                                add_unit_files(output, unit, f"{unit}_PF", {
+                                    f"{unit}_PF.pdf": merged_bytes,
+                                    f"{unit}_Match.xlsx": match_bytes,
+                                    f"{unit}_Unmatch.xlsx": unmatch_bytes,
+                                })
+                            matched_rows, unmatched_rows = match_counts.get(unit, (0, 0))
+                            add_manifest_unit(manifest, unit, {
+                                f"{month_prefix}{unit}/{unit}_Processed.pdf": merged_bytes,
+                                f"{month_prefix}{unit}/{unit}_Match.xlsx": match_bytes,
+                                f"{month_prefix}{unit}/{unit}_Unmatch.xlsx": unmatch_bytes,
+                            }, matched=matched_rows, unmatched=unmatched_rows, pages=merged_pages,
+                               pdf=f"{unit}_Processed.pdf", ids=identifier_pages(all_unit_page_ids.pop(unit)))
+                            # Upload individual files for each unit (no zip).
+                            if uploads is not None:
+                                for file_name, s3_name in (
+                                    (f"{unit}_PF.pdf", f"{unit}_Processed.pdf"),
+                                    (f"{unit}_Match.xlsx", f"{unit}_Match.xlsx"),
+                                    (f"{unit}_Unmatch.xlsx", f"{unit}_Unmatch.xlsx"),
+                                ):
+                                    submit_upload(
+                                        uploads,
+                                        f"{month_prefix}{unit}/{s3_name}",
+                                        functools.partial(read_output_file, output, unit, file_name)
+                                    )
+                    except Exception:
+                        if uploads is not None:
+                            cancel_uploads(uploads)
+                        discard_output_zip(output)
+                        raise
+                    finally:
+                        discard_unit_parts(all_unit_files)
+                    # The ZIP only moves to result_key (which Generate returns at once) after the month
+                    # is archived; until then the checkpoints are kept, so a run whose upload failed,
+                    # or that was cancelled, is resumed by pressing Generate again.
+                    if run_cancelled:
+                        output_key = cache_key("PF", "cancelled", result_key, i)
+                    else:
+                        output_key = cache_key("PF", "unarchived", result_key)
+                    with stage(metrics, "zip"):
+                        master_zip_path = finish_output_zip(output, output_key, result_cache_max_bytes())
  
-                if page_mode == "Relevant Pages":
-                    if effective_page_has_unit:
-                        if mode == "Highlight Relevant":
-                            for w in words:
-                                word_text = w[4]
-                                if uan_regex.fullmatch(word_text) and word_text in uan_list:
-                                    matched_uan_dict[unit].add(word_text)
-                                    # Adjust rectangle dimensions as needed.
-                                    x0, y0, x1, y1 = w[0]-5, w[1]-718, w[2]+5, w[3]+38
-                                    rect = fitz.Rect(x0, y0, x1, y1)
-                                    annot = temp_page.add_rect_annot(rect)
-                                    annot.set_colors(stroke=(1, 1, 0), fill=(1, 1, 0))
-                                    annot.set_border(width=1)
-                                    annot.set_opacity(0.3)
-                                    annot.set_flags(ANNOT_FLAG_READONLY)
-                                    annot.update()
-                                    modified = True
-                            # Always include first and last pages.
-                            if page.number in [0, total_pages - 1]:
-                                modified = True
-                        elif mode == "Mask all not relevant":
-                            for w in words:
-                                word_text = w[4]
-                                if uan_regex.fullmatch(word_text):
-                                    x0, y0, x1, y1 = w[0]-5, w[1]-718, w[2]+5, w[3]+38
-                                    rect = fitz.Rect(x0, y0, x1, y1)
-                                    annot = temp_page.add_rect_annot(rect)
-                                    if word_text in uan_list:
-                                        matched_uan_dict[unit].add(word_text)
-                                        annot.set_colors(stroke=(1, 1, 1), fill=(1, 1, 1))
-                                        annot.set_opacity(0.3)
-                                    else:
-                                        annot.set_colors(stroke=(0.5, 0.5, 0.5), fill=(0.5, 0.5, 0.5))
-                                        annot.set_opacity(1)
-                                    annot.set_border(width=1)
-                                    annot.set_flags(ANNOT_FLAG_READONLY)
-                                    annot.update()
-                                    modified = True
-                            if page.number in [0, total_pages - 1]:
-                                modified = True
-                elif page_mode == "All Pages":
-                    if mode == "Highlight Relevant":
-                        for w in words:
-                            word_text = w[4]
-                            if uan_regex.fullmatch(word_text) and word_text in uan_list:
-                                matched_uan_dict[unit].add(word_text)
-                                x0, y0, x1, y1 = w[0]-5, w[1]-718, w[2]+5, w[3]+38
-                                rect = fitz.Rect(x0, y0, x1, y1)
-                                annot = temp_page.add_rect_annot(rect)
-                                annot.set_colors(stroke=(1, 1, 0), fill=(1, 1, 0))
-                                annot.set_border(width=1)
-                                annot.set_opacity(0.3)
-                                annot.set_flags(ANNOT_FLAG_READONLY)
-                                annot.update()
-                        modified = True  # Include every page.
-                    elif mode == "Mask all not relevant":
-                        for w in words:
-                            word_text = w[4]
-                            if uan_regex.fullmatch(word_text):
-                                x0, y0, x1, y1 = w[0]-5, w[1]-718, w[2]+5, w[3]+38
-                                rect = fitz.Rect(x0, y0, x1, y1)
-                                annot = temp_page.add_rect_annot(rect)
-                                if word_text in uan_list:
-                                    matched_uan_dict[unit].add(word_text)
-                                    annot.set_colors(stroke=(1, 1, 1), fill=(1, 1, 1))
-                                    annot.set_opacity(0.3)
-                                else:
-                                    annot.set_colors(stroke=(0.5, 0.5, 0.5), fill=(0.5, 0.5, 0.5))
-                                    annot.set_opacity(1)
-                                annot.set_border(width=1)
-                                annot.set_flags(ANNOT_FLAG_READONLY)
-                                annot.update()
-                        modified = True  # Include every page.
+                    # If no unit was written, then display an error.
+                    if master_zip_path is None:
+                        ui.error("Mismatch: PDF & Excel file data not matching. Please upload proper data.")
+                    else:
+                        master_zip_name = f"{selected_month}-{selected_year}.zip"
+                        if uploads is None:
+                            close_output_reader(output)
+                        else:
+                            try:
+                                with stage(metrics, "s3_wait"):
+                                    upload_stats = finish_uploads(uploads)
+                                    write_manifest(uploads["client"], S3_BUCKET_NAME, manifest)
+                                master_zip_path = cache_rename("results", output_key, result_key)
+                                clear_checkpoints(checkpoints)
+                                add_time(metrics, "s3_upload", upload_stats["seconds"])
+                                count(metrics, "s3_objects", upload_stats["objects"])
+                                count(metrics, "s3_bytes", upload_stats["bytes"])
+                                ui.success("Data processed & generated files are archived for future use.")
+                                ui.info(describe_upload_stats(upload_stats))
  
-                if modified:
-                    unit_modified[unit] = True
-                    unit_pdfs[unit].insert_pdf(temp_doc)
-                temp_doc.close()
+                            except NoCredentialsError:
+                                ui.error("AWS credentials not found. Could not upload to S3. Press Generate again to retry the archive.")
+                            except Exception as e:
+                                ui.error(f"Failed to upload to S3: {e}. Press Generate again to retry the archive.")
+                            finally:
+                                close_output_reader(output)
+                                invalidate_archive_prefix(month_prefix)
  
-        # Return only those units where at least one page was added.
-        return {unit: pdf for unit, pdf in unit_pdfs.items() if unit_modified[unit]}
+                        with open(master_zip_path, "rb") as master_zip:
+                            ui.download_button(
+                                label="Download Output in ZIP",
+                                data=master_zip,
+                                file_name=master_zip_name,
+                                mime="application/zip"
+                            )
+ 
+                        end_time = time.time()
+                        elapsed_time = end_time - start_time
+                        ui.success(
+                            f"Processing completed in {elapsed_time:.2f} seconds. "
+                            f"Highlight annotations: {mark_counts['highlight']}, Mask annotations: {mark_counts['mask']}."
+                        )
+                        with ui.expander("Performance details"):
+                            ui.json(finish_metrics(metrics))
+ 
+                progress_bar.empty()
+                status_text.text("✅ Processing completed.")
+        except Exception as e:
+            ui.error("❌ Error reading Excel file. Please check the file and column names.")
+            ui.error(e)
  
     # ----------------------- Step 1: File Uploads (side-by-side) -----------------------
     col_pdf, col_excel = st.columns(2)
@@ -184,6 +386,7 @@ def run_pf_section():
  
     # ----------------------- Processing & Download -----------------------
     st.header("Processing & Download")
+    job_id = session_job_id("PF")
     if generate_button:
         if selected_month == "-- Select Month --":
             st.error("Please select month before proceeding.")
@@ -196,202 +399,45 @@ def run_pf_section():
                 st.error("Duplicate PDF files detected. Please upload only unique PDF files.")
                 return
  
-            try:
-                df = pd.read_excel(excel_file)
-                # Check if required columns are present (use "PF UAN" instead of "UAN")
-                if 'UNIT' not in df.columns or 'PF UAN' not in df.columns:
-                    st.error("The Excel file must contain 'UNIT' and 'PF UAN' columns. Please upload the proper file.")
-                else:
-                    # Ensure the PF UAN column is string type.
-                    df['PF UAN'] = df['PF UAN'].fillna(0).astype(np.int64).astype(str)
-                    # Build a dictionary mapping each UNIT to its list of PF UAN values.
-                    unit_uan_dict = {}
-                    for _, row in df.iterrows():
-                        unit = row['UNIT']
-                        uan = row['PF UAN']
-                        unit_uan_dict.setdefault(unit, []).append(uan)
- 
-                    # Initialize a dictionary to track matched UANs per unit.
-                    matched_uan_dict = {unit: set() for unit in unit_uan_dict}
- 
-                    all_unit_files = {}
-                    zip_buffer_all = io.BytesIO()
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    total_files = len(pdf_files)
-                    highlight_count = 0
-                    mask_count = 0
-                    start_time = time.time()
- 
-                    with zipfile.ZipFile(zip_buffer_all, "w", zipfile.ZIP_DEFLATED) as zip_all:
-                        for i, pdf in enumerate(pdf_files):
-                            status_text.text(f"🔄 Processing file {i+1} of {total_files}: {pdf.name}")
-                            unit_pdfs = process_pdf(pdf, unit_uan_dict, mode, page_mode, matched_uan_dict)
-                            for unit, new_doc in unit_pdfs.items():
-                                if new_doc.page_count > 0:
-                                    # Count annotations for reporting.
-                                    def color_match(c1, c2, tol=0.05):
-                                        return all(abs(a - b) < tol for a, b in zip(c1, c2))
- 
-                                    if mode == "Highlight Relevant":
-                                        highlight_count += sum(
-                                            1
-                                            for page in new_doc
-                                            for annot in page.annots()
-                                            if annot and color_match(annot.colors.get('fill', (0, 0, 0)), (1.0, 1.0, 0.0))
-                                        )
-                                    elif mode == "Mask all not relevant":
-                                        highlight_count += sum(
-                                            1
-                                            for page in new_doc
-                                            for annot in page.annots()
-                                            if annot and color_match(annot.colors.get('fill', (0, 0, 0)), (1.0, 1.0, 1.0))
-                                        )
-                                        mask_count += sum(
-                                            1
-                                            for page in new_doc
-                                            for annot in page.annots()
-                                            if annot and color_match(annot.colors.get('fill', (0, 0, 0)), (0.5, 0.5, 0.5))
-                                        )
- 
-                                    pdf_bytes = new_doc.write()
-                                    new_doc.close()
-                                    zip_all.writestr(f"{unit}_PF.pdf", pdf_bytes)
-                                    all_unit_files.setdefault(unit, []).append(
-                                        fitz.open(stream=pdf_bytes, filetype="pdf")
-                                    )
-                            progress_bar.progress((i + 1) / total_files)
- 
-                    # Additional check: if no files were processed, show an error.
-                    if not any(all_unit_files.values()):
-                        st.error("Mismatch: PDF & Excel file data not matching. Please upload proper data.")
-                    else:
-                        unit_zip_data = {}
-                        for unit, doc_list in all_unit_files.items():
-                            # Only create a ZIP for units that have processed documents and at least one matched UAN.
-                            if doc_list and matched_uan_dict[unit]:
-                                merged_pdf = fitz.open()
-                                for doc_obj in doc_list:
-                                    merged_pdf.insert_pdf(doc_obj)
-                                    doc_obj.close()
-                                merged_bytes = merged_pdf.write()
-                                merged_pdf.close()
- 
-                                zip_buffer = io.BytesIO()
-                                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-                                    zipf.writestr(f"{unit}_PF.pdf", merged_bytes)
-                                    # Prepare matched and unmatched Excel files.
-                                    df_unit = df[df['UNIT'] == unit].copy()
-                                    df_unit['PF UAN'] = df_unit['PF UAN'].astype(str)
-                                    df_match = df_unit[df_unit['PF UAN'].isin(matched_uan_dict[unit])]
-                                    df_unmatch = df_unit[~df_unit['PF UAN'].isin(matched_uan_dict[unit])]
- 
-                                    # Explicitly define the required columns to include in Excel outputs
-                                    desired_cols = [
-                                        'SNO', 'EMP CODE', 'EMP NAME', 'BRANCH', 'BRANCH 1',
-                                        'UNIT', 'STATE', 'PFNO', 'PF UAN'
-                                    ]
- 
-                                    available_cols = [col for col in desired_cols if col in df.columns]
-                                    df_match = df_match[available_cols]
-                                    df_unmatch = df_unmatch[available_cols]
- 
-                                    match_buffer = io.BytesIO()
-                                    with pd.ExcelWriter(match_buffer, engine='xlsxwriter') as writer:
-                                        df_match.to_excel(writer, index=False)
-                                    match_buffer.seek(0)
-                                    zipf.writestr(f"{unit}_Match.xlsx", match_buffer.getvalue())
- 
-                                    unmatch_buffer = io.BytesIO()
-                                    with pd.ExcelWriter(unmatch_buffer, engine='xlsxwriter') as writer:
-                                        df_unmatch.to_excel(writer, index=False)
-                                    unmatch_buffer.seek(0)
-                                    zipf.writestr(f"{unit}_Unmatch.xlsx", unmatch_buffer.getvalue())
- 
-                                zip_buffer.seek(0)
-                                unit_zip_data[unit] = zip_buffer.getvalue()
- 
-                        # If no ZIPs were created for any unit, then display an error.
-                        if not unit_zip_data:
-                            st.error("Mismatch: PDF & Excel file data not matching. Please upload proper data.")
-                        else:
-                            master_zip_buffer = io.BytesIO()
-                            with zipfile.ZipFile(master_zip_buffer, "w", zipfile.ZIP_DEFLATED) as master_zip:
-                                for unit, zip_data in unit_zip_data.items():
-                                    master_zip.writestr(f"{unit}_PF.zip", zip_data)
- 
-                            master_zip_buffer.seek(0)
-                            master_zip_name = f"{selected_month}-{selected_year}.zip"
-                            # Prepare uncompressed versions of PDFs and Excel files for S3 upload
-                            unit_pdf_data = {}
-                            unit_excel_data = {}
- 
-                            for unit, zip_data in unit_zip_data.items():
-                                zip_file = zipfile.ZipFile(io.BytesIO(zip_data))
-                                pdf_bytes = zip_file.read(f"{unit}_PF.pdf")
-                                matched_bytes = zip_file.read(f"{unit}_Match.xlsx")
-                                unmatched_bytes = zip_file.read(f"{unit}_Unmatch.xlsx")
- 
-                                unit_pdf_data[unit] = pdf_bytes
-                                unit_excel_data[unit] = (matched_bytes, unmatched_bytes)
-                            try:
-                                s3_client = boto3.client(
-                                    's3',
-                                    aws_access_key_id=AWS_ACCESS_KEY,
-                                    aws_secret_access_key=AWS_SECRET_KEY
-                                )
- 
-                                # Upload individual files for each unit (no zip)
-                                for unit, pdf_bytes in unit_pdf_data.items():
-                                    s3_client.upload_fileobj(
-                                        io.BytesIO(pdf_bytes),
-                                        S3_BUCKET_NAME,
-                                        f"{S3_FOLDER}{selected_month}-{selected_year}/{unit}/{unit}_Processed.pdf"
-                                    )
-                                    if unit in unit_excel_data:
-                                        matched_bytes, unmatched_bytes = unit_excel_data[unit]
- 
-                                        s3_client.upload_fileobj(
-                                            io.BytesIO(matched_bytes),
-                                            S3_BUCKET_NAME,
-                                            f"{S3_FOLDER}{selected_month}-{selected_year}/{unit}/{unit}_Match.xlsx"
-                                        )
-                                        s3_client.upload_fileobj(
-                                            io.BytesIO(unmatched_bytes),
-                                            S3_BUCKET_NAME,
-                                            f"{S3_FOLDER}{selected_month}-{selected_year}/{unit}/{unit}_Unmatch.xlsx"
-                                        )
- 
-                                st.success("Data processed & generated files are archived for future use.")
- 
-                            except NoCredentialsError:
-                                st.error("AWS credentials not found. Could not upload to S3.")
-                            except Exception as e:
-                                st.error(f"Failed to upload to S3: {e}")
- 
-                            st.download_button(
-                                label="Download Output in ZIP",
-                                data=master_zip_buffer.getvalue(),
-                                file_name=master_zip_name,
-                                mime="application/zip"
-                            )
- 
-                            end_time = time.time()
-                            elapsed_time = end_time - start_time
-                            st.success(
-                                f"Processing completed in {elapsed_time:.2f} seconds. "
-                                f"Highlight annotations: {highlight_count}, Mask annotations: {mask_count}."
-                            )
+            # Each PDF is copied to disk once (hashed on the way); the run only keeps the paths.
+            pdf_uploads = spool_uploads(pdf_files)
+ 
+            # --- Result cache: same files and options as an earlier run return its ZIP at once ---
+            result_key = cache_key(
+                "PF",
+                *[pdf["sha256"] for pdf in pdf_uploads],
+                content_hash(excel_file.getvalue()),
+                mode, page_mode, output_mode, selected_month, selected_year
+            )
+            cached_zip_path = cache_get("results", result_key)
+            if cached_zip_path is not None:
+                st.success("These files were already processed with the same options. Returning the previous output.")
+                st.download_button(
+                    label="Download Output in ZIP",
+                    data=deferred_file(cached_zip_path),
+                    file_name=f"{selected_month}-{selected_year}.zip",
+                    mime="application/zip"
+                )
+                return
  
-                    progress_bar.empty()
-                    status_text.text("✅ Processing completed.")
-            except Exception as e:
-                st.error("❌ Error reading Excel file. Please check the file and column names.")
-                st.error(e)
+            # --- Run in the background: the page polls the job and shows its results ---
+            if job_id and is_job_active(job_id):
+                st.warning("A PF run of this session is still in progress. Please wait for it to finish.")
+            else:
+                new_job_id = submit_job(
+                    "PF", f"PF {selected_month}-{selected_year}",
+                    sum(pdf["size"] for pdf in pdf_uploads) + excel_file.size,
+                    generate_outputs, pdf_uploads, excel_file, result_key,
+                    dedupe_key=result_key
+                )
+                if new_job_id is None:
+                    st.error("Too many runs are waiting to be processed. Please try again in a few minutes.")
+                else:
+                    job_id = new_job_id
+                    remember_job("PF", job_id)
         else:
             st.info("Please upload the PDF(s) and Excel file in the sections above.")
  
- 
- 
- 
- 
\ No newline at end of file
+    # Latest job of this session (also after a rerun or a reconnect), refreshed until it ends.
+    if job_id and show_job(job_id):
+        poll_job(job_id)
@@ -0,0 +1,115 @@
+import io
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+# Header cell format of the Matched / Unmatched workbooks (same look as pandas' to_excel).
+HEADER_FORMAT = {"bold": True, "border": 1, "align": "center", "valign": "top"}
+DATE_FORMAT = "yyyy-mm-dd hh:mm:ss"
+
+
+def report_workers():
+    """Number of workbooks written at the same time (REPORT_WORKERS in the .env file)."""
+    try:
+        workers = int(os.getenv("REPORT_WORKERS", 0))
+    except ValueError:
+        workers = 0
+    return workers if workers > 0 else min(8, os.cpu_count() or 1)
+
+
+def matched_flags(df, id_column, unit_matched):
+    """
+    Flags every roster row whose identifier was matched for its own unit, in one vectorized
+    isin over (UNIT, identifier) pairs instead of one filter per unit.
+    """
+    pairs = [(unit, identifier) for unit, ids in unit_matched.items() for identifier in ids]
+    if not pairs:
+        return pd.Series(False, index=df.index)
+    keys = pd.MultiIndex.from_arrays([df["UNIT"], df[id_column]])
+    return pd.Series(keys.isin(pairs), index=df.index)
+
+
+def unit_match_counts(df, flags):
+    """{ unit: (matched rows, unmatched rows) } of every unit of the roster, from its matched_flags."""
+    matched = flags.groupby(df["UNIT"], sort=False).sum()
+    totals = df.groupby("UNIT", sort=False).size()
+    return {unit: (int(matched[unit]), int(totals[unit] - matched[unit])) for unit in totals.index}
+
+
+def _cell(value):
+    """Converts a DataFrame value into something xlsxwriter writes natively (None = blank)."""
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if hasattr(value, "item"):  # numpy scalar
+        return value.item()
+    return value
+
+
+def write_workbook(df, sheet_name=None):
+    """
+    Writes df (header + rows, no index) into an .xlsx and returns its bytes.
+    xlsxwriter runs in constant_memory mode: rows are flushed to disk as they are written,
+    so memory stays flat however large the unit is.
+    """
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {"constant_memory": True})
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format(HEADER_FORMAT)
+    date_format = workbook.add_format({"num_format": DATE_FORMAT})
+
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+    for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        for col_idx, value in enumerate(row):
+            value = _cell(value)
+            if value is None:
+                continue
+            if hasattr(value, "year"):
+                worksheet.write_datetime(row_idx, col_idx, value, date_format)
+            else:
+                worksheet.write(row_idx, col_idx, value)
+    workbook.close()
+    return buffer.getvalue()
+
+
+def iter_unit_reports(df, flags, units, columns, sheet_names=(None, None)):
+    """
+    Builds the Matched / Unmatched workbooks of the units in units, a batch at a time, and
+    yields (matched_bytes, unmatched_bytes) of each unit in that order.
+      - flags is the roster's matched_flags, computed once by the caller (and shared with
+        unit_match_counts).
+      - The roster is split by unit with a single groupby.
+      - Workbooks are written in parallel (report_workers threads), each in constant_memory mode.
+        A batch holds enough units to keep every thread busy, and the next batch is only built
+        once the caller took the units of this one, so at most one batch of workbooks is held
+        however many units the roster has.
+    columns lists the report columns; those missing from the roster are left out.
+    sheet_names is (matched sheet, unmatched sheet); None keeps xlsxwriter's default "Sheet1".
+    """
+    report_cols = [col for col in columns if col in df.columns]
+    flags = flags.to_numpy()
+    groups = df.groupby("UNIT", sort=False, dropna=False).indices
+    no_rows = np.empty(0, dtype=np.intp)
+    workers = report_workers()
+    batch_units = max(1, workers // 2)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(units), batch_units):
+            jobs = []
+            for unit in units[start:start + batch_units]:
+                positions = groups.get(unit, no_rows)
+                unit_df = df.iloc[positions][report_cols]
+                unit_flags = flags[positions]
+                jobs.append((unit_df[unit_flags], sheet_names[0]))
+                jobs.append((unit_df[~unit_flags], sheet_names[1]))
+            workbooks = list(pool.map(lambda job: write_workbook(*job), jobs))
+            del jobs
+            for position in range(0, len(workbooks), 2):
+                yield workbooks[position], workbooks[position + 1]
@@ -0,0 +1,71 @@
+import importlib.util
+import io
+
+import pandas as pd
+
+from disk_cache import cache_get, cache_key, cache_put, content_hash, env_bytes
+
+# Byte budget of the parsed-roster cache (ROSTER_CACHE_MAX_BYTES in the .env file).
+DEFAULT_ROSTER_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+
+def excel_engine():
+    """Fastest Excel reader available: python-calamine (Rust) when installed, else pandas' default."""
+    if importlib.util.find_spec("python_calamine") is not None:
+        return "calamine"
+    return None
+
+
+def parquet_available():
+    """Parquet caching needs pyarrow (or fastparquet); without it rosters are parsed every time."""
+    return any(importlib.util.find_spec(name) is not None for name in ("pyarrow", "fastparquet"))
+
+
+def read_roster(excel_file, dtype=None):
+    """
+    Reads the uploaded roster Excel file into a DataFrame.
+      - Parsed with python-calamine when available (much faster than openpyxl on large sheets).
+      - The parsed DataFrame is cached as Parquet, keyed by the file's SHA-256 and dtype, so
+        re-uploading the same roster loads it without parsing the Excel file again.
+    Rosters Parquet cannot store (e.g. mixed-type columns) are simply not cached.
+    """
+    data = excel_file.getvalue()
+    key = cache_key("roster", content_hash(data), repr(sorted((dtype or {}).items())))
+    use_cache = parquet_available()
+
+    if use_cache:
+        cached_path = cache_get("rosters", key)
+        if cached_path is not None:
+            try:
+                return pd.read_parquet(cached_path)
+            except Exception:
+                pass  # unreadable entry: parse the Excel file again and overwrite it
+
+    engine = excel_engine()
+    try:
+        df = pd.read_excel(io.BytesIO(data), dtype=dtype, engine=engine)
+    except (ImportError, ValueError):
+        if engine is None:
+            raise
+        # Engine not supported by this pandas version (or file it can't read): use the default.
+        df = pd.read_excel(io.BytesIO(data), dtype=dtype)
+
+    if use_cache:
+        try:
+            buffer = io.BytesIO()
+            df.to_parquet(buffer)
+            cache_put(
+                "rosters", key, buffer.getvalue(),
+                env_bytes("ROSTER_CACHE_MAX_BYTES", DEFAULT_ROSTER_CACHE_MAX_BYTES)
+            )
+        except Exception:
+            pass
+    return df
+
+
+def build_unit_mapping(df, id_column):
+    """
+    Builds { UNIT: [identifiers] } with one vectorized groupby instead of iterrows.
+    Units keep their first-appearance order and identifiers keep their row order.
+    """
+    return df.groupby("UNIT", sort=False, dropna=False)[id_column].agg(list).to_dict()
@@ -0,0 +1,236 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+
+from disk_cache import env_bytes, env_int
+
+# Upload settings (.env file):
+#   S3_UPLOAD_WORKERS        objects uploaded at the same time, per process (default 16)
+#   S3_PART_CONCURRENCY      parts of one multipart object uploaded at the same time (default 4)
+#   S3_MULTIPART_THRESHOLD   objects from this size on are uploaded in parts (default 16 MB)
+#   S3_MULTIPART_CHUNKSIZE   part size (default 16 MB)
+#   S3_UPLOAD_RETRIES        extra attempts per object after a failed upload (default 3)
+#   S3_ENDPOINT_URL          S3-compatible endpoint (e.g. MinIO), AWS when unset
+DEFAULT_S3_UPLOAD_WORKERS = 16
+DEFAULT_S3_PART_CONCURRENCY = 4
+DEFAULT_S3_MULTIPART_THRESHOLD = 16 * 1024 ** 2
+DEFAULT_S3_MULTIPART_CHUNKSIZE = 16 * 1024 ** 2
+DEFAULT_S3_UPLOAD_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+
+# Errors worth retrying the whole object for (botocore already retries single requests):
+# lost or timed-out connections, and S3 error codes that mean "try again later" (any 5xx too).
+# Anything else (a missing spool file, access denied, no such bucket) fails at once.
+RETRYABLE_UPLOAD_ERRORS = (BotoConnectionError, HTTPClientError)
+RETRYABLE_ERROR_CODES = (
+    "RequestTimeout", "SlowDown", "Throttling", "ThrottlingException", "InternalError", "ServiceUnavailable",
+)
+
+# One client and one upload pool per process, shared by every section and session.
+_client = None
+_client_key = None
+_client_lock = threading.Lock()
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+
+def s3_upload_workers():
+    """Number of objects uploaded at the same time by this process."""
+    workers = env_int("S3_UPLOAD_WORKERS", DEFAULT_S3_UPLOAD_WORKERS)
+    return workers if workers > 0 else DEFAULT_S3_UPLOAD_WORKERS
+
+
+def transfer_config():
+    """Multipart thresholds and per-object part concurrency of upload_fileobj."""
+    return TransferConfig(
+        multipart_threshold=env_bytes("S3_MULTIPART_THRESHOLD", DEFAULT_S3_MULTIPART_THRESHOLD),
+        multipart_chunksize=env_bytes("S3_MULTIPART_CHUNKSIZE", DEFAULT_S3_MULTIPART_CHUNKSIZE),
+        max_concurrency=env_int("S3_PART_CONCURRENCY", DEFAULT_S3_PART_CONCURRENCY),
+    )
+
+
+def get_s3_client(access_key, secret_key):
+    """
+    Returns the process-wide S3 client (boto3 clients are thread-safe), created on first use
+    and again only if the credentials or endpoint change. Its connection pool is sized for
+    every upload worker sending parts at the same time.
+    """
+    global _client, _client_key
+    endpoint_url = os.getenv("S3_ENDPOINT_URL") or None
+    workers = s3_upload_workers()
+    part_concurrency = env_int("S3_PART_CONCURRENCY", DEFAULT_S3_PART_CONCURRENCY)
+    key = (access_key, secret_key, endpoint_url, workers, part_concurrency)
+    with _client_lock:
+        if _client is None or _client_key != key:
+            _client = boto3.client(
+                's3',
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                endpoint_url=endpoint_url,
+                config=Config(
+                    max_pool_connections=max(10, workers * max(1, part_concurrency)),
+                    retries={"max_attempts": 5, "mode": "standard"},
+                    tcp_keepalive=True,
+                ),
+            )
+            _client_key = key
+        return _client
+
+
+def get_upload_pool():
+    """Process-wide thread pool running uploads (recreated if S3_UPLOAD_WORKERS changes)."""
+    global _pool, _pool_workers
+    workers = s3_upload_workers()
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="s3-upload")
+            _pool_workers = workers
+        return _pool
+
+
+def start_uploads(access_key, secret_key, bucket):
+    """
+    Starts a batch of uploads to bucket on the shared client and pool.
+    At most twice the worker count of objects are pending at once: submit_upload blocks
+    beyond that, so a producer never gets far ahead of the network.
+
+    Returns the batch state used by submit_upload / finish_uploads.
+    """
+    workers = s3_upload_workers()
+    return {
+        "client": get_s3_client(access_key, secret_key),
+        "bucket": bucket,
+        "config": transfer_config(),
+        "retries": env_int("S3_UPLOAD_RETRIES", DEFAULT_S3_UPLOAD_RETRIES),
+        "pool": get_upload_pool(),
+        "slots": threading.BoundedSemaphore(2 * workers),
+        "futures": [],
+        "error": None,
+        "lock": threading.Lock(),
+        "spans": [],
+        "bytes": 0,
+    }
+
+
+def _is_retryable(error):
+    """True for a transient upload error (see RETRYABLE_UPLOAD_ERRORS / RETRYABLE_ERROR_CODES)."""
+    if isinstance(error, RETRYABLE_UPLOAD_ERRORS):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in RETRYABLE_ERROR_CODES or status >= 500
+    return False
+
+
+def _upload_one(uploads, key, open_body):
+    """
+    Uploads one object, retrying with exponential backoff (and jitter) on transient errors.
+    Once an object of the batch has failed for good, the remaining ones are skipped.
+    """
+    for attempt in range(uploads["retries"] + 1):
+        if uploads["error"] is not None:
+            return
+        sent = [0]
+        started = time.perf_counter()
+        try:
+            with open_body() as body:
+                uploads["client"].upload_fileobj(
+                    body, uploads["bucket"], key,
+                    Config=uploads["config"],
+                    Callback=lambda n: sent.__setitem__(0, sent[0] + n),
+                )
+        except Exception as e:
+            if not _is_retryable(e) or attempt == uploads["retries"]:
+                uploads["error"] = e
+                raise
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt * (1 + random.random()))
+        else:
+            with uploads["lock"]:
+                uploads["spans"].append((started, time.perf_counter()))
+                uploads["bytes"] += sent[0]
+            return
+
+
+def submit_upload(uploads, key, open_body):
+    """
+    Queues one object for upload. open_body() must return a readable binary file object
+    (used in a with block); it is called again for every retry.
+    """
+    uploads["slots"].acquire()
+    try:
+        future = uploads["pool"].submit(_upload_one, uploads, key, open_body)
+    except BaseException:
+        uploads["slots"].release()
+        raise
+    future.add_done_callback(lambda _: uploads["slots"].release())
+    uploads["futures"].append(future)
+
+
+def cancel_uploads(uploads):
+    """Drops the uploads of the batch not started yet (e.g. processing failed half-way)."""
+    uploads["error"] = uploads["error"] or RuntimeError("Uploads cancelled.")
+    for future in uploads["futures"]:
+        future.cancel()
+
+
+def finish_uploads(uploads):
+    """
+    Waits for every queued upload and raises the batch's first failure, if any (the uploads
+    queued after it were skipped). Returns upload_stats(uploads).
+    """
+    wait(uploads["futures"])
+    if uploads["error"] is not None:
+        raise uploads["error"]
+    return upload_stats(uploads)
+
+
+def upload_stats(uploads):
+    """
+    Throughput and per-object latency of the uploads finished so far:
+        { "objects", "bytes", "seconds", "mb_per_second",
+          "latency_p50", "latency_p95", "latency_max" }  (latencies in seconds)
+    seconds runs from the first upload's start to the last one's end, so time spent producing
+    files between uploads counts, but time before the first upload does not.
+    """
+    with uploads["lock"]:
+        spans = list(uploads["spans"])
+        total_bytes = uploads["bytes"]
+    latencies = sorted(end - start for start, end in spans)
+    seconds = max(end for _, end in spans) - min(start for start, _ in spans) if spans else 0.0
+
+    def percentile(p):
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(round(p * (len(latencies) - 1))))]
+
+    return {
+        "objects": len(latencies),
+        "bytes": total_bytes,
+        "seconds": seconds,
+        "mb_per_second": total_bytes / 1024 ** 2 / seconds if seconds > 0 else 0.0,
+        "latency_p50": percentile(0.5),
+        "latency_p95": percentile(0.95),
+        "latency_max": latencies[-1] if latencies else 0.0,
+    }
+
+
+def describe_upload_stats(stats):
+    """One-line summary of upload_stats for the UI."""
+    return (
+        f"Uploaded {stats['objects']} files ({stats['bytes'] / 1024 ** 2:.1f} MB) in "
+        f"{stats['seconds']:.1f} seconds ({stats['mb_per_second']:.1f} MB/s). "
+        f"Per file: median {stats['latency_p50']:.2f}s, p95 {stats['latency_p95']:.2f}s, "
+        f"max {stats['latency_max']:.2f}s."
+    )
@@ -0,0 +1,26 @@
+import pytest
+
+from disk_cache import env_bytes, env_int, env_seconds
+
+
+@pytest.mark.parametrize("value, expected", [("1024", 1024), ("2k", 2048), ("256M", 256 * 1024 ** 2), ("2GB", 2 * 1024 ** 3)])
+def test_env_bytes_accepts_size_units(monkeypatch, value, expected):
+    monkeypatch.setenv("SOME_MAX_BYTES", value)
+    assert env_bytes("SOME_MAX_BYTES", 1) == expected
+
+
+@pytest.mark.parametrize("value, expected", [("900", 900), ("30m", 1800), ("6h", 6 * 3600), ("2k", 5)])
+def test_env_seconds_accepts_time_units_only(monkeypatch, value, expected):
+    monkeypatch.setenv("SOME_SECONDS", value)
+    assert env_seconds("SOME_SECONDS", 5) == expected
+
+
+@pytest.mark.parametrize("value, expected", [("4", 4), ("2k", 8), ("4h", 8), ("many", 8)])
+def test_env_int_rejects_units(monkeypatch, value, expected):
+    monkeypatch.setenv("SOME_WORKERS", value)
+    assert env_int("SOME_WORKERS", 8) == expected
+
+
+def test_unset_setting_falls_back_to_default(monkeypatch):
+    monkeypatch.delenv("SOME_WORKERS", raising=False)
+    assert env_int("SOME_WORKERS", 8) == 8
@@ -0,0 +1,50 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import object_cache
+
+BUCKET = "object-cache-test"
+
+
+@pytest.fixture
+def s3_object(tmp_path, monkeypatch):
+    monkeypatch.setenv("CORE_INTEGRA_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket=BUCKET)
+        s3_client.put_object(Bucket=BUCKET, Key="PF/Jan-2026/A/A.pdf", Body=b"unit pdf")
+        head = s3_client.head_object(Bucket=BUCKET, Key="PF/Jan-2026/A/A.pdf")
+        yield s3_client, {"Key": "PF/Jan-2026/A/A.pdf", "ETag": head["ETag"]}
+
+
+def test_copy_evicted_before_open_is_downloaded_again(s3_object, monkeypatch):
+    s3_client, obj = s3_object
+    real_get = object_cache.get_cached_object
+    evicted = []
+
+    def get_then_evict(*args, **kwargs):
+        path = real_get(*args, **kwargs)
+        if not evicted:  # a concurrent miss evicts the copy between the lookup and the open
+            os.remove(path)
+            evicted.append(path)
+        return path
+
+    monkeypatch.setattr(object_cache, "get_cached_object", get_then_evict)
+    with object_cache.open_cached_object(s3_client, BUCKET, obj) as f:
+        assert f.read() == b"unit pdf"
+    assert evicted
+
+
+def test_copy_evicted_after_lookup_is_a_miss(s3_object, monkeypatch):
+    s3_client, obj = s3_object
+    path = object_cache.get_cached_object(s3_client, BUCKET, obj)
+    monkeypatch.setattr(object_cache, "cache_get", lambda name, key: path)
+    os.remove(path)
+
+    assert object_cache.get_cached_object(s3_client, BUCKET, obj) == path
+    with open(path, "rb") as f:
+        assert f.read() == b"unit pdf"
@@ -0,0 +1,76 @@
+import io
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+import s3_upload
+
+BUCKET = "s3-upload-test"
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("S3_UPLOAD_RETRIES", "2")
+    monkeypatch.setattr(s3_upload, "RETRY_BACKOFF_SECONDS", 0)
+    with mock_aws():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket=BUCKET)
+        yield s3_upload.start_uploads("testing", "testing", BUCKET)
+
+
+def _failing_first(uploads, monkeypatch, error, failures):
+    """Makes the first `failures` uploads of the batch raise error; returns the keys attempted."""
+    attempts = []
+    real_upload = uploads["client"].upload_fileobj
+
+    def upload_fileobj(body, bucket, key, **kwargs):
+        attempts.append(key)
+        if len(attempts) <= failures:
+            raise error
+        return real_upload(body, bucket, key, **kwargs)
+
+    monkeypatch.setattr(uploads["client"], "upload_fileobj", upload_fileobj)
+    return attempts
+
+
+def test_transient_errors_are_retried(uploads, monkeypatch):
+    slow_down = ClientError({"Error": {"Code": "SlowDown"}, "ResponseMetadata": {"HTTPStatusCode": 503}}, "PutObject")
+    attempts = _failing_first(uploads, monkeypatch, slow_down, failures=2)
+
+    s3_upload.submit_upload(uploads, "PF/Jan-2026/A/A.pdf", lambda: io.BytesIO(b"unit pdf"))
+    stats = s3_upload.finish_uploads(uploads)
+
+    assert len(attempts) == 3
+    assert stats["objects"] == 1
+    body = uploads["client"].get_object(Bucket=BUCKET, Key="PF/Jan-2026/A/A.pdf")["Body"].read()
+    assert body == b"unit pdf"
+
+
+@pytest.mark.parametrize("error", [
+    ClientError({"Error": {"Code": "AccessDenied"}, "ResponseMetadata": {"HTTPStatusCode": 403}}, "PutObject"),
+    FileNotFoundError("spooled file is gone"),
+])
+def test_permanent_errors_fail_at_once(uploads, monkeypatch, error):
+    attempts = _failing_first(uploads, monkeypatch, error, failures=3)
+
+    s3_upload.submit_upload(uploads, "PF/Jan-2026/A/A.pdf", lambda: io.BytesIO(b"unit pdf"))
+    with pytest.raises(type(error)):
+        s3_upload.finish_uploads(uploads)
+
+    assert len(attempts) == 1
+
+
+def test_missing_body_fails_at_once(uploads):
+    opened = []
+
+    def open_missing():
+        opened.append(True)
+        return open("/nonexistent/spooled.pdf", "rb")
+
+    s3_upload.submit_upload(uploads, "PF/Jan-2026/A/A.pdf", open_missing)
+    with pytest.raises(FileNotFoundError):
+        s3_upload.finish_uploads(uploads)
+
+    assert len(opened) == 1
@@ -0,0 +1,44 @@
+import fitz  # PyMuPDF
+
+from disk_cache import content_hash
+from word_cache import get_doc_words
+
+
+def _text_page(text):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    return doc
+
+
+def _xobject_pdf(texts):
+    """One page per text, each drawing its text through a Form XObject (show_pdf_page)."""
+    doc = fitz.open()
+    for text in texts:
+        source = _text_page(text)
+        page = doc.new_page()
+        page.show_pdf_page(page.rect, source, 0)
+        source.close()
+    return doc.tobytes()
+
+
+def _words(doc):
+    return [[word[4] for word in page.get_text("words")] for page in doc]
+
+
+def test_pages_drawn_through_xobjects_keep_their_own_words(tmp_path, monkeypatch):
+    monkeypatch.setenv("CORE_INTEGRA_CACHE_DIR", str(tmp_path))
+    first = _xobject_pdf(["UAN 100200300400"])
+    second = _xobject_pdf(["UAN 999888777666"])
+
+    for pdf_bytes in (first, second, first, second):  # second round is served from the cache
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            cached = [[word[4] for word in words] for words in get_doc_words(doc, content_hash(pdf_bytes))]
+            assert cached == _words(doc)
+
+    both = _xobject_pdf(["UAN 100200300400", "UAN 999888777666"])
+    with fitz.open(stream=both, filetype="pdf") as doc:
+        for _ in range(2):
+            words = get_doc_words(doc, content_hash(both))
+            assert [[word[4] for word in page_words] for page_words in words] == [
+                ["UAN", "100200300400"], ["UAN", "999888777666"]
+            ]
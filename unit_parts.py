@@ -0,0 +1,144 @@
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+
+import fitz  # PyMuPDF
+
+from disk_cache import cache_dir, env_bytes
+from metrics import count, stage
+
+# Per-unit output pages of a run, collected source PDF by source PDF until the units are merged.
+# Parts stay in memory up to a byte budget; beyond it, the unit holding the most bytes in memory
+# has its parts appended to its own PDF on disk (saved incrementally, so only the new pages are
+# written), which keeps memory flat however many units and pages a month has.
+# Parts are appended in source PDF order: parts of a PDF that finished before an earlier one
+# wait (in memory) for it, and callers running PDFs in parallel stop starting new ones while
+# unit_parts_over_budget() is true.
+# Settings (.env file):
+#   OUTPUT_MEMORY_MAX_BYTES   unit parts held in memory at most (default 256 MB)
+DEFAULT_OUTPUT_MEMORY_MAX_BYTES = 256 * 1024 ** 2
+# Folders of runs that died before discarding them are removed after this many seconds.
+UNIT_PARTS_STALE_SECONDS = 24 * 3600
+
+
+def output_memory_max_bytes():
+    """Byte budget of the unit parts held in memory."""
+    return env_bytes("OUTPUT_MEMORY_MAX_BYTES", DEFAULT_OUTPUT_MEMORY_MAX_BYTES)
+
+
+def start_unit_parts(metrics=None):
+    """
+    New, empty accumulator:
+        { "dir": spill folder, "units": { unit: { "memory": [PDF bytes], "bytes": n, "path": file or None } },
+          "waiting": { source PDF index: { unit: PDF bytes } }, "next": next index to append,
+          "memory_bytes": n, "max_bytes": budget, "metrics": metrics }
+    Spilling is timed as the "unit_spill" stage and counted as "spilled_bytes" in metrics.
+    """
+    root = cache_dir("unit_parts")
+    oldest = time.time() - UNIT_PARTS_STALE_SECONDS
+    for name in os.listdir(root):
+        with contextlib.suppress(FileNotFoundError):
+            if os.path.getmtime(os.path.join(root, name)) < oldest:
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    return {
+        "dir": tempfile.mkdtemp(dir=root),
+        "units": {},
+        "waiting": {},
+        "next": 0,
+        "memory_bytes": 0,
+        "max_bytes": output_memory_max_bytes(),
+        "metrics": metrics,
+    }
+
+
+def _spill(parts, unit):
+    """Appends the unit's in-memory parts to its PDF on disk."""
+    entry = parts["units"][unit]
+    with stage(parts["metrics"], "unit_spill"):
+        new_file = entry["path"] is None
+        if new_file:
+            fd, entry["path"] = tempfile.mkstemp(dir=parts["dir"], suffix=".pdf")
+            os.close(fd)
+            doc = fitz.open()
+        else:
+            doc = fitz.open(entry["path"])
+        for pdf_bytes in entry["memory"]:
+            with fitz.open(stream=pdf_bytes, filetype="pdf") as part_doc:
+                doc.insert_pdf(part_doc)
+        if new_file:
+            doc.save(entry["path"])
+        else:
+            doc.saveIncr()
+        doc.close()
+    count(parts["metrics"], "spilled_bytes", entry["bytes"])
+    parts["memory_bytes"] -= entry["bytes"]
+    entry["memory"] = []
+    entry["bytes"] = 0
+
+
+def _append(parts, unit_files):
+    for unit, pdf_bytes in unit_files.items():
+        entry = parts["units"].setdefault(unit, {"memory": [], "bytes": 0, "path": None})
+        entry["memory"].append(pdf_bytes)
+        entry["bytes"] += len(pdf_bytes)
+    # Waiting parts cannot be spilled (they must follow the PDFs before them).
+    while parts["memory_bytes"] > parts["max_bytes"]:
+        unit = max(parts["units"], key=lambda name: parts["units"][name]["bytes"], default=None)
+        if unit is None or not parts["units"][unit]["bytes"]:
+            break
+        _spill(parts, unit)
+
+
+def add_unit_parts(parts, index, unit_files):
+    """
+    Adds the outputs of source PDF number index ({ unit: PDF bytes of the unit's part }).
+    They are appended after those of every earlier PDF, so they wait until those are added.
+    """
+    parts["waiting"][index] = unit_files
+    parts["memory_bytes"] += sum(len(pdf_bytes) for pdf_bytes in unit_files.values())
+    while parts["next"] in parts["waiting"]:
+        _append(parts, parts["waiting"].pop(parts["next"]))
+        parts["next"] += 1
+
+
+def unit_parts_over_budget(parts):
+    """True while the parts in memory exceed the budget (only possible with waiting parts)."""
+    return parts["memory_bytes"] > parts["max_bytes"]
+
+
+def finish_unit_parts(parts):
+    """
+    Appends the parts still waiting (PDFs before them never finished, e.g. after a Cancel),
+    in source PDF order. Returns the units with pages, in the order they were first appended.
+    """
+    for index in sorted(parts["waiting"]):
+        _append(parts, parts["waiting"].pop(index))
+    return list(parts["units"])
+
+
+def merge_unit_parts(parts, unit):
+    """
+    One document with every page of the unit in source PDF order (the caller writes and closes
+    it). The unit's parts are dropped from the accumulator.
+    """
+    entry = parts["units"].pop(unit)
+    merged_pdf = fitz.open()
+    if entry["path"] is not None:
+        with fitz.open(entry["path"]) as spilled_doc:
+            merged_pdf.insert_pdf(spilled_doc)
+        os.remove(entry["path"])
+    for pdf_bytes in entry["memory"]:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as part_doc:
+            merged_pdf.insert_pdf(part_doc)
+    parts["memory_bytes"] -= entry["bytes"]
+    return merged_pdf
+
+
+def discard_unit_parts(parts):
+    """Drops every part and the spill folder."""
+    parts["units"].clear()
+    parts["waiting"].clear()
+    parts["memory_bytes"] = 0
+    shutil.rmtree(parts["dir"], ignore_errors=True)
@@ -0,0 +1,69 @@
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+
+from disk_cache import cache_dir, env_seconds
+
+# Uploaded PDFs are copied once, in chunks, into <cache>/uploads/ and hashed on the way, so a
+# run holds file paths instead of copies of every upload: PyMuPDF opens each PDF from its path
+# and reads pages from disk as they are needed, and Bank worker processes receive only the path.
+# Spooled files are named by their SHA-256, so the same PDF uploaded twice is stored once.
+# Settings (.env file):
+#   UPLOAD_RETENTION_SECONDS   spooled uploads not used for this long are deleted (default 1 day)
+DEFAULT_UPLOAD_RETENTION_SECONDS = 24 * 3600
+# Bytes copied (and hashed) at a time.
+SPOOL_CHUNK_BYTES = 1024 ** 2
+
+
+def upload_retention_seconds():
+    """Seconds a spooled upload is kept after it was last used."""
+    return env_seconds("UPLOAD_RETENTION_SECONDS", DEFAULT_UPLOAD_RETENTION_SECONDS)
+
+
+def _prune_uploads(folder):
+    """Deletes the spooled uploads (and abandoned partial copies) older than the retention time."""
+    oldest = time.time() - upload_retention_seconds()
+    with os.scandir(folder) as it:
+        for entry in it:
+            with contextlib.suppress(FileNotFoundError):
+                if entry.stat().st_mtime < oldest:
+                    os.remove(entry.path)
+
+
+def spool_upload(uploaded_file):
+    """
+    Copies an uploaded file (any readable file object with a name) to the upload spool.
+    Returns { "name": file name, "path": spooled copy, "sha256": hex digest, "size": bytes }.
+    """
+    folder = cache_dir("uploads")
+    digest = hashlib.sha256()
+    size = 0
+    uploaded_file.seek(0)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = uploaded_file.read(SPOOL_CHUNK_BYTES)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        path = os.path.join(folder, digest.hexdigest() + os.path.splitext(uploaded_file.name)[1].lower())
+        # Same content, same name: replacing an earlier copy also marks it as recently used.
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    finally:
+        uploaded_file.seek(0)
+    return {"name": uploaded_file.name, "path": path, "sha256": digest.hexdigest(), "size": size}
+
+
+def spool_uploads(uploaded_files):
+    """spool_upload of every file, in upload order (old spooled files are pruned first)."""
+    _prune_uploads(cache_dir("uploads"))
+    return [spool_upload(uploaded_file) for uploaded_file in uploaded_files]
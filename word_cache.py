@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from disk_cache import cache_dir, env_bytes
+
+# Byte budget of the page word cache (WORD_CACHE_MAX_BYTES in the .env file, 0 disables it).
+DEFAULT_WORD_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+# Separator of the per-page string table (never part of an extracted word).
+STRING_SEPARATOR = "\x00"
+
+
+def word_cache_max_bytes():
+    """Byte budget of the page word cache."""
+    return env_bytes("WORD_CACHE_MAX_BYTES", DEFAULT_WORD_CACHE_MAX_BYTES)
+
+
+def page_fingerprint(doc_sha256, page_number):
+    """
+    Identifies a page by the SHA-256 of its source PDF and its page number. What a page shows
+    also depends on resources its content stream only names (Form XObjects, fonts, images), so
+    no hash of the page alone is safe; the same upload seen again (another session, a resumed
+    or re-run month) still hits the cache.
+    """
+    return f"{doc_sha256}:{page_number}"
+
+
+def pack_words(words):
+    """
+    Packs page.get_text("words") into columns:
+        coords   -> float32 (n, 4) array of x0, y0, x1, y1
+        numbers  -> int32 (n, 3) array of block, line and word numbers
+        text_ids -> int32 index of every word into the string table
+        strings  -> the page's distinct word texts, each stored once
+    """
+    string_ids = {}
+    text_ids = np.empty(len(words), dtype=np.int32)
+    for w_idx, w in enumerate(words):
+        text_ids[w_idx] = string_ids.setdefault(w[4], len(string_ids))
+    coords = np.array([w[:4] for w in words], dtype=np.float32).reshape(-1, 4)
+    numbers = np.array([w[5:8] for w in words], dtype=np.int32).reshape(-1, 3)
+    strings = STRING_SEPARATOR.join(string_ids).encode("utf-8")
+    return coords.tobytes(), numbers.tobytes(), text_ids.tobytes(), strings
+
+
+def unpack_words(coords, numbers, text_ids, strings):
+    """Rebuilds the list of 8-tuples returned by page.get_text("words") from its packed columns."""
+    coords = np.frombuffer(coords, dtype=np.float32).reshape(-1, 4).tolist()
+    numbers = np.frombuffer(numbers, dtype=np.int32).reshape(-1, 3).tolist()
+    text_ids = np.frombuffer(text_ids, dtype=np.int32).tolist()
+    table = strings.decode("utf-8").split(STRING_SEPARATOR) if text_ids else []
+    return [
+        (c[0], c[1], c[2], c[3], table[t], n[0], n[1], n[2])
+        for c, n, t in zip(coords, numbers, text_ids)
+    ]
+
+
+def _connect():
+    conn = sqlite3.connect(os.path.join(cache_dir("words"), "words.sqlite"), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS page_words ("
+        " fingerprint TEXT PRIMARY KEY, coords BLOB, numbers BLOB, text_ids BLOB, strings BLOB,"
+        " size INTEGER, last_used REAL)"
+    )
+    return conn
+
+
+def _evict(conn, max_bytes):
+    """Drops the least recently used pages until the cache fits in max_bytes."""
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM page_words").fetchone()[0]
+    if total <= max_bytes:
+        return
+    victims = []
+    for fingerprint, size in conn.execute("SELECT fingerprint, size FROM page_words ORDER BY last_used"):
+        if total <= max_bytes:
+            break
+        victims.append((fingerprint,))
+        total -= size
+    conn.executemany("DELETE FROM page_words WHERE fingerprint = ?", victims)
+
+
+def _extract_words(doc, cancelled=None):
+    """page.get_text("words") of every page, stopping before the next page once cancelled() is true."""
+    doc_words = []
+    for page in doc:
+        if cancelled is not None and cancelled():
+            break
+        doc_words.append(page.get_text("words"))
+    return doc_words
+
+
+def get_doc_words(doc, doc_sha256=None, cancelled=None):
+    """
+    Returns page.get_text("words") for every page of doc, in page order.
+    doc_sha256 is the SHA-256 of the file doc was opened from (see upload_spool). Pages already
+    seen (same file, same page number) are served from the local SQLite cache without any
+    PyMuPDF text extraction; new pages are extracted once and stored. Coordinates come back
+    with float32 precision. Without doc_sha256, or on any cache failure, every page is extracted.
+    cancelled (a callable) is checked before each page: once it returns True the pages left
+    are skipped and the list is shorter than the document (pages extracted so far are still cached).
+    """
+    max_bytes = word_cache_max_bytes()
+    if max_bytes <= 0 or doc_sha256 is None:
+        return _extract_words(doc, cancelled)
+
+    try:
+        fingerprints = [page_fingerprint(doc_sha256, page_number) for page_number in range(doc.page_count)]
+        conn = _connect()
+    except (sqlite3.Error, OSError):
+        return _extract_words(doc, cancelled)
+
+    try:
+        cached = {}
+        distinct = list(dict.fromkeys(fingerprints))
+        for start in range(0, len(distinct), 500):
+            chunk = distinct[start:start + 500]
+            rows = conn.execute(
+                "SELECT fingerprint, coords, numbers, text_ids, strings FROM page_words"
+                f" WHERE fingerprint IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for fingerprint, coords, numbers, text_ids, strings in rows:
+                cached[fingerprint] = unpack_words(coords, numbers, text_ids, strings)
+
+        now = time.time()
+        doc_words = []
+        new_rows = []
+        for page, fingerprint in zip(doc, fingerprints):
+            if cancelled is not None and cancelled():
+                break
+            if fingerprint not in cached:
+                words = page.get_text("words")
+                packed = pack_words(words)
+                new_rows.append((fingerprint, *packed, sum(len(part) for part in packed), now))
+                cached[fingerprint] = words
+            doc_words.append(cached[fingerprint])
+
+        with conn:
+            conn.executemany(
+                "UPDATE page_words SET last_used = ? WHERE fingerprint = ?",
+                [(now, fingerprint) for fingerprint in distinct],
+            )
+            conn.executemany("INSERT OR REPLACE INTO page_words VALUES (?, ?, ?, ?, ?, ?, ?)", new_rows)
+            if new_rows:
+                _evict(conn, max_bytes)
+        return doc_words
+    except sqlite3.Error:
+        return _extract_words(doc, cancelled)
+    finally:
+        conn.close()